@@ -1,16 +1,52 @@
 """
 Conexión a PostgreSQL con databases y SQLAlchemy
 """
+import time
+from datetime import date
+from typing import Any, Callable, Dict, List, Tuple
+import asyncpg
 import databases
 import sqlalchemy
 from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.schema import CreateIndex, CreateTable
 from app.config import settings
+from app.utils.db_router import DatabaseRouter
+from app.utils.logger import logger
+from app.utils.query_stats import ConexionConEdad, InstrumentedDatabase
 
 # URL de conexión
 DATABASE_URL = settings.database_url
 
-# Crear conexión asíncrona
-database = databases.Database(DATABASE_URL)
+
+def _crear_database(url: str) -> InstrumentedDatabase:
+    """Base de datos con el pool configurado e instrumentada"""
+    return InstrumentedDatabase(
+        databases.Database(
+            url,
+            min_size=settings.db_pool_min,
+            max_size=settings.db_pool_max,
+            statement_cache_size=settings.db_statement_cache_size,
+            max_inactive_connection_lifetime=settings.db_conexion_inactiva_maxima,
+            connection_class=ConexionConEdad
+        ),
+        umbral_lento_ms=settings.db_consulta_lenta_ms,
+        timeout_adquisicion=settings.db_pool_timeout_adquisicion,
+        vida_maxima=settings.db_conexion_vida_maxima
+    )
+
+
+# Crear conexión asíncrona (instrumentada: latencia por huella de consulta y
+# espera de adquisición del pool)
+database = _crear_database(DATABASE_URL)
+
+# Lecturas enrutadas a réplicas (si hay configuradas); escrituras al primario
+db_router = DatabaseRouter(
+    database,
+    [_crear_database(url) for url in settings.database_replica_urls],
+    ventana_escritura=settings.db_read_your_writes_segundos,
+    intervalo_salud=settings.db_replicas_intervalo_salud,
+    lag_maximo=settings.db_replicas_lag_maximo
+)
 
 # Metadata de SQLAlchemy
 metadata = sqlalchemy.MetaData()
@@ -18,71 +54,430 @@ metadata = sqlalchemy.MetaData()
 # Base para modelos
 Base = declarative_base()
 
-# Tabla de compras
-compras_table = sqlalchemy.Table(
-    "compras",
+
+def _columnas_compra(archivo: bool = False) -> List[sqlalchemy.Column]:
+    """Columnas de una compra (iguales en `compras` y en `compras_archivo`)"""
+    return [
+        sqlalchemy.Column(
+            "id",
+            sqlalchemy.Integer,
+            primary_key=True,
+            autoincrement=not archivo
+        ),
+        sqlalchemy.Column("usuario_id", sqlalchemy.String(255), nullable=False),
+        sqlalchemy.Column("evento_id", sqlalchemy.Integer, nullable=False, index=True),
+        sqlalchemy.Column("cantidad", sqlalchemy.Integer, nullable=False),
+        sqlalchemy.Column("precio_unitario", sqlalchemy.DECIMAL(10, 2), nullable=False),
+        sqlalchemy.Column("total", sqlalchemy.DECIMAL(10, 2), nullable=False),
+        sqlalchemy.Column("estado", sqlalchemy.String(50), nullable=False, default="pendiente"),
+        sqlalchemy.Column("metodo_pago", sqlalchemy.String(50), nullable=True),
+        sqlalchemy.Column(
+            "fecha_compra",
+            sqlalchemy.DateTime(timezone=True),
+            # La clave de partición forma parte de la clave primaria
+            primary_key=not archivo,
+            nullable=False,
+            server_default=sqlalchemy.func.now()
+        ),
+        sqlalchemy.Column("fecha_pago", sqlalchemy.DateTime(timezone=True), nullable=True),
+        sqlalchemy.Column(
+            "creado_en",
+            sqlalchemy.DateTime(timezone=True),
+            server_default=sqlalchemy.func.now()
+        ),
+        sqlalchemy.Column(
+            "actualizado_en",
+            sqlalchemy.DateTime(timezone=True),
+            server_default=sqlalchemy.func.now(),
+            onupdate=sqlalchemy.func.now()
+        ),
+    ]
+
+
+# Tabla de compras, particionada por rango mensual de fecha_compra (migración
+# 4). Las particiones futuras las crea ParticionesService; las de más de
+# `particiones_meses_calientes` meses se mueven a `compras_archivo`
+compras_table = sqlalchemy.Table("compras", metadata, *_columnas_compra())
+# Índice compuesto para "mis compras": filtra por usuario y sirve el orden
+# (fecha_compra DESC, id DESC) usado en la paginación por cursor
+sqlalchemy.Index(
+    "ix_compras_usuario_fecha_id",
+    compras_table.c.usuario_id,
+    compras_table.c.fecha_compra.desc(),
+    compras_table.c.id.desc()
+)
+
+# Índice parcial para la expiración de compras pendientes: solo contiene las
+# pendientes, así que se mantiene pequeño aunque la tabla crezca
+ix_compras_pendientes = sqlalchemy.Index(
+    "ix_compras_pendientes_fecha",
+    compras_table.c.fecha_compra,
+    postgresql_where=compras_table.c.estado == "pendiente"
+)
+
+# Nivel frío: compras de particiones antiguas, ya en estado final. Una sola
+# tabla sin hueco para actualizaciones (fillfactor 100), rellenada en orden de
+# usuario, y solo con los índices que usan las lecturas
+compras_archivo_table = sqlalchemy.Table(
+    "compras_archivo",
     metadata,
-    sqlalchemy.Column("id", sqlalchemy.Integer, primary_key=True, autoincrement=True),
-    sqlalchemy.Column("usuario_id", sqlalchemy.String(255), nullable=False, index=True),
-    sqlalchemy.Column("evento_id", sqlalchemy.Integer, nullable=False, index=True),
-    sqlalchemy.Column("cantidad", sqlalchemy.Integer, nullable=False),
-    sqlalchemy.Column("precio_unitario", sqlalchemy.DECIMAL(10, 2), nullable=False),
-    sqlalchemy.Column("total", sqlalchemy.DECIMAL(10, 2), nullable=False),
-    sqlalchemy.Column(
-        "estado",
-        sqlalchemy.String(50),
-        nullable=False,
-        default="pendiente",
-        index=True
-    ),
-    sqlalchemy.Column("metodo_pago", sqlalchemy.String(50), nullable=True),
+    *_columnas_compra(archivo=True),
+    postgresql_with={"fillfactor": 100}
+)
+
+sqlalchemy.Index(
+    "ix_compras_archivo_usuario_fecha_id",
+    compras_archivo_table.c.usuario_id,
+    compras_archivo_table.c.fecha_compra.desc(),
+    compras_archivo_table.c.id.desc()
+)
+
+
+def compras_con_archivo(filtro: Callable[[Any], List[Any]]) -> sqlalchemy.Subquery:
+    """
+    Compras de los dos niveles (`compras` y `compras_archivo`) como una tabla
+
+    Args:
+        filtro: Recibe las columnas de un nivel y devuelve sus condiciones,
+            que se aplican dentro de cada rama del UNION ALL
+
+    Returns:
+        Subconsulta con las columnas de `compras`
+    """
+    return sqlalchemy.union_all(*(
+        tabla.select().where(*filtro(tabla.c))
+        for tabla in (compras_table, compras_archivo_table)
+    )).subquery("compras_todas")
+
+
+def nombre_particion(mes: date) -> str:
+    """Nombre de la partición mensual de `compras` que empieza en `mes`"""
+    return f"compras_p{mes:%Y_%m}"
+
+
+def ddl_crear_particion(mes: date, siguiente: date) -> Tuple[List[str], str]:
+    """
+    DDL de la partición [mes, siguiente) en UTC sin bloquear `compras`
+
+    CREATE TABLE ... PARTITION OF toma ACCESS EXCLUSIVE sobre `compras`; en su
+    lugar la tabla se crea suelta, con un CHECK del rango para que el ATTACH
+    no tenga que recorrerla, y se adjunta con ATTACH PARTITION, que solo toma
+    SHARE UPDATE EXCLUSIVE sobre `compras` (lecturas y escrituras siguen).
+
+    Returns:
+        (sentencias idempotentes de creación, ATTACH PARTITION)
+    """
+    nombre = nombre_particion(mes)
+    desde = f"'{mes.isoformat()} 00:00:00+00'"
+    hasta = f"'{siguiente.isoformat()} 00:00:00+00'"
+    crear = [
+        f"CREATE TABLE IF NOT EXISTS {nombre} (LIKE compras INCLUDING DEFAULTS INCLUDING CONSTRAINTS)",
+        f"ALTER TABLE {nombre} DROP CONSTRAINT IF EXISTS {nombre}_rango, "
+        f"ADD CONSTRAINT {nombre}_rango CHECK (fecha_compra >= {desde} AND fecha_compra < {hasta})",
+    ]
+    adjuntar = f"ALTER TABLE compras ATTACH PARTITION {nombre} FOR VALUES FROM ({desde}) TO ({hasta})"
+    return crear, adjuntar
+
+# Outbox transaccional: mensajes pendientes de publicar en RabbitMQ, escritos
+# en la misma transacción que el cambio de estado de la compra
+outbox_table = sqlalchemy.Table(
+    "outbox",
+    metadata,
+    sqlalchemy.Column("id", sqlalchemy.BigInteger, primary_key=True, autoincrement=True),
+    sqlalchemy.Column("tipo", sqlalchemy.String(50), nullable=False),
+    sqlalchemy.Column("payload", sqlalchemy.JSON, nullable=False),
     sqlalchemy.Column(
-        "fecha_compra",
+        "creado_en",
         sqlalchemy.DateTime(timezone=True),
         server_default=sqlalchemy.func.now()
     ),
-    sqlalchemy.Column("fecha_pago", sqlalchemy.DateTime(timezone=True), nullable=True),
+)
+
+# Inventario de asientos por evento repartido en shards: cada compra descuenta
+# de un shard distinto para que los compradores de un mismo evento no compitan
+# por una única fila. Todas las filas de un evento guardan la capacidad con la
+# que se calcularon sus asientos disponibles
+inventario_table = sqlalchemy.Table(
+    "inventario_asientos",
+    metadata,
+    sqlalchemy.Column("evento_id", sqlalchemy.Integer, primary_key=True),
+    sqlalchemy.Column("shard", sqlalchemy.SmallInteger, primary_key=True),
+    sqlalchemy.Column("disponibles", sqlalchemy.Integer, nullable=False),
+    sqlalchemy.Column("capacidad", sqlalchemy.Integer, nullable=True),
+    sqlalchemy.CheckConstraint("disponibles >= 0", name="ck_inventario_disponibles"),
+)
+
+# Claves de idempotencia (header Idempotency-Key) con la respuesta almacenada.
+# Mientras la petición original está en curso la respuesta es NULL y la clave
+# solo está reservada hasta en_curso_hasta; pasado ese plazo otra petición
+# puede reclamarla
+idempotencia_table = sqlalchemy.Table(
+    "idempotencia",
+    metadata,
+    sqlalchemy.Column("usuario_id", sqlalchemy.String(255), primary_key=True),
+    sqlalchemy.Column("operacion", sqlalchemy.String(50), primary_key=True),
+    sqlalchemy.Column("clave", sqlalchemy.String(255), primary_key=True),
+    sqlalchemy.Column("huella", sqlalchemy.String(64), nullable=False),
+    sqlalchemy.Column("respuesta", sqlalchemy.JSON, nullable=True),
     sqlalchemy.Column(
         "creado_en",
         sqlalchemy.DateTime(timezone=True),
         server_default=sqlalchemy.func.now()
     ),
+    sqlalchemy.Column("expira_en", sqlalchemy.DateTime(timezone=True), nullable=False, index=True),
+    sqlalchemy.Column("en_curso_hasta", sqlalchemy.DateTime(timezone=True), nullable=True),
+)
+
+# Agregados de ventas por evento y estado, actualizados en la misma transacción
+# que cada compra, pago o cancelación. Repartidos en shards como el inventario;
+# una fila suelta puede quedar negativa, solo la suma por evento es significativa
+ventas_eventos_table = sqlalchemy.Table(
+    "ventas_eventos",
+    metadata,
+    sqlalchemy.Column("evento_id", sqlalchemy.Integer, primary_key=True),
+    sqlalchemy.Column("estado", sqlalchemy.String(50), primary_key=True),
+    sqlalchemy.Column("shard", sqlalchemy.SmallInteger, primary_key=True),
+    sqlalchemy.Column("compras", sqlalchemy.Integer, nullable=False, default=0),
+    sqlalchemy.Column("entradas", sqlalchemy.Integer, nullable=False, default=0),
+    sqlalchemy.Column("importe", sqlalchemy.DECIMAL(14, 2), nullable=False, default=0),
+)
+
+
+def select_ventas_desde_compras(origen=None) -> sqlalchemy.Select:
+    """
+    Agregados de `ventas_eventos` recalculados desde las compras (en el shard 0)
+
+    Args:
+        origen: Tabla o subconsulta con las columnas de `compras`; por
+            defecto los dos niveles (`compras_con_archivo`)
+    """
+    if origen is None:
+        origen = compras_con_archivo(lambda c: [])
+    return sqlalchemy.select(
+        origen.c.evento_id,
+        origen.c.estado,
+        sqlalchemy.literal(0, sqlalchemy.SmallInteger).label("shard"),
+        sqlalchemy.func.count().label("compras"),
+        sqlalchemy.func.sum(origen.c.cantidad).label("entradas"),
+        sqlalchemy.func.sum(origen.c.total).label("importe")
+    ).group_by(origen.c.evento_id, origen.c.estado)
+
+
+# Versión del esquema aplicada (una fila por migración)
+schema_version_table = sqlalchemy.Table(
+    "schema_version",
+    metadata,
+    sqlalchemy.Column("version", sqlalchemy.Integer, primary_key=True),
     sqlalchemy.Column(
-        "actualizado_en",
+        "aplicado_en",
         sqlalchemy.DateTime(timezone=True),
-        server_default=sqlalchemy.func.now(),
-        onupdate=sqlalchemy.func.now()
+        server_default=sqlalchemy.func.now()
     ),
 )
 
+# Clave del advisory lock que serializa las migraciones entre workers
+LOCK_MIGRACIONES = 7_302_001
+
+
+def _crear_tablas(*tablas: sqlalchemy.Table) -> List[Any]:
+    """Sentencias DDL idempotentes para crear tablas y sus índices"""
+    sentencias = []
+    for tabla in tablas:
+        sentencias.append(CreateTable(tabla, if_not_exists=True))
+        sentencias.extend(CreateIndex(indice, if_not_exists=True) for indice in tabla.indexes)
+    return sentencias
+
+
+# Conversión de `compras` en tabla particionada por mes de fecha_compra
+# (migración 4), en dos fases alrededor de la copia de las filas
+PARTICIONAR_PREPARAR: List[Any] = [
+    "DROP TABLE IF EXISTS compras_particionada CASCADE",
+    "CREATE TABLE compras_particionada (LIKE compras INCLUDING DEFAULTS) "
+    "PARTITION BY RANGE (fecha_compra)",
+    "ALTER TABLE compras_particionada ALTER COLUMN fecha_compra SET NOT NULL, "
+    "ADD PRIMARY KEY (id, fecha_compra)",
+    # Una partición por mes desde la compra más antigua hasta el mes
+    # siguiente al actual; ParticionesService crea las posteriores
+    """
+    DO $$
+    DECLARE
+        mes timestamp := date_trunc('month', COALESCE(
+            (SELECT min(COALESCE(fecha_compra, creado_en, now())) FROM compras), now()
+        ) AT TIME ZONE 'UTC');
+        fin timestamp := date_trunc('month', now() AT TIME ZONE 'UTC') + interval '2 months';
+    BEGIN
+        WHILE mes < fin LOOP
+            EXECUTE 'CREATE TABLE ' || quote_ident('compras_p' || to_char(mes, 'YYYY_MM'))
+                || ' PARTITION OF compras_particionada FOR VALUES FROM ('
+                || quote_literal(to_char(mes, 'YYYY-MM-DD') || ' 00:00:00+00') || ') TO ('
+                || quote_literal(to_char(mes + interval '1 month', 'YYYY-MM-DD') || ' 00:00:00+00')
+                || ')';
+            mes := mes + interval '1 month';
+        END LOOP;
+    END
+    $$
+    """,
+]
+
+PARTICIONAR_SUSTITUIR: List[Any] = [
+    # La secuencia del id sobrevive a la tabla original
+    "ALTER SEQUENCE compras_id_seq OWNED BY compras_particionada.id",
+    "DROP TABLE compras",
+    "ALTER TABLE compras_particionada RENAME TO compras",
+    "ALTER TABLE compras RENAME CONSTRAINT compras_particionada_pkey TO compras_pkey",
+    # Índices particionados (uno por partición): el compuesto de usuario
+    # sustituye a los simples; el de estado no se recrea, las pendientes
+    # ya tienen su índice parcial
+] + [
+    CreateIndex(indice, if_not_exists=True) for indice in compras_table.indexes
+] + _crear_tablas(compras_archivo_table)
 
-def create_tables_sync():
-    """Crea las tablas de forma síncrona (solo al inicio)"""
-    # Crear engine síncrono temporal solo para crear tablas
-    sync_engine = sqlalchemy.create_engine(
-        DATABASE_URL.replace("postgresql://", "postgresql+psycopg2://")
+
+def particionar_copiar_lote(desde: int, hasta: int) -> Any:
+    """INSERT ... SELECT de las compras con id en (desde, hasta] a la tabla particionada"""
+    columnas = [c.name for c in compras_table.c]
+    destino = sqlalchemy.table("compras_particionada", *(sqlalchemy.column(c) for c in columnas))
+    origen = compras_table.c
+    return sqlalchemy.insert(destino).from_select(
+        columnas,
+        sqlalchemy.select(*(
+            sqlalchemy.func.coalesce(origen.fecha_compra, origen.creado_en, sqlalchemy.func.now())
+            if c == "fecha_compra" else origen[c]
+            for c in columnas
+        )).where(origen.id > desde, origen.id <= hasta)
     )
-    
+
+
+# Migraciones en orden: (versión, sentencias)
+MIGRACIONES: List[Tuple[int, List[Any]]] = [
+    (1, _crear_tablas(
+        compras_table,
+        outbox_table,
+        inventario_table,
+        idempotencia_table
+    ) + [
+        # El índice simple de usuario_id queda cubierto por el compuesto
+        "DROP INDEX IF EXISTS ix_compras_usuario_id",
+    ]),
+    (2, _crear_tablas(ventas_eventos_table) + [
+        # Carga inicial desde las compras existentes (la reconciliación
+        # nocturna corrige lo que cambie durante el despliegue)
+        sqlalchemy.insert(ventas_eventos_table).from_select(
+            [c.name for c in ventas_eventos_table.c],
+            select_ventas_desde_compras(compras_table)
+        ),
+    ]),
+    (3, [
+        CreateIndex(ix_compras_pendientes, if_not_exists=True),
+    ]),
+    # compras pasa a estar particionada. Al arrancar solo se aplica si la
+    # tabla está vacía; con compras, la copia se hace por lotes y con el
+    # servicio parado con `python -m app.particionar`, nunca en el arranque
+    (4, [
+        """
+        DO $$
+        BEGIN
+            IF EXISTS (SELECT 1 FROM compras) THEN
+                RAISE EXCEPTION 'La migración 4 copia la tabla compras: ejecutar '
+                    '"python -m app.particionar" con el servicio parado';
+            END IF;
+        END
+        $$
+        """,
+    ] + PARTICIONAR_PREPARAR + PARTICIONAR_SUSTITUIR),
+    (5, [
+        # Lease de las reservas de idempotencia en curso; las que ya había
+        # reciben uno nuevo en lugar de quedar bloqueadas hasta expira_en
+        "ALTER TABLE idempotencia ADD COLUMN IF NOT EXISTS en_curso_hasta TIMESTAMPTZ",
+        "UPDATE idempotencia SET en_curso_hasta = now() + interval "
+        f"'{int(settings.idempotencia_reserva)} seconds' WHERE respuesta IS NULL",
+    ]),
+    (6, [
+        # Capacidad registrada por evento; NULL en los eventos ya inicializados
+        # hasta que se vuelva a comprobar contra Eventos
+        "ALTER TABLE inventario_asientos ADD COLUMN IF NOT EXISTS capacidad INTEGER",
+    ]),
+]
+
+VERSION_ESQUEMA = MIGRACIONES[-1][0]
+
+# Tiempos del último arranque (segundos)
+tiempos_arranque: Dict[str, float] = {}
+
+
+async def _version_actual() -> int:
+    """Versión del esquema aplicada (0 si aún no hay tabla de versiones)"""
     try:
-        metadata.create_all(sync_engine)
-        print("Tablas creadas/verificadas en PostgreSQL")
-    except Exception as e:
-        print(f"Error al crear tablas: {e}")
-    finally:
-        sync_engine.dispose()
+        return await database.fetch_val(
+            sqlalchemy.select(sqlalchemy.func.coalesce(
+                sqlalchemy.func.max(schema_version_table.c.version), 0
+            ))
+        )
+    except asyncpg.exceptions.UndefinedTableError:
+        return 0
+
+
+async def migrar_esquema(hasta: int = VERSION_ESQUEMA) -> int:
+    """
+    Aplica las migraciones pendientes
+
+    En el caso habitual solo se consulta la versión. Si hay migraciones
+    pendientes, un advisory lock garantiza que un único worker las aplica;
+    el resto espera al lock y vuelve a comprobar la versión.
+
+    Args:
+        hasta: Última versión a aplicar
+
+    Returns:
+        Número de migraciones aplicadas por este proceso
+    """
+    if await _version_actual() >= hasta:
+        return 0
+
+    aplicadas = 0
+    async with database.transaction():
+        await database.execute(
+            sqlalchemy.select(sqlalchemy.func.pg_advisory_xact_lock(LOCK_MIGRACIONES))
+        )
+        for sentencia in _crear_tablas(schema_version_table):
+            await database.execute(sentencia)
+
+        version = await _version_actual()
+        for numero, sentencias in MIGRACIONES:
+            if numero <= version or numero > hasta:
+                continue
+            for sentencia in sentencias:
+                await database.execute(sentencia)
+            await database.execute(schema_version_table.insert().values(version=numero))
+            logger.info(f"Migración de esquema {numero} aplicada")
+            aplicadas += 1
+
+    return aplicadas
 
 
 async def connect_db():
-    """Conecta a la base de datos"""
+    """Conecta a la base de datos y verifica el esquema"""
+    inicio = time.perf_counter()
     await database.connect()
+    conectado = time.perf_counter()
     
-    # Crear tablas de forma síncrona antes de continuar
-    create_tables_sync()
+    aplicadas = await migrar_esquema()
+    await db_router.conectar()
+    fin = time.perf_counter()
     
-    print("Conectado a PostgreSQL")
+    tiempos_arranque.update({
+        "conexion": round(conectado - inicio, 4),
+        "esquema_y_replicas": round(fin - conectado, 4),
+        "total": round(fin - inicio, 4)
+    })
+    logger.info(
+        f"Conectado a PostgreSQL (esquema v{VERSION_ESQUEMA}, "
+        f"{aplicadas} migraciones aplicadas, {tiempos_arranque['total']}s)"
+    )
 
 
 async def disconnect_db():
     """Desconecta de la base de datos"""
+    await db_router.desconectar()
     await database.disconnect()
-    print("Desconectado de PostgreSQL")
\ No newline at end of file
+    logger.info("Desconectado de PostgreSQL")
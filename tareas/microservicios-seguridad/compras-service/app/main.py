@@ -1,15 +1,28 @@
 """
 Aplicación FastAPI - Servicio de Compras
 """
-from fastapi import FastAPI, Request
+from fastapi import Depends, FastAPI, Query, Request
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import JSONResponse
 from contextlib import asynccontextmanager
 from app.config import settings
-from app.database import connect_db, disconnect_db
+from app.database import connect_db, database, db_router, disconnect_db, tiempos_arranque
 from app.routes import compras
+from app.services.estadisticas_service import estadisticas_service
+from app.services.eventos_client import eventos_client
+from app.services.expiracion_service import expiracion_service
+from app.services.notificaciones_estado import notificaciones_estado
+from app.services.particiones_service import particiones_service
+from app.services.idempotencia_service import idempotencia_service
+from app.services.inventario_service import inventario_service
+from app.services.outbox_relay import outbox_relay
 from app.services.rabbitmq_client import rabbitmq_client 
-from app.utils.logger import logger
+from app.services.usuarios_client import usuarios_client
+from app.utils.circuit_breaker import DatosObsoletosMiddleware
+from app.utils.db_router import CABECERA_LSN, ReadYourWritesMiddleware
+from app.utils.jwt_utils import require_admin, tokens_cache
+from app.utils.logger import detener_logging, logger, metricas_logging
+from app.utils.query_stats import PoolAgotadoError
 
 
 @asynccontextmanager
@@ -18,12 +31,29 @@ async def lifespan(app: FastAPI):
     # Startup
     logger.info(f"Iniciando {settings.app_name} v{settings.app_version}")
     await connect_db()
+    await eventos_client.iniciar()  # Pool HTTP compartido con Eventos
+    await usuarios_client.iniciar()  # Pool HTTP compartido con Usuarios
     await rabbitmq_client.conectar()  #  Conectar a RabbitMQ
+    await outbox_relay.iniciar()  # Publicación de notificaciones pendientes
+    await idempotencia_service.iniciar()  # Purga de claves expiradas
+    await estadisticas_service.iniciar()  # Reconciliación nocturna de ventas
+    await expiracion_service.iniciar()  # Expiración de compras pendientes
+    await particiones_service.iniciar()  # Particiones futuras y archivo
+    await notificaciones_estado.iniciar()  # LISTEN de cambios de estado (SSE)
     yield
     # Shutdown
+    await notificaciones_estado.detener()
+    await particiones_service.detener()
+    await expiracion_service.detener()
+    await estadisticas_service.detener()
+    await idempotencia_service.detener()
+    await outbox_relay.detener()
+    await usuarios_client.cerrar()
+    await eventos_client.cerrar()
     await rabbitmq_client.cerrar()  #  Cerrar conexión
     await disconnect_db()
     logger.info("Cerrando servicio de compras")
+    detener_logging()
 
 
 # Crear aplicación
@@ -41,8 +71,16 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Datos-Obsoletos", CABECERA_LSN],
 )
 
+# Read-your-writes entre workers (posición del WAL en cookie/header)
+app.add_middleware(ReadYourWritesMiddleware, router=db_router)
+
+# X-Datos-Obsoletos si la respuesta usa datos de respaldo
+app.add_middleware(DatosObsoletosMiddleware)
+
+
 # Registrar rutas
 app.include_router(compras.router)
 
@@ -59,11 +97,71 @@ async def root():
             "GET /api/compras/eventos - Listar eventos disponibles",
             "POST /api/compras/ - Crear compra",
             "GET /api/compras/mis-compras - Ver mis compras",
-            "POST /api/compras/{id}/pagar - Confirmar pago"
+            "POST /api/compras/{id}/pagar - Confirmar pago",
+            "GET /api/compras/{id}/eventos-estado - Cambios de estado (SSE)",
+            "GET /api/compras/estadisticas/eventos/{id} - Ventas de un evento (admin)",
+            "GET /metrics - Métricas internas del servicio (admin)",
+            "GET /debug/queries - Consultas más costosas (admin)"
         ]
     }
 
 
+@app.get("/metrics", tags=["Health"], dependencies=[Depends(require_admin)])
+async def metrics():
+    """
+    Métricas internas de los clientes y pools del servicio
+
+    **Requiere rol admin**
+    """
+    return {
+        "arranque": tiempos_arranque,
+        "pool": database.metricas_pool(),
+        "replicas": db_router.metricas(),
+        "eventos": eventos_client.metricas(),
+        "usuarios": usuarios_client.metricas(),
+        "outbox": await outbox_relay.metricas(),
+        "rabbitmq": rabbitmq_client.metricas(),
+        "jwt_cache": tokens_cache.metricas(),
+        "inventario": inventario_service.metricas(),
+        "idempotencia": idempotencia_service.metricas(),
+        "estadisticas": estadisticas_service.metricas(),
+        "expiracion": expiracion_service.metricas(),
+        "particiones": particiones_service.metricas(),
+        "sse": notificaciones_estado.metricas(),
+        "logging": metricas_logging()
+    }
+
+
+@app.get("/debug/queries", tags=["Health"], dependencies=[Depends(require_admin)])
+async def debug_queries(
+    top: int = Query(20, ge=1, le=500),
+    orden: str = Query("total_ms", pattern="^(total_ms|llamadas|media_ms|p99_ms|max_ms|errores)$")
+):
+    """
+    Consultas a PostgreSQL agrupadas por huella, ordenadas por coste
+
+    **Requiere rol admin**
+    """
+    return {
+        "umbral_lento_ms": database.umbral_lento_ms,
+        "consultas": database.top(top, orden)
+    }
+
+
+@app.exception_handler(PoolAgotadoError)
+async def pool_agotado_handler(request: Request, exc: PoolAgotadoError):
+    """Pool de PostgreSQL saturado: el cliente puede reintentar"""
+    logger.warning(f"Pool de conexiones agotado: {str(exc)}")
+    return JSONResponse(
+        status_code=503,
+        headers={"Retry-After": "1"},
+        content={
+            "detail": "Servicio saturado, inténtelo de nuevo",
+            "type": "pool_exhausted"
+        }
+    )
+
+
 @app.exception_handler(Exception)
 async def global_exception_handler(request: Request, exc: Exception):
     """Manejador global de excepciones"""
@@ -3,7 +3,7 @@ Modelos de dominio para Compra
 """
 from datetime import datetime
 from decimal import Decimal
-from typing import Optional
+from typing import Any, Mapping, Optional
 from pydantic import BaseModel, Field, field_validator
 
 
@@ -38,6 +38,19 @@ class CompraResponse(BaseModel):
     
     class Config:
         from_attributes = True
+    
+    @classmethod
+    def desde_fila(cls, fila: Mapping[str, Any], **extra: Any):
+        """
+        Construye el modelo desde una fila de `compras` sin validar
+        
+        Solo para filas de la propia BD: los tipos ya son los del modelo
+        (Decimal, datetime con zona), así que la validación no cambia nada.
+        """
+        return cls.model_construct(
+            **{campo: fila[campo] for campo in CompraResponse.model_fields},
+            **extra
+        )
 
 
 class CompraDetallada(CompraResponse):
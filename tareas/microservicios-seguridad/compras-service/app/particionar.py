@@ -0,0 +1,93 @@
+"""
+Migración 4 fuera del arranque: convierte `compras` en tabla particionada
+
+    python -m app.particionar --lote 10000
+
+Ejecutar con el servicio parado (nadie escribe en `compras` durante la
+copia). Aplica antes las migraciones anteriores que falten, crea la tabla
+particionada, copia las compras por lotes de ids (cada lote en su propia
+transacción, así que no hay una transacción enorme ni un lock mantenido
+durante toda la copia) y al final sustituye la tabla y registra la versión
+4 en una transacción corta. Si se interrumpe, basta con volver a lanzarlo.
+Las migraciones posteriores las aplica el servicio al arrancar.
+"""
+import argparse
+import asyncio
+import time
+import sqlalchemy
+from app.database import (
+    LOCK_MIGRACIONES,
+    PARTICIONAR_PREPARAR,
+    PARTICIONAR_SUSTITUIR,
+    _version_actual,
+    compras_table,
+    database,
+    migrar_esquema,
+    particionar_copiar_lote,
+    schema_version_table
+)
+from app.utils.logger import detener_logging, logger
+
+VERSION = 4
+
+
+async def particionar(lote: int) -> bool:
+    """
+    Convierte `compras` en tabla particionada
+
+    Returns:
+        True si se aplicó, False si la versión 4 ya estaba aplicada
+    """
+    await migrar_esquema(hasta=VERSION - 1)
+
+    # Lock de sesión: un servicio que arranque espera a que termine
+    async with database.connection():
+        await database.execute(sqlalchemy.select(sqlalchemy.func.pg_advisory_lock(LOCK_MIGRACIONES)))
+        try:
+            if await _version_actual() >= VERSION:
+                logger.info("La migración 4 ya está aplicada")
+                return False
+
+            async with database.transaction():
+                for sentencia in PARTICIONAR_PREPARAR:
+                    await database.execute(sentencia)
+
+            maximo = await database.fetch_val(
+                sqlalchemy.select(sqlalchemy.func.coalesce(sqlalchemy.func.max(compras_table.c.id), 0))
+            )
+            inicio = time.perf_counter()
+            for desde in range(0, maximo, lote):
+                await database.execute(particionar_copiar_lote(desde, desde + lote))
+                logger.info(
+                    f"Compras copiadas hasta el id {min(desde + lote, maximo)} de {maximo} "
+                    f"({time.perf_counter() - inicio:.1f}s)"
+                )
+
+            async with database.transaction():
+                for sentencia in PARTICIONAR_SUSTITUIR:
+                    await database.execute(sentencia)
+                await database.execute(schema_version_table.insert().values(version=VERSION))
+        finally:
+            await database.execute(
+                sqlalchemy.select(sqlalchemy.func.pg_advisory_unlock(LOCK_MIGRACIONES))
+            )
+
+    logger.info("Migración 4 aplicada: compras particionada por mes")
+    return True
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--lote", type=int, default=10_000, help="Compras por transacción")
+    args = parser.parse_args()
+
+    await database.connect()
+    try:
+        await particionar(args.lote)
+    finally:
+        await database.disconnect()
+        detener_logging()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -1,29 +1,35 @@
 """
 Endpoints del servicio de Compras
 """
-from fastapi import APIRouter, Depends, HTTPException
-from typing import List
+from datetime import datetime
+from fastapi import APIRouter, Depends, Header, HTTPException, Query, Request
+from fastapi.responses import StreamingResponse
+from typing import List, Optional
+from app.config import settings
 from app.models.compra import CompraCreate, CompraPago, CompraResponse, CompraDetallada
-from app.schemas.compra_schema import MessageResponse, CompraListResponse
+from app.schemas.compra_schema import MessageResponse, CompraListResponse, EstadisticasEventoResponse
 from app.services.compras_service import compras_service
+from app.services.estadisticas_service import estadisticas_service
 from app.services.eventos_client import eventos_client
-from app.utils.jwt_utils import get_current_user
+from app.services.idempotencia_service import idempotencia_service
+from app.utils.jwt_utils import get_current_user, require_admin
+from app.utils.respuestas import ModeloJSONResponse
 
 router = APIRouter(prefix="/api/compras", tags=["Compras"])
 
 
 @router.get("/eventos", summary="Listar eventos disponibles")
-async def listar_eventos(current_user: dict = Depends(get_current_user)):
+async def listar_eventos(request: Request, current_user: dict = Depends(get_current_user)):
     """
     Lista todos los eventos disponibles para comprar entradas
     
+    La respuesta lleva ETag (If-None-Match devuelve 304) y se comprime con
+    gzip o zstd según Accept-Encoding.
+    
     **Requiere autenticación** (token JWT válido)
     """
-    eventos = await eventos_client.listar_eventos()
-    return {
-        "total": len(eventos),
-        "eventos": eventos
-    }
+    catalogo = await eventos_client.obtener_catalogo()
+    return catalogo.representacion.responder(request, max_age=int(settings.eventos_lista_ttl))
 
 
 @router.post(
@@ -34,7 +40,8 @@ async def listar_eventos(current_user: dict = Depends(get_current_user)):
 )
 async def crear_compra(
     compra_data: CompraCreate,
-    current_user: dict = Depends(get_current_user)
+    current_user: dict = Depends(get_current_user),
+    idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key", max_length=255)
 ):
     """
     Crea una nueva compra de entradas para un evento
@@ -44,12 +51,17 @@ async def crear_compra(
     - **evento_id**: ID del evento (debe existir)
     - **cantidad**: Número de entradas (1-100)
     
-    La compra se crea en estado "pendiente"
+    La compra se crea en estado "pendiente". Con el header `Idempotency-Key`
+    los reintentos devuelven la compra ya creada en lugar de crear otra.
     """
-    return await compras_service.crear_compra(
-        compra_data,
-        current_user["id"]
+    compra = await idempotencia_service.ejecutar(
+        idempotency_key,
+        current_user["id"],
+        "crear_compra",
+        idempotencia_service.huella(compra_data.model_dump()),
+        lambda: compras_service.crear_compra(compra_data, current_user["id"])
     )
+    return ModeloJSONResponse(compra, status_code=201)
 
 
 @router.get(
@@ -57,19 +69,72 @@ async def crear_compra(
     response_model=CompraListResponse,
     summary="Mis compras"
 )
-async def mis_compras(current_user: dict = Depends(get_current_user)):
+async def mis_compras(
+    request: Request,
+    limit: int = Query(50, ge=1, le=200, description="Compras por página"),
+    cursor: Optional[str] = Query(None, description="Cursor de la página siguiente"),
+    estado: Optional[str] = Query(None, description="Filtrar por estado"),
+    desde: Optional[datetime] = Query(None, description="Fecha de compra mínima"),
+    hasta: Optional[datetime] = Query(None, description="Fecha de compra máxima"),
+    incluir_total: bool = Query(True, description="Contar todas las compras que cumplen los filtros"),
+    current_user: dict = Depends(get_current_user)
+):
     """
-    Lista todas las compras del usuario autenticado
+    Lista las compras del usuario autenticado, de la más reciente a la más antigua
     
     **Requiere autenticación**
     
-    Incluye detalles del evento asociado a cada compra
+    Incluye detalles del evento asociado a cada compra. Se pagina con
+    `limit` y `cursor` (usar `siguiente_cursor` de la respuesta anterior).
+    `cantidad` es el número de compras de la página y `total` el de todas
+    las compras del usuario con esos filtros. Contarlas recorre todas sus
+    compras: con `incluir_total=false` no se calcula y `total` es null.
+    
+    Con `Accept: application/x-ndjson` se emite una compra por línea a medida
+    que se leen de la base de datos (sin `limit`).
     """
-    compras = await compras_service.listar_compras_usuario(current_user["id"])
-    return {
-        "total": len(compras),
-        "compras": compras
-    }
+    if "application/x-ndjson" in request.headers.get("accept", ""):
+        compras_stream = compras_service.iterar_compras_usuario(
+            current_user["id"], cursor, estado, desde, hasta
+        )
+        
+        async def ndjson():
+            async for compra in compras_stream:
+                yield compra.model_dump_json() + "\n"
+        
+        return StreamingResponse(ndjson(), media_type="application/x-ndjson")
+    
+    compras, siguiente_cursor = await compras_service.listar_compras_usuario(
+        current_user["id"], limit, cursor, estado, desde, hasta
+    )
+    total = None
+    if incluir_total:
+        total = await compras_service.contar_compras_usuario(
+            current_user["id"], estado, desde, hasta
+        )
+    return ModeloJSONResponse(CompraListResponse.model_construct(
+        cantidad=len(compras),
+        total=total,
+        compras=compras,
+        siguiente_cursor=siguiente_cursor
+    ))
+
+
+@router.get(
+    "/estadisticas/eventos/{evento_id}",
+    response_model=EstadisticasEventoResponse,
+    summary="Ventas de un evento"
+)
+async def estadisticas_evento(
+    evento_id: int,
+    current_user: dict = Depends(require_admin)
+):
+    """
+    Entradas vendidas y recaudación de un evento, por estado de la compra
+    
+    **Requiere rol admin**
+    """
+    return await estadisticas_service.obtener(evento_id)
 
 
 @router.get(
@@ -86,7 +151,7 @@ async def obtener_compra(
     
     **Requiere autenticación**
     """
-    compra = await compras_service.get_compra_by_id(compra_id)
+    compra = await compras_service.get_compra_by_id(compra_id, current_user["id"])
     
     # Validar propiedad
     if compra.usuario_id != current_user["id"]:
@@ -95,7 +160,34 @@ async def obtener_compra(
             detail="No tienes permiso para ver esta compra"
         )
     
-    return compra
+    return ModeloJSONResponse(compra)
+
+
+@router.get(
+    "/{compra_id}/eventos-estado",
+    summary="Seguir el estado de una compra (SSE)",
+    response_class=StreamingResponse
+)
+async def eventos_estado_compra(
+    compra_id: int,
+    current_user: dict = Depends(get_current_user)
+):
+    """
+    Emite como Server-Sent Events el estado de la compra y su cambio
+    
+    **Requiere autenticación**
+    
+    Sustituye al sondeo de `GET /api/compras/{id}`: el primer evento `estado`
+    lleva el estado actual y el stream termina tras el cambio a pagado,
+    cancelado o expirado. Mientras espera se envía un comentario de latido;
+    pasados `sse_duracion_maxima` segundos se cierra y el cliente reconecta.
+    """
+    eventos = await compras_service.seguir_estado(compra_id, current_user["id"])
+    return StreamingResponse(
+        eventos,
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
 
 
 @router.post(
@@ -106,7 +198,8 @@ async def obtener_compra(
 async def pagar_compra(
     compra_id: int,
     pago_data: CompraPago,
-    current_user: dict = Depends(get_current_user)
+    current_user: dict = Depends(get_current_user),
+    idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key", max_length=255)
 ):
     """
     Confirma el pago de una compra pendiente
@@ -115,13 +208,17 @@ async def pagar_compra(
     
     - **metodo_pago**: Método de pago usado (tarjeta, efectivo, transferencia, etc.)
     
-    La compra cambia de estado "pendiente" a "pagado"
+    La compra cambia de estado "pendiente" a "pagado". Con el header
+    `Idempotency-Key` los reintentos devuelven el pago ya confirmado.
     """
-    return await compras_service.confirmar_pago(
-        compra_id,
-        pago_data,
-        current_user["id"]
+    compra = await idempotencia_service.ejecutar(
+        idempotency_key,
+        current_user["id"],
+        "pagar_compra",
+        idempotencia_service.huella(compra_id, pago_data.model_dump()),
+        lambda: compras_service.confirmar_pago(compra_id, pago_data, current_user["id"])
     )
+    return ModeloJSONResponse(compra)
 
 
 @router.delete(
@@ -1,7 +1,8 @@
 """
 Schemas para respuestas HTTP
 """
-from typing import List, Optional
+from decimal import Decimal
+from typing import Dict, List, Optional
 from pydantic import BaseModel
 from app.models.compra import CompraResponse, CompraDetallada
 
@@ -13,9 +14,26 @@ class MessageResponse(BaseModel):
 
 
 class CompraListResponse(BaseModel):
-    """Lista de compras"""
-    total: int
+    """Página de compras (total es null si se pidió no contarlas)"""
+    cantidad: int
+    total: Optional[int] = None
     compras: List[CompraDetallada]
+    siguiente_cursor: Optional[str] = None
+
+
+class VentasEstado(BaseModel):
+    """Ventas de un evento en un estado"""
+    compras: int
+    entradas: int
+    importe: Decimal
+
+
+class EstadisticasEventoResponse(BaseModel):
+    """Ventas de un evento (vendidas y recaudado: solo compras pagadas)"""
+    evento_id: int
+    por_estado: Dict[str, VentasEstado]
+    entradas_vendidas: int
+    recaudado: Decimal
 
 
 class ErrorResponse(BaseModel):
@@ -1,16 +1,54 @@
 """
 Lógica de negocio para el servicio de Compras
 """
+import base64
+import time
 from decimal import Decimal
 from datetime import datetime
-from typing import List, Optional
+from typing import AsyncIterator, List, Optional, Tuple
+import orjson
+import sqlalchemy
 from fastapi import HTTPException
-from app.database import database, compras_table
+from app.database import (
+    compras_archivo_table,
+    compras_con_archivo,
+    compras_table,
+    database,
+    db_router,
+    outbox_table
+)
+from app.config import settings
 from app.models.compra import CompraCreate, CompraPago, CompraResponse, CompraDetallada
+from app.services.estadisticas_service import estadisticas_service
 from app.services.eventos_client import eventos_client
-from app.services.rabbitmq_client import rabbitmq_client 
+from app.services.inventario_service import inventario_service
+from app.services.notificaciones_estado import Suscripcion, notificaciones_estado
 from app.utils.logger import logger
 
+# Filas que se enriquecen juntas al emitir compras en streaming
+TAMANO_BLOQUE_STREAM = 50
+
+
+def _codificar_cursor(fecha_compra: datetime, compra_id: int) -> str:
+    """Cursor opaco a partir de la última fila (fecha_compra, id)"""
+    valor = f"{fecha_compra.isoformat()}|{compra_id}"
+    return base64.urlsafe_b64encode(valor.encode()).decode()
+
+
+def _decodificar_cursor(cursor: str) -> Tuple[datetime, int]:
+    """Obtiene (fecha_compra, id) de un cursor"""
+    try:
+        fecha, compra_id = base64.urlsafe_b64decode(cursor.encode()).decode().split("|")
+        return datetime.fromisoformat(fecha), int(compra_id)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Cursor de paginación inválido")
+
+
+def _evento_sse(compra_id: int, estado: str) -> str:
+    """Evento SSE "estado" con el estado de una compra"""
+    datos = orjson.dumps({"id": compra_id, "estado": estado}).decode()
+    return f"event: estado\ndata: {datos}\n\n"
+
 
 class ComprasService:
     """Servicio de gestión de compras"""
@@ -39,7 +77,7 @@ class ComprasService:
                 detail=f"Evento con ID {compra_data.evento_id} no encontrado"
             )
         
-        # 2. Validar disponibilidad (simulado, en producción sería más complejo)
+        # 2. Validar contra la capacidad total antes de tocar el inventario
         if compra_data.cantidad > evento.get("capacidad", 0):
             raise HTTPException(
                 status_code=400,
@@ -50,7 +88,8 @@ class ComprasService:
         precio_unitario = Decimal(str(evento["precio"]))
         total = precio_unitario * Decimal(str(compra_data.cantidad))
         
-        # 4. Guardar en base de datos
+        # 4. Reservar asientos y guardar la compra en la misma transacción
+        #    (RETURNING evita releer la fila)
         query = compras_table.insert().values(
             usuario_id=usuario_id,
             evento_id=compra_data.evento_id,
@@ -58,21 +97,42 @@ class ComprasService:
             precio_unitario=precio_unitario,
             total=total,
             estado="pendiente"
-        )
+        ).returning(*compras_table.c)
         
-        compra_id = await database.execute(query)
+        async with database.transaction():
+            await inventario_service.inicializar_evento(
+                compra_data.evento_id,
+                evento["capacidad"]
+            )
+            await inventario_service.reservar(compra_data.evento_id, compra_data.cantidad)
+            compra = await database.fetch_one(query)
+            await estadisticas_service.registrar_compra(
+                compra_data.evento_id,
+                compra_data.cantidad,
+                total
+            )
+        db_router.marcar_escritura(usuario_id)
         
-        logger.info(f"Compra {compra_id} creada por usuario {usuario_id}")
+        logger.info(f"Compra {compra['id']} creada por usuario {usuario_id}")
         
         # 5. Retornar compra creada
-        return await self.get_compra_by_id(compra_id)
+        return CompraResponse.desde_fila(compra)
     
-    async def get_compra_by_id(self, compra_id: int) -> CompraResponse:
+    async def get_compra_by_id(
+        self,
+        compra_id: int,
+        usuario_id: Optional[str] = None
+    ) -> CompraResponse:
         """
         Obtiene una compra por ID
         
+        Busca a la vez en las particiones de `compras` y en el archivo de
+        compras antiguas (una consulta; si la réplica no la encuentra, se
+        repite una vez en el primario).
+        
         Args:
             compra_id: ID de la compra
+            usuario_id: Usuario que consulta (para leer sus propias escrituras)
             
         Returns:
             CompraResponse
@@ -80,8 +140,12 @@ class ComprasService:
         Raises:
             HTTPException 404 si no existe
         """
-        query = compras_table.select().where(compras_table.c.id == compra_id)
-        compra = await database.fetch_one(query)
+        compras = compras_con_archivo(lambda c: [c.id == compra_id])
+        compra = await db_router.fetch_one(
+            sqlalchemy.select(compras).limit(1),
+            usuario_id,
+            primario_si_vacio=True
+        )
         
         if not compra:
             raise HTTPException(
@@ -89,33 +153,159 @@ class ComprasService:
                 detail=f"Compra con ID {compra_id} no encontrada"
             )
         
-        return CompraResponse(**dict(compra))
+        return CompraResponse.desde_fila(compra)
     
-    async def listar_compras_usuario(self, usuario_id: str) -> List[CompraDetallada]:
+    async def listar_compras_usuario(
+        self,
+        usuario_id: str,
+        limit: int = 50,
+        cursor: Optional[str] = None,
+        estado: Optional[str] = None,
+        desde: Optional[datetime] = None,
+        hasta: Optional[datetime] = None
+    ) -> Tuple[List[CompraDetallada], Optional[str]]:
         """
-        Lista todas las compras de un usuario con detalles del evento
+        Lista una página de compras de un usuario con detalles del evento
         
         Args:
             usuario_id: ID del usuario
+            limit: Máximo de compras por página
+            cursor: Cursor devuelto por la página anterior
+            estado: Filtra por estado de la compra
+            desde: Fecha de compra mínima (inclusive)
+            hasta: Fecha de compra máxima (inclusive)
             
         Returns:
-            Lista de CompraDetallada
+            (lista de CompraDetallada, cursor de la página siguiente o None)
+            
+        Raises:
+            HTTPException 400 si el cursor es inválido
         """
-        query = compras_table.select().where(
-            compras_table.c.usuario_id == usuario_id
-        ).order_by(compras_table.c.fecha_compra.desc())
+        query = self._query_compras_usuario(
+            usuario_id, cursor, estado, desde, hasta
+        ).limit(limit + 1)
         
-        compras = await database.fetch_all(query)
+        compras = await db_router.fetch_all(query, usuario_id)
         
-        # Enriquecer con datos del evento
-        compras_detalladas = []
-        for compra in compras:
-            compra_dict = dict(compra)
-            evento = await eventos_client.get_evento(compra_dict["evento_id"])
-            compra_dict["evento"] = evento
-            compras_detalladas.append(CompraDetallada(**compra_dict))
+        siguiente_cursor = None
+        if len(compras) > limit:
+            compras = compras[:limit]
+            ultima = compras[-1]
+            siguiente_cursor = _codificar_cursor(ultima["fecha_compra"], ultima["id"])
         
-        return compras_detalladas
+        return await self._enriquecer(compras), siguiente_cursor
+    
+    def iterar_compras_usuario(
+        self,
+        usuario_id: str,
+        cursor: Optional[str] = None,
+        estado: Optional[str] = None,
+        desde: Optional[datetime] = None,
+        hasta: Optional[datetime] = None
+    ) -> AsyncIterator[CompraDetallada]:
+        """
+        Recorre las compras de un usuario a medida que salen del cursor de la BD
+        
+        Las filas se enriquecen en bloques para no consultar Eventos fila a fila
+        ni cargar todo el historial en memoria.
+        
+        Raises:
+            HTTPException 400 si el cursor es inválido (antes de iterar)
+        """
+        query = self._query_compras_usuario(usuario_id, cursor, estado, desde, hasta)
+        return self._iterar_enriquecidas(query, usuario_id)
+    
+    async def _iterar_enriquecidas(self, query, usuario_id: str) -> AsyncIterator[CompraDetallada]:
+        """Emite las filas de la consulta enriquecidas por bloques"""
+        bloque = []
+        async for compra in db_router.iterate(query, usuario_id):
+            bloque.append(compra)
+            if len(bloque) >= TAMANO_BLOQUE_STREAM:
+                for compra_detallada in await self._enriquecer(bloque):
+                    yield compra_detallada
+                bloque = []
+        
+        for compra_detallada in await self._enriquecer(bloque):
+            yield compra_detallada
+    
+    def _query_compras_usuario(
+        self,
+        usuario_id: str,
+        cursor: Optional[str],
+        estado: Optional[str],
+        desde: Optional[datetime],
+        hasta: Optional[datetime]
+    ):
+        """
+        Consulta ordenada por (fecha_compra, id) DESC con filtros y cursor
+        
+        Recorre las compras recientes y las archivadas; cada nivel sirve el
+        orden con su índice (usuario_id, fecha_compra DESC, id DESC).
+        """
+        posicion = _decodificar_cursor(cursor) if cursor else None
+        
+        compras = compras_con_archivo(
+            self._filtro_compras_usuario(usuario_id, estado, desde, hasta, posicion)
+        )
+        return sqlalchemy.select(compras).order_by(
+            compras.c.fecha_compra.desc(),
+            compras.c.id.desc()
+        )
+    
+    @staticmethod
+    def _filtro_compras_usuario(
+        usuario_id: str,
+        estado: Optional[str],
+        desde: Optional[datetime],
+        hasta: Optional[datetime],
+        posicion=None
+    ):
+        """Condiciones de las compras de un usuario para `compras_con_archivo`"""
+        def filtro(c):
+            condiciones = [c.usuario_id == usuario_id]
+            if estado:
+                condiciones.append(c.estado == estado)
+            if desde:
+                condiciones.append(c.fecha_compra >= desde)
+            if hasta:
+                condiciones.append(c.fecha_compra <= hasta)
+            if posicion:
+                condiciones.append(sqlalchemy.tuple_(c.fecha_compra, c.id) < posicion)
+            return condiciones
+        return filtro
+    
+    async def contar_compras_usuario(
+        self,
+        usuario_id: str,
+        estado: Optional[str] = None,
+        desde: Optional[datetime] = None,
+        hasta: Optional[datetime] = None
+    ) -> int:
+        """
+        Número de compras de un usuario con los filtros del listado
+        
+        Recorre todas las compras del usuario (recientes y archivadas): solo
+        se usa cuando el cliente pide el total.
+        """
+        compras = compras_con_archivo(
+            self._filtro_compras_usuario(usuario_id, estado, desde, hasta)
+        )
+        fila = await db_router.fetch_one(
+            sqlalchemy.select(sqlalchemy.func.count().label("total")).select_from(compras),
+            usuario_id
+        )
+        return fila["total"]
+    
+    async def _enriquecer(self, compras) -> List[CompraDetallada]:
+        """Añade los datos del evento (una consulta por evento distinto)"""
+        eventos = await eventos_client.get_eventos(
+            compra["evento_id"] for compra in compras
+        )
+        
+        return [
+            CompraDetallada.desde_fila(compra, evento=eventos.get(compra["evento_id"]))
+            for compra in compras
+        ]
     
     async def confirmar_pago(
         self,
@@ -139,45 +329,23 @@ class ComprasService:
             HTTPException 403 si no es propietario
             HTTPException 400 si ya está pagada
         """
-        # 1. Obtener compra
-        compra = await self.get_compra_by_id(compra_id)
-        
-        # 2. Validar propiedad
-        if compra.usuario_id != usuario_id:
-            raise HTTPException(
-                status_code=403,
-                detail="No tienes permiso para pagar esta compra"
-            )
-        
-        # 3. Validar estado
-        if compra.estado == "pagado":
-            raise HTTPException(
-                status_code=400,
-                detail="Esta compra ya ha sido pagada"
-            )
-        
-        if compra.estado == "cancelado":
-            raise HTTPException(
-                status_code=400,
-                detail="No se puede pagar una compra cancelada"
-            )
-        
-        # 4. Actualizar estado
+        # 1. Actualizar estado y registrar la notificación en la misma
+        #    transacción; el relay del outbox la publica en RabbitMQ
         fecha_pago = datetime.now()
-        query = compras_table.update().where(
-            compras_table.c.id == compra_id
-        ).values(
-            estado="pagado",
-            metodo_pago=pago_data.metodo_pago,
-            fecha_pago=fecha_pago
-        )
-        
-        await database.execute(query)
-        
-        logger.info(f"Pago confirmado para compra {compra_id} con {pago_data.metodo_pago}")
-        
-        #  5. Publicar mensaje en RabbitMQ para notificaciones
-        try:
+        async with database.transaction():
+            compra = await self._transicionar(
+                compra_id,
+                usuario_id,
+                {
+                    "estado": "pagado",
+                    "metodo_pago": pago_data.metodo_pago,
+                    "fecha_pago": fecha_pago
+                },
+                sin_permiso="No tienes permiso para pagar esta compra",
+                ya_pagada="Esta compra ya ha sido pagada",
+                ya_cancelada="No se puede pagar una compra cancelada"
+            )
+            
             mensaje = {
                 "compraId": compra_id,
                 "usuarioId": usuario_id,
@@ -187,13 +355,18 @@ class ComprasService:
                 "metodoPago": pago_data.metodo_pago,
                 "fechaPago": fecha_pago.isoformat()
             }
-            await rabbitmq_client.publicar_mensaje(mensaje)
-        except Exception as e:
-            logger.error(f"Error al publicar mensaje en RabbitMQ: {str(e)}")
-            # No fallar la operación si falla la notificación
+            await database.execute(
+                outbox_table.insert().values(tipo="pago_confirmado", payload=mensaje)
+            )
+            await estadisticas_service.registrar_transicion(
+                compra.evento_id, compra.cantidad, compra.total, "pendiente", "pagado"
+            )
+            await notificaciones_estado.notificar(compra_id, "pagado")
+        db_router.marcar_escritura(usuario_id)
+        
+        logger.info(f"Pago confirmado para compra {compra_id} con {pago_data.metodo_pago}")
         
-        # 6. Retornar compra actualizada
-        return await self.get_compra_by_id(compra_id)
+        return compra
     
     async def cancelar_compra(self, compra_id: int, usuario_id: str) -> CompraResponse:
         """
@@ -207,32 +380,174 @@ class ComprasService:
             CompraResponse actualizada
             
         Raises:
+            HTTPException 404 si no existe la compra
             HTTPException 403 si no es propietario
-            HTTPException 400 si ya está pagada
+            HTTPException 400 si ya está pagada o cancelada
+        """
+        async with database.transaction():
+            compra = await self._transicionar(
+                compra_id,
+                usuario_id,
+                {"estado": "cancelado"},
+                sin_permiso="No tienes permiso para cancelar esta compra",
+                ya_pagada="No se puede cancelar una compra ya pagada",
+                ya_cancelada="Esta compra ya ha sido cancelada"
+            )
+            await inventario_service.liberar(compra.evento_id, compra.cantidad)
+            await estadisticas_service.registrar_transicion(
+                compra.evento_id, compra.cantidad, compra.total, "pendiente", "cancelado"
+            )
+            await notificaciones_estado.notificar(compra_id, "cancelado")
+        db_router.marcar_escritura(usuario_id)
+        
+        logger.info(f"Compra {compra_id} cancelada")
+        
+        return compra
+    
+    async def seguir_estado(self, compra_id: int, usuario_id: str) -> AsyncIterator[str]:
         """
-        compra = await self.get_compra_by_id(compra_id)
+        Eventos SSE con el estado de una compra hasta que deja de estar pendiente
+        
+        El primer evento lleva el estado actual y el siguiente, el cambio
+        (pagado, cancelado o expirado). La suscripción se abre antes de leer
+        la compra para no perder un cambio entre la lectura y la espera.
         
-        if compra.usuario_id != usuario_id:
+        Args:
+            compra_id: ID de la compra
+            usuario_id: Usuario que consulta (debe ser el propietario)
+            
+        Returns:
+            Iterador de eventos SSE ya formateados
+            
+        Raises (antes de emitir):
+            HTTPException 404 si no existe la compra
+            HTTPException 403 si no es propietario
+            HTTPException 503 si el worker tiene demasiadas suscripciones
+        """
+        suscripcion = notificaciones_estado.suscribir(compra_id)
+        try:
+            compra = await self.get_compra_by_id(compra_id, usuario_id)
+            if compra.usuario_id != usuario_id:
+                raise HTTPException(
+                    status_code=403,
+                    detail="No tienes permiso para ver esta compra"
+                )
+        except BaseException:
+            notificaciones_estado.cancelar(suscripcion)
+            raise
+        
+        return self._eventos_estado(suscripcion, compra.estado, usuario_id)
+    
+    async def _eventos_estado(
+        self,
+        suscripcion: Suscripcion,
+        estado: str,
+        usuario_id: str
+    ) -> AsyncIterator[str]:
+        """Emite el estado y sus cambios; comentario de latido mientras espera"""
+        compra_id = suscripcion.compra_id
+        fin = time.monotonic() + settings.sse_duracion_maxima
+        try:
+            yield f"retry: {settings.sse_reintento_ms}\n" + _evento_sse(compra_id, estado)
+            
+            while estado == "pendiente":
+                restante = fin - time.monotonic()
+                if restante <= 0:
+                    break
+                
+                avisado = await suscripcion.esperar(min(settings.sse_latido, restante))
+                if avisado and suscripcion.estado is not None:
+                    nuevo = suscripcion.estado
+                elif avisado or not notificaciones_estado.escuchando:
+                    # Sin LISTEN (o tras reconectar) el estado se relee
+                    nuevo = (await self.get_compra_by_id(compra_id, usuario_id)).estado
+                else:
+                    yield ": latido\n\n"
+                    continue
+                
+                if nuevo != estado:
+                    estado = nuevo
+                    yield _evento_sse(compra_id, estado)
+                elif not avisado:
+                    yield ": latido\n\n"
+        finally:
+            notificaciones_estado.cancelar(suscripcion)
+    
+    async def _transicionar(
+        self,
+        compra_id: int,
+        usuario_id: str,
+        valores: dict,
+        sin_permiso: str,
+        ya_pagada: str,
+        ya_cancelada: str
+    ) -> CompraResponse:
+        """
+        Cambia el estado de una compra pendiente en un solo round trip
+        
+        El UPDATE condicional (id, usuario_id, estado='pendiente') se ejecuta
+        junto a la lectura del estado actual, de modo que el código de error
+        se deduce del mismo resultado sin consultas adicionales. Dos pagos
+        concurrentes no pueden pasar ambos la validación de estado.
+        
+        Raises:
+            HTTPException 404 si no existe la compra
+            HTTPException 403 si no es propietario
+            HTTPException 400 si la compra ya no está pendiente
+        """
+        c = compras_table.c
+        actual = sqlalchemy.select(
+            c.usuario_id.label("usuario_actual"),
+            c.estado.label("estado_actual")
+        ).where(c.id == compra_id).cte("actual")
+        
+        actualizada = compras_table.update().where(
+            c.id == compra_id,
+            c.usuario_id == usuario_id,
+            c.estado == "pendiente"
+        ).values(**valores).returning(*compras_table.c).cte("actualizada")
+        
+        query = sqlalchemy.select(actual, actualizada).select_from(
+            actual.outerjoin(actualizada, sqlalchemy.true())
+        )
+        fila = await database.fetch_one(query)
+        
+        if not fila:
+            # Las compras archivadas ya no cambian, pero responden con su estado
+            archivo = compras_archivo_table.c
+            fila = await database.fetch_one(
+                sqlalchemy.select(
+                    archivo.usuario_id.label("usuario_actual"),
+                    archivo.estado.label("estado_actual"),
+                    sqlalchemy.null().label("id")
+                ).where(archivo.id == compra_id)
+            )
+        
+        if not fila:
             raise HTTPException(
-                status_code=403,
-                detail="No tienes permiso para cancelar esta compra"
+                status_code=404,
+                detail=f"Compra con ID {compra_id} no encontrada"
             )
         
-        if compra.estado == "pagado":
+        if fila["id"] is None:
+            if fila["usuario_actual"] != usuario_id:
+                raise HTTPException(status_code=403, detail=sin_permiso)
+            if fila["estado_actual"] == "pagado":
+                raise HTTPException(status_code=400, detail=ya_pagada)
+            if fila["estado_actual"] == "cancelado":
+                raise HTTPException(status_code=400, detail=ya_cancelada)
+            if fila["estado_actual"] == "expirado":
+                raise HTTPException(
+                    status_code=400,
+                    detail="La compra expiró sin pagarse; los asientos se liberaron"
+                )
+            # Otra petición cambió el estado entre la lectura y el UPDATE
             raise HTTPException(
                 status_code=400,
-                detail="No se puede cancelar una compra ya pagada"
+                detail="La compra ya no está pendiente"
             )
         
-        query = compras_table.update().where(
-            compras_table.c.id == compra_id
-        ).values(estado="cancelado")
-        
-        await database.execute(query)
-        
-        logger.info(f"Compra {compra_id} cancelada")
-        
-        return await self.get_compra_by_id(compra_id)
+        return CompraResponse.desde_fila(fila)
 
 
 compras_service = ComprasService()
\ No newline at end of file
@@ -0,0 +1,297 @@
+"""
+Agregados de ventas por evento mantenidos de forma incremental
+"""
+import asyncio
+import random
+from datetime import datetime, timedelta
+from decimal import Decimal
+from typing import Dict, List, Optional, Tuple
+import sqlalchemy
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from app.config import settings
+from app.database import (
+    compras_con_archivo,
+    database,
+    db_router,
+    select_ventas_desde_compras,
+    ventas_eventos_table
+)
+from app.utils.logger import logger
+
+# Clave del advisory lock de la reconciliación (un único worker a la vez)
+LOCK_RECONCILIACION = 7_302_002
+
+# Clase de los advisory locks por evento: las escrituras toman el suyo
+# compartido y la reconciliación de ese evento, exclusivo
+LOCK_VENTAS_EVENTO = 7_302_004
+
+
+class EstadisticasService:
+    """
+    Compras, entradas e importe por (evento, estado) sin recorrer `compras`
+
+    Cada compra, pago o cancelación aplica su delta en la misma transacción
+    que el cambio de la compra, así que consultar un evento lee unas pocas
+    filas. Igual que el inventario, los contadores se reparten en shards para
+    que las compras de un evento popular no compitan por una sola fila. Una
+    reconciliación nocturna los recalcula desde `compras`.
+    """
+
+    def __init__(self):
+        self.shards = settings.inventario_shards
+        self.tarea: Optional[asyncio.Task] = None
+
+        # Métricas
+        self.reconciliaciones = 0
+        self.corregidos = 0
+        self.ultima_reconciliacion: Optional[datetime] = None
+
+    async def registrar_compra(self, evento_id: int, cantidad: int, total: Decimal):
+        """Suma una compra nueva (pendiente); llamar dentro de su transacción"""
+        await self._aplicar(evento_id, cantidad, total, [("pendiente", 1)])
+
+    async def registrar_transicion(
+        self,
+        evento_id: int,
+        cantidad: int,
+        total: Decimal,
+        desde: str,
+        hasta: str,
+        compras: int = 1
+    ):
+        """Mueve compras de estado (sumando cantidad y total); llamar dentro de su transacción"""
+        await self._aplicar(evento_id, cantidad, total, [(desde, -compras), (hasta, compras)])
+
+    async def _aplicar(
+        self,
+        evento_id: int,
+        cantidad: int,
+        total: Decimal,
+        deltas: List[Tuple[str, int]]
+    ):
+        """
+        Upsert de los deltas en un shard al azar (una sentencia)
+
+        Cada delta es (estado, compras); cantidad y total tienen el signo del delta.
+        """
+        t = ventas_eventos_table
+        shard = random.randrange(self.shards)
+
+        # Hasta el commit, la reconciliación de este evento espera
+        await database.execute(
+            sqlalchemy.select(sqlalchemy.func.pg_advisory_xact_lock_shared(LOCK_VENTAS_EVENTO, evento_id))
+        )
+
+        # Filas ordenadas por estado: dos transacciones sobre el mismo shard
+        # bloquean las filas en el mismo orden
+        insert = pg_insert(t).values([
+            {
+                "evento_id": evento_id,
+                "estado": estado,
+                "shard": shard,
+                "compras": compras,
+                "entradas": cantidad if compras > 0 else -cantidad,
+                "importe": total if compras > 0 else -total
+            }
+            for estado, compras in sorted(deltas)
+        ])
+        await database.execute(
+            insert.on_conflict_do_update(
+                index_elements=[t.c.evento_id, t.c.estado, t.c.shard],
+                set_={
+                    "compras": t.c.compras + insert.excluded.compras,
+                    "entradas": t.c.entradas + insert.excluded.entradas,
+                    "importe": t.c.importe + insert.excluded.importe
+                }
+            )
+        )
+
+    async def obtener(self, evento_id: int) -> dict:
+        """
+        Ventas de un evento por estado
+
+        Returns:
+            dict con evento_id, por_estado, entradas_vendidas y recaudado
+            (estos dos solo cuentan compras pagadas)
+        """
+        t = ventas_eventos_table
+        query = sqlalchemy.select(
+            t.c.estado,
+            sqlalchemy.func.sum(t.c.compras).label("compras"),
+            sqlalchemy.func.sum(t.c.entradas).label("entradas"),
+            sqlalchemy.func.sum(t.c.importe).label("importe")
+        ).where(t.c.evento_id == evento_id).group_by(t.c.estado)
+
+        por_estado = {
+            fila["estado"]: {
+                "compras": int(fila["compras"]),
+                "entradas": int(fila["entradas"]),
+                "importe": fila["importe"]
+            }
+            for fila in await db_router.fetch_all(query)
+        }
+        pagado = por_estado.get("pagado", {"entradas": 0, "importe": Decimal("0")})
+
+        return {
+            "evento_id": evento_id,
+            "por_estado": por_estado,
+            "entradas_vendidas": pagado["entradas"],
+            "recaudado": pagado["importe"]
+        }
+
+    async def reconciliar(self) -> Optional[int]:
+        """
+        Recalcula desde las compras (incluidas las archivadas) los eventos
+        cuyos agregados se desviaron
+
+        La comparación de todos los eventos se hace sin bloqueos. Cada evento
+        candidato se vuelve a comprobar y se corrige en su propia transacción
+        con su advisory lock exclusivo: espera a que se confirmen las
+        escrituras en curso de ese evento y frena solo las nuevas de ese
+        evento mientras dura, así que ninguna compra queda contada dos veces
+        ni perdida.
+
+        Returns:
+            Número de (evento, estado) corregidos, o None si otro worker ya
+            está reconciliando
+        """
+        # Lock de sesión: la conexión se mantiene durante toda la reconciliación
+        async with database.connection():
+            bloqueado = await database.fetch_val(
+                sqlalchemy.select(sqlalchemy.func.pg_try_advisory_lock(LOCK_RECONCILIACION))
+            )
+            if not bloqueado:
+                return None
+
+            try:
+                candidatos = self._eventos_distintos(
+                    await self._sumas(self._select_actuales()),
+                    await self._sumas(select_ventas_desde_compras())
+                )
+
+                corregidos = 0
+                for evento_id in candidatos:
+                    corregidos += await self._corregir_evento(evento_id)
+            finally:
+                await database.execute(
+                    sqlalchemy.select(sqlalchemy.func.pg_advisory_unlock(LOCK_RECONCILIACION))
+                )
+
+        self.reconciliaciones += 1
+        self.corregidos += corregidos
+        self.ultima_reconciliacion = datetime.now()
+        return corregidos
+
+    async def _corregir_evento(self, evento_id: int) -> int:
+        """
+        Recalcula un evento bajo su advisory lock exclusivo
+
+        Returns:
+            Número de (evento, estado) corregidos (0 si ya cuadraba)
+        """
+        t = ventas_eventos_table
+        origen = compras_con_archivo(lambda c: [c.evento_id == evento_id])
+
+        async with database.transaction():
+            await database.execute(
+                sqlalchemy.select(sqlalchemy.func.pg_advisory_xact_lock(LOCK_VENTAS_EVENTO, evento_id))
+            )
+            distintos = self._claves_distintas(
+                await self._sumas(self._select_actuales(evento_id)),
+                await self._sumas(select_ventas_desde_compras(origen))
+            )
+            if distintos:
+                await database.execute(t.delete().where(t.c.evento_id == evento_id))
+                await database.execute(
+                    sqlalchemy.insert(t).from_select(
+                        [c.name for c in t.c],
+                        select_ventas_desde_compras(origen)
+                    )
+                )
+        return len(distintos)
+
+    @staticmethod
+    def _select_actuales(evento_id: Optional[int] = None):
+        """Agregados actuales por (evento, estado), de todos los eventos o de uno"""
+        t = ventas_eventos_table
+        query = sqlalchemy.select(
+            t.c.evento_id,
+            t.c.estado,
+            sqlalchemy.func.sum(t.c.compras).label("compras"),
+            sqlalchemy.func.sum(t.c.entradas).label("entradas"),
+            sqlalchemy.func.sum(t.c.importe).label("importe")
+        ).group_by(t.c.evento_id, t.c.estado)
+        if evento_id is not None:
+            query = query.where(t.c.evento_id == evento_id)
+        return query
+
+    @staticmethod
+    def _claves_distintas(actuales: dict, reales: dict) -> List[Tuple[int, str]]:
+        # Las filas a cero equivalen a no tener filas
+        vacio = (0, 0, Decimal("0"))
+        return [
+            clave for clave in actuales.keys() | reales.keys()
+            if actuales.get(clave, vacio) != reales.get(clave, vacio)
+        ]
+
+    def _eventos_distintos(self, actuales: dict, reales: dict) -> List[int]:
+        return sorted({evento_id for evento_id, _ in self._claves_distintas(actuales, reales)})
+
+    @staticmethod
+    async def _sumas(query) -> Dict[Tuple[int, str], Tuple[int, int, Decimal]]:
+        return {
+            (fila["evento_id"], fila["estado"]): (
+                int(fila["compras"]),
+                int(fila["entradas"]),
+                Decimal(fila["importe"])
+            )
+            for fila in await database.fetch_all(query)
+        }
+
+    async def iniciar(self):
+        """Programa la reconciliación nocturna (ciclo de vida de la app)"""
+        if self.tarea is None:
+            self.tarea = asyncio.create_task(self._reconciliar_cada_noche())
+
+    async def detener(self):
+        """Cancela la reconciliación programada"""
+        if self.tarea is not None:
+            self.tarea.cancel()
+            try:
+                await self.tarea
+            except asyncio.CancelledError:
+                pass
+            self.tarea = None
+
+    async def _reconciliar_cada_noche(self):
+        while True:
+            ahora = datetime.now()
+            siguiente = ahora.replace(
+                hour=settings.estadisticas_hora_reconciliacion,
+                minute=0,
+                second=0,
+                microsecond=0
+            )
+            if siguiente <= ahora:
+                siguiente += timedelta(days=1)
+            await asyncio.sleep((siguiente - ahora).total_seconds())
+
+            try:
+                corregidos = await self.reconciliar()
+                if corregidos is not None:
+                    logger.info(f"Estadísticas de ventas reconciliadas ({corregidos} corregidos)")
+            except Exception as e:
+                logger.error(f"Error al reconciliar estadísticas de ventas: {str(e)}")
+
+    def metricas(self) -> dict:
+        """Reconciliaciones ejecutadas y agregados corregidos"""
+        return {
+            "reconciliaciones": self.reconciliaciones,
+            "corregidos": self.corregidos,
+            "ultima_reconciliacion": (
+                self.ultima_reconciliacion.isoformat() if self.ultima_reconciliacion else None
+            )
+        }
+
+
+estadisticas_service = EstadisticasService()
@@ -1,66 +1,322 @@
 """
 Cliente HTTP para el servicio de Eventos (Rust)
 """
+import asyncio
+import time
 import httpx
-from typing import Optional
+import orjson
+from typing import Dict, Iterable, List, Optional, Tuple
 from app.config import settings
+from app.utils.cache import SingleFlight, TTLCache
+from app.utils.circuit_breaker import CircuitBreaker, CircuitoAbiertoError, marcar_obsoleto
+from app.utils.http_cache import RepresentacionCacheable
 from app.utils.logger import logger
 
 
+# Clave del catálogo en el SingleFlight (las de los eventos son enteros)
+CLAVE_CATALOGO = "catalogo"
+
+
+class Catalogo:
+    """Lista de eventos con su respuesta HTTP ya serializada"""
+
+    def __init__(self, eventos: List[dict]):
+        self.eventos = eventos
+        self.obtenido_en = time.monotonic()
+        self.representacion = RepresentacionCacheable(
+            orjson.dumps({"total": len(eventos), "eventos": eventos})
+        )
+
+
 class EventosClient:
-    """Cliente para comunicarse con el servicio de Eventos"""
-    
+    """
+    Cliente para comunicarse con el servicio de Eventos
+
+    Las llamadas pasan por un circuit breaker: si Eventos falla o va lento se
+    rechazan al instante en lugar de esperar al timeout. Mientras tanto se
+    sirve la última versión válida de cada evento (hasta
+    `eventos_obsoleto_ttl`), marcando la respuesta como obsoleta.
+    """
+
     def __init__(self):
         self.base_url = settings.eventos_service_url
-    
+        self.client: Optional[httpx.AsyncClient] = None
+        self.cache = TTLCache(settings.eventos_cache_max, settings.eventos_cache_ttl)
+        self.validos = TTLCache(settings.eventos_cache_max, settings.eventos_obsoleto_ttl)
+        self.catalogo: Optional[Catalogo] = None
+        self._refresco: Optional[asyncio.Task] = None
+        self.single_flight = SingleFlight()
+        self.breaker = CircuitBreaker(
+            "eventos",
+            ventana=settings.eventos_breaker_ventana,
+            minimo_llamadas=settings.eventos_breaker_minimo,
+            tasa_fallos=settings.eventos_breaker_tasa_fallos,
+            tasa_lentas=settings.eventos_breaker_tasa_lentas,
+            lento_ms=settings.eventos_breaker_lento_ms,
+            espera=settings.eventos_breaker_espera,
+            sondas=settings.eventos_breaker_sondas
+        )
+
+        # Métricas de uso del pool
+        self.peticiones = 0
+        self.en_vuelo = 0
+        self.max_en_vuelo = 0
+        self.saturaciones = 0
+        self.pool_timeouts = 0
+        self.obsoletos_servidos = 0
+
+    def _crear_cliente(self) -> httpx.AsyncClient:
+        """Crea el cliente HTTP compartido con keep-alive"""
+        http2 = settings.eventos_http2
+        if http2:
+            try:
+                import h2  # noqa: F401
+            except ImportError:
+                logger.warning("Paquete h2 no instalado, se usará HTTP/1.1 con Eventos")
+                http2 = False
+
+        limits = httpx.Limits(
+            max_connections=settings.eventos_pool_max_conexiones,
+            max_keepalive_connections=settings.eventos_pool_max_keepalive,
+            keepalive_expiry=settings.eventos_keepalive_expiry
+        )
+        return httpx.AsyncClient(
+            base_url=self.base_url,
+            limits=limits,
+            http2=http2,
+            timeout=self._timeout(settings.eventos_timeout)
+        )
+
+    def _timeout(self, total: float) -> httpx.Timeout:
+        """Timeout por llamada con límites propios de conexión y pool"""
+        return httpx.Timeout(
+            total,
+            connect=settings.eventos_connect_timeout,
+            pool=settings.eventos_pool_timeout
+        )
+
+    async def iniciar(self):
+        """Abre el cliente HTTP compartido (ciclo de vida de la app)"""
+        if self.client is None:
+            self.client = self._crear_cliente()
+            logger.info(f"Cliente de Eventos iniciado - {self.base_url}")
+
+    async def cerrar(self):
+        """Cancela el refresco del catálogo en curso y cierra el cliente HTTP"""
+        if self._refresco is not None:
+            self._refresco.cancel()
+            try:
+                await self._refresco
+            except asyncio.CancelledError:
+                pass
+            except Exception as e:
+                logger.warning(f"Refresco del catálogo de eventos fallido: {str(e)}")
+            self._refresco = None
+        # La descarga compartida corre en su propia tarea
+        await self.single_flight.cancelar()
+
+        if self.client is not None:
+            await self.client.aclose()
+            self.client = None
+            logger.info("Cliente de Eventos cerrado")
+
+    async def _get(self, path: str, timeout: float) -> httpx.Response:
+        """
+        GET sobre el pool compartido registrando su ocupación
+
+        Raises:
+            CircuitoAbiertoError si el circuito rechaza la llamada
+            httpx.RequestError si la llamada falla
+        """
+        if self.client is None:
+            await self.iniciar()
+
+        if not self.breaker.permitir():
+            raise CircuitoAbiertoError("Circuito de Eventos abierto")
+
+        self.peticiones += 1
+        if self.en_vuelo >= settings.eventos_pool_max_conexiones:
+            self.saturaciones += 1
+        self.en_vuelo += 1
+        self.max_en_vuelo = max(self.max_en_vuelo, self.en_vuelo)
+
+        inicio = time.perf_counter()
+        exito = False
+        cancelada = False
+        try:
+            response = await self.client.get(path, timeout=self._timeout(timeout))
+            exito = response.status_code < 500
+            return response
+        except asyncio.CancelledError:
+            # El llamador abandonó la petición: no dice nada de Eventos
+            cancelada = True
+            raise
+        except httpx.PoolTimeout:
+            self.pool_timeouts += 1
+            raise
+        finally:
+            self.en_vuelo -= 1
+            if cancelada:
+                self.breaker.cancelar()
+            else:
+                self.breaker.registrar(exito, (time.perf_counter() - inicio) * 1000)
+
+    def metricas(self) -> dict:
+        """Contadores de uso del pool HTTP y de la caché de eventos"""
+        return {
+            "cache": {
+                **self.cache.metricas(),
+                "peticiones_compartidas": self.single_flight.compartidas
+            },
+            "peticiones": self.peticiones,
+            "en_vuelo": self.en_vuelo,
+            "max_en_vuelo": self.max_en_vuelo,
+            "saturaciones": self.saturaciones,
+            "pool_timeouts": self.pool_timeouts,
+            "max_conexiones": settings.eventos_pool_max_conexiones,
+            "circuito": self.breaker.metricas(),
+            "obsoletos_servidos": self.obsoletos_servidos
+        }
+
     async def get_evento(self, evento_id: int) -> Optional[dict]:
         """
-        Obtiene un evento por ID
-        
+        Obtiene un evento por ID (con caché y deduplicación de peticiones)
+
         Args:
             evento_id: ID del evento
-            
+
         Returns:
             dict con datos del evento o None si no existe
         """
+        encontrado, evento = self.cache.get(evento_id)
+        if encontrado:
+            return evento
+
+        evento, obsoleto = await self.single_flight.do(
+            evento_id,
+            lambda: self._cargar_evento(evento_id)
+        )
+        if obsoleto:
+            marcar_obsoleto("eventos")
+        return evento
+
+    async def get_eventos(self, evento_ids: Iterable[int]) -> Dict[int, Optional[dict]]:
+        """
+        Obtiene varios eventos de forma concurrente (el servicio de Eventos
+        no expone un endpoint por lotes)
+
+        Args:
+            evento_ids: IDs de los eventos (se ignoran duplicados)
+
+        Returns:
+            dict evento_id -> evento (o None si no existe)
+        """
+        ids = list(dict.fromkeys(evento_ids))
+        semaforo = asyncio.Semaphore(settings.eventos_max_concurrencia)
+
+        async def obtener(evento_id: int) -> Optional[dict]:
+            async with semaforo:
+                return await self.get_evento(evento_id)
+
+        eventos = await asyncio.gather(*(obtener(evento_id) for evento_id in ids))
+        return dict(zip(ids, eventos))
+
+    async def _cargar_evento(self, evento_id: int) -> Tuple[Optional[dict], bool]:
+        """
+        Consulta el evento en el servicio y guarda el resultado en caché
+
+        Returns:
+            (evento, obsoleto): si Eventos no responde se devuelve la última
+            versión válida conocida con obsoleto=True
+        """
         try:
-            async with httpx.AsyncClient(timeout=5.0) as client:
-                response = await client.get(f"{self.base_url}/eventos/{evento_id}")
-                
-                if response.status_code == 200:
-                    return response.json()
-                elif response.status_code == 404:
-                    logger.warning(f"Evento {evento_id} no encontrado")
-                    return None
-                else:
-                    logger.error(f"Error al obtener evento {evento_id}: {response.status_code}")
-                    return None
-                    
+            response = await self._get(f"/eventos/{evento_id}", settings.eventos_timeout)
+
+            if response.status_code == 200:
+                evento = response.json()
+                self.cache.set(evento_id, evento)
+                self.validos.set(evento_id, evento)
+                return evento, False
+            elif response.status_code == 404:
+                logger.warning(f"Evento {evento_id} no encontrado")
+                self.cache.set(evento_id, None, settings.eventos_cache_ttl_negativo)
+                self.validos.invalidar(evento_id)
+                return None, False
+            else:
+                logger.error(f"Error al obtener evento {evento_id}: {response.status_code}")
+
+        except CircuitoAbiertoError:
+            pass
         except httpx.RequestError as e:
             logger.error(f"Error de conexión con servicio de Eventos: {str(e)}")
-            return None
-    
+
+        encontrado, evento = self.validos.get(evento_id)
+        if encontrado:
+            self.obsoletos_servidos += 1
+            return evento, True
+        return None, False
+
     async def listar_eventos(self) -> list:
         """
         Lista todos los eventos disponibles
-        
+
         Returns:
             Lista de eventos
         """
+        return (await self.obtener_catalogo()).eventos
+
+    async def obtener_catalogo(self) -> "Catalogo":
+        """
+        Catálogo de eventos cacheado en el proceso
+
+        Durante `eventos_lista_ttl` se sirve sin consultar a Eventos; después,
+        y hasta `eventos_lista_max_edad`, se sirve la copia actual mientras se
+        refresca en segundo plano.
+        """
+        catalogo = self.catalogo
+        if catalogo is not None:
+            edad = time.monotonic() - catalogo.obtenido_en
+            if edad < settings.eventos_lista_ttl:
+                return catalogo
+            if edad < settings.eventos_lista_max_edad:
+                if self._refresco is None or self._refresco.done():
+                    self._refresco = asyncio.create_task(
+                        self.single_flight.do(CLAVE_CATALOGO, self._cargar_catalogo)
+                    )
+                return catalogo
+
+        catalogo, obsoleto = await self.single_flight.do(CLAVE_CATALOGO, self._cargar_catalogo)
+        if obsoleto:
+            marcar_obsoleto("eventos")
+        return catalogo
+
+    async def _cargar_catalogo(self) -> Tuple["Catalogo", bool]:
+        """
+        Descarga la lista de eventos
+
+        Returns:
+            (catálogo, obsoleto): si Eventos no responde se devuelve el último
+            catálogo válido (o uno vacío) con obsoleto=True
+        """
         try:
-            async with httpx.AsyncClient(timeout=10.0) as client:
-                response = await client.get(f"{self.base_url}/eventos")
-                
-                if response.status_code == 200:
-                    data = response.json()
-                    return data.get("eventos", [])
-                else:
-                    logger.error(f"Error al listar eventos: {response.status_code}")
-                    return []
-                    
+            response = await self._get("/eventos", settings.eventos_listar_timeout)
+
+            if response.status_code == 200:
+                self.catalogo = Catalogo(response.json().get("eventos", []))
+                return self.catalogo, False
+            else:
+                logger.error(f"Error al listar eventos: {response.status_code}")
+
+        except CircuitoAbiertoError:
+            pass
         except httpx.RequestError as e:
             logger.error(f"Error de conexión con servicio de Eventos: {str(e)}")
-            return []
+
+        catalogo = self.catalogo
+        if catalogo is not None and time.monotonic() - catalogo.obtenido_en < settings.eventos_obsoleto_ttl:
+            self.obsoletos_servidos += 1
+            return catalogo, True
+        return Catalogo([]), False
 
 
-eventos_client = EventosClient()
\ No newline at end of file
+eventos_client = EventosClient()
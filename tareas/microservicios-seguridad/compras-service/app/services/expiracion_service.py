@@ -0,0 +1,141 @@
+"""
+Expiración en segundo plano de compras pendientes abandonadas
+"""
+import asyncio
+import time
+from collections import defaultdict
+from datetime import timedelta
+from decimal import Decimal
+from typing import Dict, List, Optional
+import sqlalchemy
+from app.config import settings
+from app.database import database, compras_table
+from app.services.estadisticas_service import estadisticas_service
+from app.services.inventario_service import inventario_service
+from app.services.notificaciones_estado import notificaciones_estado
+from app.utils.logger import logger
+from app.utils.query_stats import EstadisticaConsulta
+
+
+class ExpiracionService:
+    """
+    Marca como 'expirado' las compras pendientes más antiguas que la reserva
+
+    Trabaja por lotes acotados con FOR UPDATE SKIP LOCKED, así que varios
+    workers pueden ejecutarlo a la vez sin pisarse ni bloquear los pagos en
+    curso. Entre lotes hace una pausa para que la carga de escritura sea
+    predecible. Los asientos vuelven al inventario y los agregados de ventas
+    se actualizan en la misma transacción que cada lote.
+    """
+
+    def __init__(self):
+        self.tarea: Optional[asyncio.Task] = None
+        self.lote = settings.expiracion_lote
+        self.pausa = settings.expiracion_pausa
+        self.intervalo = settings.expiracion_intervalo
+
+        # Métricas
+        self.expiradas = 0
+        self.errores = 0
+        self.duracion_lotes = EstadisticaConsulta("lote_expiracion")
+        self.ultimo_lote: Optional[dict] = None
+
+    async def iniciar(self):
+        """Arranca la tarea de fondo (ciclo de vida de la app)"""
+        if self.tarea is None:
+            self.tarea = asyncio.create_task(self._ejecutar())
+            logger.info("Expiración de compras pendientes iniciada")
+
+    async def detener(self):
+        """Detiene la tarea de fondo"""
+        if self.tarea is not None:
+            self.tarea.cancel()
+            try:
+                await self.tarea
+            except asyncio.CancelledError:
+                pass
+            self.tarea = None
+            logger.info("Expiración de compras pendientes detenida")
+
+    async def _ejecutar(self):
+        """Expira lotes con pausas entre ellos; espera cuando no queda nada"""
+        while True:
+            try:
+                expiradas = await self.expirar_lote()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.errores += 1
+                logger.error(f"Error al expirar compras pendientes: {str(e)}")
+                expiradas = 0
+
+            await asyncio.sleep(self.pausa if expiradas >= self.lote else self.intervalo)
+
+    async def expirar_lote(self) -> int:
+        """
+        Expira un lote de compras pendientes
+
+        Returns:
+            Número de compras expiradas
+        """
+        c = compras_table.c
+        limite = sqlalchemy.func.now() - timedelta(minutes=settings.compras_reserva_minutos)
+        inicio = time.perf_counter()
+
+        lote = sqlalchemy.select(c.id).where(
+            c.estado == "pendiente",
+            c.fecha_compra < limite
+        ).order_by(c.fecha_compra).limit(self.lote).with_for_update(skip_locked=True)
+
+        query = compras_table.update().where(
+            c.id.in_(lote.scalar_subquery())
+        ).values(estado="expirado").returning(c.id, c.evento_id, c.cantidad, c.total)
+
+        async with database.transaction():
+            filas = await database.fetch_all(query)
+
+            # Un único ajuste por evento, en orden para no cruzar bloqueos
+            por_evento: Dict[int, List] = defaultdict(lambda: [0, 0, Decimal("0")])
+            for fila in filas:
+                acumulado = por_evento[fila["evento_id"]]
+                acumulado[0] += 1
+                acumulado[1] += fila["cantidad"]
+                acumulado[2] += fila["total"]
+
+            for evento_id in sorted(por_evento):
+                compras, cantidad, total = por_evento[evento_id]
+                await inventario_service.liberar(evento_id, cantidad)
+                await estadisticas_service.registrar_transicion(
+                    evento_id, cantidad, total, "pendiente", "expirado", compras=compras
+                )
+            await notificaciones_estado.notificar_varias(
+                (fila["id"] for fila in filas), "expirado"
+            )
+
+        duracion_ms = (time.perf_counter() - inicio) * 1000
+        self.duracion_lotes.registrar(duracion_ms, False)
+        self.expiradas += len(filas)
+        self.ultimo_lote = {
+            "expiradas": len(filas),
+            "eventos": len(por_evento),
+            "duracion_ms": round(duracion_ms, 3)
+        }
+        if filas:
+            logger.info(f"{len(filas)} compras pendientes expiradas en {duracion_ms:.1f} ms")
+        return len(filas)
+
+    def metricas(self) -> dict:
+        """Compras expiradas y duración de los lotes"""
+        duracion = self.duracion_lotes.resumen()
+        return {
+            "expiradas": self.expiradas,
+            "lotes": duracion["llamadas"],
+            "errores": self.errores,
+            "lote_media_ms": duracion["media_ms"],
+            "lote_p99_ms": duracion["p99_ms"],
+            "lote_max_ms": duracion["max_ms"],
+            "ultimo_lote": self.ultimo_lote
+        }
+
+
+expiracion_service = ExpiracionService()
@@ -0,0 +1,332 @@
+"""
+Almacén de claves de idempotencia (header Idempotency-Key)
+"""
+import asyncio
+import hashlib
+import time
+from datetime import datetime, timedelta
+from typing import Any, Awaitable, Callable, Optional, Tuple
+import sqlalchemy
+from fastapi import HTTPException
+from fastapi.encoders import jsonable_encoder
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from app.config import settings
+from app.database import database, idempotencia_table
+from app.utils.cache import SingleFlight, TTLCache
+from app.utils.logger import logger
+
+# Intervalo de sondeo mientras otra petición con la misma clave está en curso
+INTERVALO_ESPERA = 0.1
+
+
+class IdempotenciaService:
+    """
+    Repite la respuesta almacenada para peticiones con una clave ya usada
+
+    Las respuestas se guardan en la tabla `idempotencia` (con TTL) y en una
+    caché LRU en memoria hasta el mismo vencimiento que su fila. Los duplicados concurrentes en el mismo worker
+    esperan a la primera petición; entre workers, la fila insertada al
+    comenzar actúa como reserva de la clave durante `idempotencia_reserva`
+    segundos. Si la petición original muere sin liberarla, otra petición con
+    la misma clave la reclama al vencer ese plazo en lugar de recibir 409
+    hasta que expire.
+    """
+
+    def __init__(self):
+        self.cache = TTLCache(settings.idempotencia_cache_max, settings.idempotencia_ttl)
+        self.single_flight = SingleFlight()
+        self.tarea: Optional[asyncio.Task] = None
+
+        # Métricas
+        self.repetidas = 0
+        self.purgadas = 0
+
+    @staticmethod
+    def huella(*partes: Any) -> str:
+        """Hash de los datos de la petición para detectar claves reutilizadas"""
+        return hashlib.sha256(repr(partes).encode()).hexdigest()
+
+    async def ejecutar(
+        self,
+        clave: Optional[str],
+        usuario_id: str,
+        operacion: str,
+        huella: str,
+        fn: Callable[[], Awaitable[Any]]
+    ) -> Any:
+        """
+        Ejecuta la operación una sola vez por clave
+
+        Args:
+            clave: Valor del header Idempotency-Key (None para no aplicar)
+            usuario_id: ID del usuario (las claves son por usuario)
+            operacion: Nombre de la operación
+            huella: Hash de los datos de la petición
+            fn: Operación a ejecutar
+
+        Returns:
+            Resultado de la operación o la respuesta almacenada
+
+        Raises:
+            HTTPException 422 si la clave se usó con otros datos
+            HTTPException 409 si la petición original sigue en curso
+        """
+        if not clave:
+            return await fn()
+
+        id_clave = (usuario_id, operacion, clave)
+        encontrado, entrada = self.cache.get(id_clave)
+        if encontrado:
+            return self._respuesta(entrada, huella)
+
+        # Los duplicados concurrentes de este worker esperan a la primera
+        entrada = await self.single_flight.do(
+            id_clave,
+            lambda: self._ejecutar_una_vez(id_clave, huella, fn)
+        )
+        return self._respuesta(entrada, huella)
+
+    def _respuesta(self, entrada: Tuple[str, Any, bool], huella: str) -> Any:
+        """Devuelve la respuesta si los datos de la petición coinciden"""
+        huella_original, respuesta, repetida = entrada
+        if huella_original != huella:
+            raise HTTPException(
+                status_code=422,
+                detail="La Idempotency-Key ya se usó con datos distintos"
+            )
+        if repetida:
+            self.repetidas += 1
+        return respuesta
+
+    def _filtro(self, id_clave: Tuple[str, str, str]):
+        usuario_id, operacion, clave = id_clave
+        return sqlalchemy.and_(
+            idempotencia_table.c.usuario_id == usuario_id,
+            idempotencia_table.c.operacion == operacion,
+            idempotencia_table.c.clave == clave,
+            idempotencia_table.c.expira_en > sqlalchemy.func.now()
+        )
+
+    @staticmethod
+    def _segundos_restantes():
+        """Segundos que le quedan a la fila antes de expirar (para la caché)"""
+        return sqlalchemy.func.extract(
+            "epoch", idempotencia_table.c.expira_en - sqlalchemy.func.now()
+        ).label("restante")
+
+    async def _ejecutar_una_vez(
+        self,
+        id_clave: Tuple[str, str, str],
+        huella: str,
+        fn: Callable[[], Awaitable[Any]]
+    ) -> Tuple[str, Any, bool]:
+        """
+        Reserva la clave, ejecuta la operación y guarda la respuesta
+
+        La operación y la respuesta se confirman en la misma transacción (la
+        de la operación pasa a ser un savepoint), así que no puede quedar una
+        compra hecha sin su respuesta. La respuesta solo se guarda si la
+        reserva sigue siendo nuestra; si otra petición la reclamó, todo se
+        deshace y no hay dos ejecuciones confirmadas.
+
+        Returns:
+            (huella, respuesta, repetida)
+        """
+        while True:
+            reserva = await self._reservar(id_clave, huella)
+            if reserva is not None:
+                break
+            entrada = await self._esperar_respuesta(id_clave)
+            if entrada is not None:
+                return entrada
+
+        try:
+            async with database.transaction():
+                resultado = await fn()
+                respuesta = jsonable_encoder(resultado)
+                restante = await database.fetch_val(
+                    idempotencia_table.update().where(
+                        self._filtro_reserva(id_clave, reserva)
+                    ).values(respuesta=respuesta, en_curso_hasta=None).returning(
+                        self._segundos_restantes()
+                    )
+                )
+                if restante is None:
+                    raise HTTPException(
+                        status_code=409,
+                        detail="La reserva de la Idempotency-Key venció antes de completar la petición"
+                    )
+        except BaseException:
+            await self._liberar(id_clave, reserva)
+            raise
+
+        self.cache.set(id_clave, (huella, respuesta, True), ttl=float(restante))
+        return huella, respuesta, False
+
+    async def _reservar(self, id_clave: Tuple[str, str, str], huella: str) -> Optional[datetime]:
+        """
+        Inserta la clave con respuesta NULL
+
+        Si la clave existe pero expiró (pendiente de purga) o su reserva venció
+        sin respuesta, se reclama.
+
+        Returns:
+            Fin de la reserva (identifica al dueño), o None si la clave está
+            ocupada
+        """
+        usuario_id, operacion, clave = id_clave
+        t = idempotencia_table
+        ahora = sqlalchemy.func.now()
+        expira_en = ahora + timedelta(seconds=settings.idempotencia_ttl)
+        en_curso_hasta = ahora + timedelta(seconds=settings.idempotencia_reserva)
+
+        insert = pg_insert(t).values(
+            usuario_id=usuario_id,
+            operacion=operacion,
+            clave=clave,
+            huella=huella,
+            expira_en=expira_en,
+            en_curso_hasta=en_curso_hasta
+        )
+        return await database.fetch_val(
+            insert.on_conflict_do_update(
+                index_elements=[t.c.usuario_id, t.c.operacion, t.c.clave],
+                set_={
+                    "huella": huella,
+                    "respuesta": sqlalchemy.null(),
+                    "expira_en": expira_en,
+                    "en_curso_hasta": en_curso_hasta
+                },
+                where=sqlalchemy.or_(
+                    t.c.expira_en <= ahora,
+                    sqlalchemy.and_(t.c.respuesta.is_(None), t.c.en_curso_hasta <= ahora)
+                )
+            ).returning(t.c.en_curso_hasta)
+        )
+
+    def _filtro_reserva(self, id_clave: Tuple[str, str, str], reserva: datetime):
+        """Filtro de la clave mientras la reserva sigue siendo de esta petición"""
+        return sqlalchemy.and_(
+            self._filtro(id_clave),
+            idempotencia_table.c.respuesta.is_(None),
+            idempotencia_table.c.en_curso_hasta == reserva
+        )
+
+    async def _liberar(self, id_clave: Tuple[str, str, str], reserva: datetime):
+        """
+        Borra la reserva para que el cliente pueda reintentar
+
+        Si el borrado falla (o se cancela) no pasa nada grave: la reserva
+        vence sola al cabo de `idempotencia_reserva` segundos.
+        """
+        try:
+            await database.execute(
+                idempotencia_table.delete().where(self._filtro_reserva(id_clave, reserva))
+            )
+        except BaseException as e:
+            logger.warning(f"No se pudo liberar la clave de idempotencia {id_clave[2]}: {str(e)}")
+
+    async def _esperar_respuesta(
+        self,
+        id_clave: Tuple[str, str, str]
+    ) -> Optional[Tuple[str, Any, bool]]:
+        """
+        Espera a que otra petición complete la original
+
+        La respuesta encontrada se guarda en la caché hasta que expire su fila.
+
+        Returns:
+            (huella, respuesta, repetida), o None si la clave quedó libre
+            (borrada o con la reserva vencida) y se puede volver a reservar
+
+        Raises:
+            HTTPException 409 si la original sigue en curso pasado
+            `idempotencia_espera`
+        """
+        t = idempotencia_table
+        limite = time.monotonic() + settings.idempotencia_espera
+        query = sqlalchemy.select(
+            t.c.huella,
+            t.c.respuesta,
+            (t.c.en_curso_hasta <= sqlalchemy.func.now()).label("vencida"),
+            self._segundos_restantes()
+        ).where(self._filtro(id_clave))
+
+        while True:
+            fila = await database.fetch_one(query)
+            if fila is None or (fila["respuesta"] is None and fila["vencida"]):
+                return None
+            if fila["respuesta"] is not None:
+                entrada = (fila["huella"], fila["respuesta"], True)
+                self.cache.set(id_clave, entrada, ttl=float(fila["restante"]))
+                return entrada
+            if time.monotonic() >= limite:
+                raise HTTPException(
+                    status_code=409,
+                    detail="Hay una petición en curso con la misma Idempotency-Key"
+                )
+            await asyncio.sleep(INTERVALO_ESPERA)
+
+    async def purgar(self) -> int:
+        """
+        Elimina por lotes las claves expiradas
+
+        Returns:
+            Número de claves eliminadas
+        """
+        t = idempotencia_table
+        total = 0
+        while True:
+            expiradas = sqlalchemy.select(
+                t.c.usuario_id, t.c.operacion, t.c.clave
+            ).where(
+                t.c.expira_en <= sqlalchemy.func.now()
+            ).limit(settings.idempotencia_purga_lote)
+
+            query = t.delete().where(
+                sqlalchemy.tuple_(t.c.usuario_id, t.c.operacion, t.c.clave).in_(expiradas)
+            ).returning(t.c.clave)
+            borradas = len(await database.fetch_all(query))
+
+            total += borradas
+            if borradas < settings.idempotencia_purga_lote:
+                break
+
+        self.purgadas += total
+        return total
+
+    async def iniciar(self):
+        """Arranca la purga periódica (ciclo de vida de la app)"""
+        if self.tarea is None:
+            self.tarea = asyncio.create_task(self._purgar_periodicamente())
+
+    async def detener(self):
+        """Detiene la purga periódica"""
+        if self.tarea is not None:
+            self.tarea.cancel()
+            try:
+                await self.tarea
+            except asyncio.CancelledError:
+                pass
+            self.tarea = None
+
+    async def _purgar_periodicamente(self):
+        while True:
+            await asyncio.sleep(settings.idempotencia_purga_intervalo)
+            try:
+                borradas = await self.purgar()
+                if borradas:
+                    logger.info(f"{borradas} claves de idempotencia expiradas eliminadas")
+            except Exception as e:
+                logger.error(f"Error al purgar claves de idempotencia: {str(e)}")
+
+    def metricas(self) -> dict:
+        """Contadores de respuestas repetidas y claves purgadas"""
+        return {
+            "cache": self.cache.metricas(),
+            "repetidas": self.repetidas,
+            "purgadas": self.purgadas
+        }
+
+
+idempotencia_service = IdempotenciaService()
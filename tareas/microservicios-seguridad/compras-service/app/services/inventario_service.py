@@ -0,0 +1,275 @@
+"""
+Inventario de asientos por evento repartido en shards
+"""
+from typing import Dict, Optional
+import sqlalchemy
+from fastapi import HTTPException
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from app.config import settings
+from app.database import database, compras_con_archivo, inventario_table
+from app.utils.logger import logger
+
+
+class InventarioService:
+    """
+    Reserva y libera asientos sin serializar a los compradores de un evento
+
+    Los asientos disponibles de cada evento se reparten en N filas (shards).
+    Una reserva descuenta de un shard existente elegido al azar con un UPDATE
+    condicional; si ningún shard tiene suficientes asientos pero el total sí
+    alcanza, se rebalancean los shards del evento. Con el evento agotado la
+    reserva falla sin bloquear ningún shard.
+
+    El número de shards de un evento es el de las filas que ya tiene: cambiar
+    `inventario_shards` solo afecta a los eventos que se inicialicen después,
+    así que workers con distinta configuración comparten el mismo inventario.
+    """
+
+    def __init__(self):
+        # Shards con los que se crea el inventario de un evento nuevo
+        self.shards = settings.inventario_shards
+        # Capacidad ya registrada en la base de datos por evento; solo evita
+        # volver a consultarla en cada compra
+        self._capacidades: Dict[int, int] = {}
+
+        # Métricas
+        self.reservas = 0
+        self.reintentos = 0
+        self.rebalanceos = 0
+        self.sin_capacidad = 0
+        self.ajustes_capacidad = 0
+        self.liberaciones_sin_inventario = 0
+
+    async def inicializar_evento(self, evento_id: int, capacidad: int):
+        """
+        Crea los shards del evento si aún no existen y aplica los cambios de
+        capacidad
+
+        Debe llamarse dentro de la transacción de la reserva: si la compra se
+        revierte, el inventario recién creado o ajustado también. Los asientos
+        ya vendidos (compras no canceladas) se descuentan de la capacidad. Es
+        idempotente: varios workers pueden llamarlo a la vez.
+
+        Si Eventos informa de una capacidad distinta de la registrada, los
+        asientos disponibles se recalculan con la nueva capacidad.
+        """
+        if self._capacidades.get(evento_id) == capacidad:
+            return
+
+        fila = await database.fetch_one(
+            sqlalchemy.select(inventario_table.c.capacidad).where(
+                inventario_table.c.evento_id == evento_id
+            ).limit(1)
+        )
+
+        if fila is None:
+            restantes = max(capacidad - await self._vendidas(evento_id), 0)
+            base, extra = divmod(restantes, self.shards)
+
+            await database.execute(
+                pg_insert(inventario_table).values([
+                    {
+                        "evento_id": evento_id,
+                        "shard": shard,
+                        "disponibles": base + (1 if shard < extra else 0),
+                        "capacidad": capacidad
+                    }
+                    for shard in range(self.shards)
+                ]).on_conflict_do_nothing()
+            )
+            logger.info(f"Inventario del evento {evento_id} inicializado con {restantes} asientos")
+        elif fila["capacidad"] != capacidad:
+            await self._ajustar_capacidad(evento_id, capacidad)
+        else:
+            # Solo se recuerda lo que ya estaba confirmado en la base de datos
+            self._capacidades[evento_id] = capacidad
+
+    async def _vendidas(self, evento_id: int) -> int:
+        """Asientos de las compras no canceladas del evento"""
+        compras = compras_con_archivo(lambda c: [
+            c.evento_id == evento_id,
+            c.estado.notin_(["cancelado", "expirado"])
+        ])
+        return await database.fetch_val(
+            sqlalchemy.select(
+                sqlalchemy.func.coalesce(sqlalchemy.func.sum(compras.c.cantidad), 0)
+            )
+        )
+
+    async def _ajustar_capacidad(self, evento_id: int, capacidad: int):
+        """
+        Recalcula los asientos disponibles del evento con una nueva capacidad
+
+        Bloquea todos los shards del evento (en orden, como al rebalancear):
+        así las reservas en curso terminan antes de contar las compras.
+        """
+        filas = await database.fetch_all(
+            inventario_table.select().where(
+                inventario_table.c.evento_id == evento_id
+            ).order_by(inventario_table.c.shard).with_for_update()
+        )
+        if not filas or filas[0]["capacidad"] == capacidad:
+            return
+
+        restantes = max(capacidad - await self._vendidas(evento_id), 0)
+        base, extra = divmod(restantes, len(filas))
+        for i, fila in enumerate(filas):
+            await database.execute(
+                inventario_table.update().where(
+                    inventario_table.c.evento_id == evento_id,
+                    inventario_table.c.shard == fila["shard"]
+                ).values(
+                    disponibles=base + (1 if i < extra else 0),
+                    capacidad=capacidad
+                )
+            )
+
+        self.ajustes_capacidad += 1
+        logger.info(
+            f"Capacidad del evento {evento_id} cambiada de {filas[0]['capacidad']} "
+            f"a {capacidad}: {restantes} asientos disponibles"
+        )
+
+    async def disponibles(self, evento_id: int) -> Optional[int]:
+        """
+        Asientos disponibles de un evento (lectura sin bloqueos)
+
+        Returns:
+            Total disponible o None si el inventario no está inicializado
+        """
+        query = sqlalchemy.select(
+            sqlalchemy.func.sum(inventario_table.c.disponibles)
+        ).where(inventario_table.c.evento_id == evento_id)
+        return await database.fetch_val(query)
+
+    async def reservar(self, evento_id: int, cantidad: int):
+        """
+        Descuenta asientos del inventario del evento
+
+        Raises:
+            HTTPException 400 si no hay suficientes asientos
+        """
+        # Primero un shard con asientos que nadie tenga bloqueado
+        if await self._descontar(evento_id, cantidad, esperar=False):
+            self.reservas += 1
+            return
+        self.reintentos += 1
+
+        # Suma sin bloqueos: si ni el total alcanza no hace falta rebalancear
+        disponibles = await self.disponibles(evento_id) or 0
+        if disponibles < cantidad:
+            self._sin_capacidad(disponibles)
+
+        # Hay asientos pero en shards ocupados: se espera a uno de ellos
+        if await self._descontar(evento_id, cantidad, esperar=True):
+            self.reservas += 1
+            return
+
+        if not await self._rebalancear(evento_id, cantidad):
+            self._sin_capacidad(await self.disponibles(evento_id) or 0)
+        self.reservas += 1
+
+    async def _descontar(self, evento_id: int, cantidad: int, esperar: bool) -> bool:
+        """
+        Descuenta la reserva de un shard al azar entre los que tienen asientos
+
+        Con `esperar=False` se saltan los shards bloqueados por otras reservas.
+
+        Returns:
+            True si algún shard tenía asientos suficientes
+        """
+        shard = sqlalchemy.select(inventario_table.c.shard).where(
+            inventario_table.c.evento_id == evento_id,
+            inventario_table.c.disponibles >= cantidad
+        ).order_by(sqlalchemy.func.random()).limit(1).with_for_update(
+            skip_locked=not esperar
+        ).scalar_subquery()
+
+        query = inventario_table.update().where(
+            inventario_table.c.evento_id == evento_id,
+            inventario_table.c.shard == shard,
+            inventario_table.c.disponibles >= cantidad
+        ).values(
+            disponibles=inventario_table.c.disponibles - cantidad
+        ).returning(inventario_table.c.shard)
+
+        return await database.fetch_val(query) is not None
+
+    def _sin_capacidad(self, disponibles: int):
+        self.sin_capacidad += 1
+        raise HTTPException(
+            status_code=400,
+            detail=f"No hay suficiente capacidad (disponible: {disponibles})"
+        )
+
+    async def _rebalancear(self, evento_id: int, cantidad: int) -> bool:
+        """
+        Reparte de nuevo los asientos del evento descontando la reserva
+
+        Bloquea todos los shards del evento (en orden, para evitar deadlocks);
+        solo ocurre cuando los shards individuales se han quedado cortos.
+
+        Returns:
+            True si había asientos suficientes y la reserva quedó aplicada
+        """
+        async with database.transaction():
+            filas = await database.fetch_all(
+                inventario_table.select().where(
+                    inventario_table.c.evento_id == evento_id
+                ).order_by(inventario_table.c.shard).with_for_update()
+            )
+
+            total = sum(fila["disponibles"] for fila in filas)
+            if not filas or total < cantidad:
+                return False
+
+            base, extra = divmod(total - cantidad, len(filas))
+            for i, fila in enumerate(filas):
+                await database.execute(
+                    inventario_table.update().where(
+                        inventario_table.c.evento_id == evento_id,
+                        inventario_table.c.shard == fila["shard"]
+                    ).values(disponibles=base + (1 if i < extra else 0))
+                )
+
+        self.rebalanceos += 1
+        return True
+
+    async def liberar(self, evento_id: int, cantidad: int):
+        """
+        Devuelve asientos al inventario del evento (a uno de sus shards al azar)
+
+        Si el evento aún no tiene inventario no hay nada que devolver: se
+        creará a partir de las compras, donde la cancelada ya no cuenta.
+        """
+        shard = sqlalchemy.select(inventario_table.c.shard).where(
+            inventario_table.c.evento_id == evento_id
+        ).order_by(sqlalchemy.func.random()).limit(1).scalar_subquery()
+
+        query = inventario_table.update().where(
+            inventario_table.c.evento_id == evento_id,
+            inventario_table.c.shard == shard
+        ).values(
+            disponibles=inventario_table.c.disponibles + cantidad
+        ).returning(inventario_table.c.shard)
+
+        if await database.fetch_val(query) is None:
+            self.liberaciones_sin_inventario += 1
+            logger.warning(
+                f"Evento {evento_id} sin inventario: {cantidad} asientos no devueltos"
+            )
+
+    def metricas(self) -> dict:
+        """Contadores de reservas"""
+        return {
+            "shards": self.shards,
+            "reservas": self.reservas,
+            "reintentos": self.reintentos,
+            "rebalanceos": self.rebalanceos,
+            "sin_capacidad": self.sin_capacidad,
+            "ajustes_capacidad": self.ajustes_capacidad,
+            "liberaciones_sin_inventario": self.liberaciones_sin_inventario
+        }
+
+
+inventario_service = InventarioService()
@@ -0,0 +1,223 @@
+"""
+Difusión de los cambios de estado de las compras con LISTEN/NOTIFY
+"""
+import asyncio
+from typing import Dict, Iterable, Optional, Set
+import asyncpg
+import orjson
+import sqlalchemy
+from fastapi import HTTPException
+from sqlalchemy.dialects import postgresql
+from app.config import settings
+from app.database import database
+from app.utils.logger import logger
+
+# Canal de PostgreSQL por el que viajan los cambios de estado
+CANAL = "compras_estado"
+
+# Cada cuánto se comprueba que la conexión LISTEN sigue viva (segundos)
+INTERVALO_COMPROBACION = 30.0
+
+
+def _dsn() -> str:
+    """URL de la base de datos sin el driver de SQLAlchemy (para asyncpg)"""
+    url = sqlalchemy.engine.make_url(settings.database_url).set(drivername="postgresql")
+    return url.render_as_string(hide_password=False)
+
+
+def _carga(compra_id: int, estado: str) -> str:
+    return orjson.dumps({"id": compra_id, "estado": estado}).decode()
+
+
+class Suscripcion:
+    """Un cliente esperando el cambio de estado de una compra"""
+
+    __slots__ = ("compra_id", "estado", "aviso")
+
+    def __init__(self, compra_id: int):
+        self.compra_id = compra_id
+        self.estado: Optional[str] = None
+        self.aviso = asyncio.Event()
+
+    def avisar(self, estado: Optional[str]):
+        """Nuevo estado, o None si hay que releerlo de la base de datos"""
+        self.estado = estado
+        self.aviso.set()
+
+    async def esperar(self, timeout: float) -> bool:
+        """Espera un aviso; False si pasa `timeout` sin ninguno"""
+        try:
+            await asyncio.wait_for(self.aviso.wait(), timeout)
+        except asyncio.TimeoutError:
+            return False
+        self.aviso.clear()
+        return True
+
+
+class NotificacionesEstado:
+    """
+    Reparte los cambios de estado de compras entre los clientes suscritos
+
+    Los cambios se emiten con NOTIFY dentro de la transacción que los hace,
+    así que el aviso solo sale si el cambio se confirma, y llega a todos los
+    workers. Cada worker escucha con una única conexión dedicada y guarda
+    sus suscripciones en memoria: un objeto pequeño por cliente y como mucho
+    `sse_max_conexiones`. Si la conexión LISTEN se pierde, al recuperarla se
+    pide a todos los clientes que relean el estado, porque los avisos de ese
+    intervalo no llegaron.
+    """
+
+    def __init__(self):
+        self.max_conexiones = settings.sse_max_conexiones
+        self.conexion: Optional[asyncpg.Connection] = None
+        self.tarea: Optional[asyncio.Task] = None
+        self.conectado_antes = False
+        self._suscripciones: Dict[int, Set[Suscripcion]] = {}
+        self.activas = 0
+
+        # Métricas
+        self.max_activas = 0
+        self.rechazadas = 0
+        self.notificaciones = 0
+        self.entregadas = 0
+        self.reconexiones = 0
+
+    @property
+    def escuchando(self) -> bool:
+        return self.conexion is not None and not self.conexion.is_closed()
+
+    async def iniciar(self):
+        """Abre la conexión LISTEN en segundo plano (ciclo de vida de la app)"""
+        if self.tarea is None:
+            self.tarea = asyncio.create_task(self._escuchar())
+
+    async def detener(self):
+        """Cierra la conexión LISTEN"""
+        if self.tarea is not None:
+            self.tarea.cancel()
+            try:
+                await self.tarea
+            except asyncio.CancelledError:
+                pass
+            self.tarea = None
+
+    async def _escuchar(self):
+        """Mantiene la conexión LISTEN, reconectando con espera creciente"""
+        espera = 1.0
+        while True:
+            conexion = None
+            try:
+                conexion = await asyncpg.connect(_dsn())
+                perdida = asyncio.Event()
+                conexion.add_termination_listener(lambda _: perdida.set())
+                await conexion.add_listener(CANAL, self._recibir)
+
+                if self.conectado_antes:
+                    self.reconexiones += 1
+                    self._releer_todas()
+                self.conectado_antes = True
+                self.conexion = conexion
+                espera = 1.0
+                logger.info(f"Escuchando cambios de estado de compras (canal {CANAL})")
+
+                while not perdida.is_set():
+                    try:
+                        await asyncio.wait_for(perdida.wait(), INTERVALO_COMPROBACION)
+                    except asyncio.TimeoutError:
+                        await asyncio.wait_for(conexion.execute("SELECT 1"), INTERVALO_COMPROBACION)
+                logger.warning("Conexión LISTEN de estados de compra perdida")
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Error en la conexión LISTEN de estados de compra: {str(e)}")
+            finally:
+                self.conexion = None
+                if conexion is not None and not conexion.is_closed():
+                    conexion.terminate()
+
+            await asyncio.sleep(espera)
+            espera = min(espera * 2, 30.0)
+
+    def _recibir(self, conexion, pid: int, canal: str, carga: str):
+        """Callback de asyncpg: avisa a los suscritos a la compra"""
+        try:
+            datos = orjson.loads(carga)
+            compra_id = int(datos["id"])
+            estado = str(datos["estado"])
+        except (orjson.JSONDecodeError, KeyError, TypeError, ValueError):
+            logger.warning(f"Notificación de estado inválida: {carga[:200]}")
+            return
+
+        self.notificaciones += 1
+        for suscripcion in self._suscripciones.get(compra_id, ()):
+            suscripcion.avisar(estado)
+            self.entregadas += 1
+
+    def _releer_todas(self):
+        for suscripciones in self._suscripciones.values():
+            for suscripcion in suscripciones:
+                suscripcion.avisar(None)
+
+    def suscribir(self, compra_id: int) -> Suscripcion:
+        """
+        Registra un cliente interesado en una compra
+
+        Raises:
+            HTTPException 503 si el worker ya tiene el máximo de suscripciones
+        """
+        if self.activas >= self.max_conexiones:
+            self.rechazadas += 1
+            raise HTTPException(
+                status_code=503,
+                detail="Demasiadas conexiones de seguimiento abiertas",
+                headers={"Retry-After": "5"}
+            )
+
+        suscripcion = Suscripcion(compra_id)
+        self._suscripciones.setdefault(compra_id, set()).add(suscripcion)
+        self.activas += 1
+        self.max_activas = max(self.max_activas, self.activas)
+        return suscripcion
+
+    def cancelar(self, suscripcion: Suscripcion):
+        """Elimina una suscripción (idempotente)"""
+        suscripciones = self._suscripciones.get(suscripcion.compra_id)
+        if suscripciones is None or suscripcion not in suscripciones:
+            return
+        suscripciones.discard(suscripcion)
+        if not suscripciones:
+            del self._suscripciones[suscripcion.compra_id]
+        self.activas -= 1
+
+    async def notificar(self, compra_id: int, estado: str):
+        """Emite el cambio de estado; llamar dentro de la transacción del cambio"""
+        await database.execute(
+            sqlalchemy.select(sqlalchemy.func.pg_notify(CANAL, _carga(compra_id, estado)))
+        )
+
+    async def notificar_varias(self, compra_ids: Iterable[int], estado: str):
+        """Emite el mismo cambio de estado para varias compras en una sentencia"""
+        cargas = [_carga(compra_id, estado) for compra_id in compra_ids]
+        if not cargas:
+            return
+        await database.execute(
+            sqlalchemy.select(sqlalchemy.func.pg_notify(
+                CANAL,
+                sqlalchemy.func.unnest(sqlalchemy.literal(cargas, postgresql.ARRAY(sqlalchemy.Text)))
+            ))
+        )
+
+    def metricas(self) -> dict:
+        """Suscripciones abiertas y avisos repartidos"""
+        return {
+            "escuchando": self.escuchando,
+            "suscripciones": self.activas,
+            "max_suscripciones": self.max_activas,
+            "rechazadas": self.rechazadas,
+            "notificaciones": self.notificaciones,
+            "entregadas": self.entregadas,
+            "reconexiones": self.reconexiones
+        }
+
+
+notificaciones_estado = NotificacionesEstado()
@@ -0,0 +1,130 @@
+"""
+Relay del outbox transaccional hacia RabbitMQ
+"""
+import asyncio
+import time
+from datetime import datetime, timezone
+from typing import Optional
+import sqlalchemy
+from app.config import settings
+from app.database import database, outbox_table
+from app.services.rabbitmq_client import rabbitmq_client
+from app.utils.logger import logger
+
+
+class OutboxRelay:
+    """Publica por lotes los mensajes del outbox y los elimina al confirmarse"""
+
+    def __init__(self):
+        self.tarea: Optional[asyncio.Task] = None
+        self.lote = settings.outbox_lote
+        self.intervalo = settings.outbox_intervalo
+
+        # Métricas
+        self.publicados = 0
+        self.lotes = 0
+        self.errores = 0
+        self.ultimo_lote_segundos = 0.0
+        self.ultimo_lote_mensajes_por_segundo = 0.0
+
+    async def iniciar(self):
+        """Arranca la tarea de fondo (ciclo de vida de la app)"""
+        if self.tarea is None:
+            self.tarea = asyncio.create_task(self._ejecutar())
+            logger.info("Relay de outbox iniciado")
+
+    async def detener(self):
+        """Detiene la tarea de fondo"""
+        if self.tarea is not None:
+            self.tarea.cancel()
+            try:
+                await self.tarea
+            except asyncio.CancelledError:
+                pass
+            self.tarea = None
+            logger.info("Relay de outbox detenido")
+
+    async def _ejecutar(self):
+        """Drena el outbox; espera solo cuando no quedan mensajes pendientes"""
+        while True:
+            try:
+                procesados = await self.procesar_lote()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.errores += 1
+                logger.error(f"Error en relay de outbox: {str(e)}")
+                procesados = 0
+
+            if procesados < self.lote:
+                await asyncio.sleep(self.intervalo)
+
+    async def procesar_lote(self, filtro=None) -> int:
+        """
+        Publica un lote de mensajes pendientes
+
+        Las filas se bloquean con FOR UPDATE SKIP LOCKED, de modo que varios
+        workers pueden drenar el outbox a la vez sin publicar dos veces el
+        mismo mensaje. Si la publicación falla la transacción se revierte y
+        los mensajes se reintentan en el siguiente ciclo.
+
+        Args:
+            filtro: Condición adicional sobre `outbox` (p. ej. para drenar
+                solo los mensajes de los benchmarks); por defecto, todos
+
+        Returns:
+            Número de mensajes publicados
+        """
+        inicio = time.perf_counter()
+
+        async with database.transaction():
+            query = outbox_table.select().order_by(
+                outbox_table.c.id
+            ).limit(self.lote).with_for_update(skip_locked=True)
+            if filtro is not None:
+                query = query.where(filtro)
+            filas = await database.fetch_all(query)
+
+            if not filas:
+                return 0
+
+            await rabbitmq_client.publicar_lote([fila["payload"] for fila in filas])
+
+            await database.execute(
+                outbox_table.delete().where(
+                    outbox_table.c.id.in_([fila["id"] for fila in filas])
+                )
+            )
+
+        duracion = time.perf_counter() - inicio
+        self.lotes += 1
+        self.publicados += len(filas)
+        self.ultimo_lote_segundos = round(duracion, 4)
+        self.ultimo_lote_mensajes_por_segundo = round(len(filas) / duracion, 2) if duracion else 0.0
+        return len(filas)
+
+    async def metricas(self) -> dict:
+        """Lag (pendientes y antigüedad del más viejo) y throughput del relay"""
+        query = sqlalchemy.select(
+            sqlalchemy.func.count().label("pendientes"),
+            sqlalchemy.func.min(outbox_table.c.creado_en).label("mas_antiguo")
+        ).select_from(outbox_table)
+        fila = await database.fetch_one(query)
+        pendientes, mas_antiguo = fila["pendientes"], fila["mas_antiguo"]
+
+        lag_segundos = 0.0
+        if mas_antiguo is not None:
+            lag_segundos = round((datetime.now(timezone.utc) - mas_antiguo).total_seconds(), 3)
+
+        return {
+            "pendientes": pendientes,
+            "lag_segundos": lag_segundos,
+            "publicados": self.publicados,
+            "lotes": self.lotes,
+            "errores": self.errores,
+            "ultimo_lote_segundos": self.ultimo_lote_segundos,
+            "ultimo_lote_mensajes_por_segundo": self.ultimo_lote_mensajes_por_segundo
+        }
+
+
+outbox_relay = OutboxRelay()
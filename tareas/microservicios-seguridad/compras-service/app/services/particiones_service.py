@@ -0,0 +1,331 @@
+"""
+Mantenimiento de las particiones mensuales de compras y de su archivo
+"""
+import asyncio
+import re
+import time
+from contextlib import asynccontextmanager
+from datetime import date, datetime, timezone
+from typing import List, Optional
+import asyncpg
+import sqlalchemy
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from app.config import settings
+from app.database import (
+    compras_archivo_table,
+    database,
+    ddl_crear_particion,
+    nombre_particion
+)
+from app.utils.logger import logger
+
+# Clave del advisory lock del mantenimiento (un único worker a la vez)
+LOCK_PARTICIONES = 7_302_003
+
+_PATRON_PARTICION = re.compile(r"^compras_p(\d{4})_(\d{2})$")
+
+# Estados de una tabla de partición respecto a `compras`
+ADJUNTA = "adjunta"
+SEPARANDO = "separando"
+SEPARADA = "separada"
+
+
+def _sumar_meses(mes: date, meses: int) -> date:
+    """Primer día del mes `meses` meses después (o antes) de `mes`"""
+    indice = mes.year * 12 + mes.month - 1 + meses
+    return date(indice // 12, indice % 12 + 1, 1)
+
+
+def _mes_actual() -> date:
+    """Primer día del mes en curso (UTC, como los límites de las particiones)"""
+    hoy = datetime.now(timezone.utc)
+    return date(hoy.year, hoy.month, 1)
+
+
+class ParticionesService:
+    """
+    Crea las particiones futuras de `compras` y archiva las antiguas
+
+    Siempre existen las particiones del mes actual y de los `meses_futuros`
+    siguientes, de modo que ninguna compra nueva se queda sin partición. Ningún
+    paso pide un lock que deje en cola a las compras:
+
+    - Las particiones nuevas se crean sueltas y se adjuntan con ATTACH
+      PARTITION.
+    - Las de más de `meses_calientes` meses se copian a `compras_archivo` en
+      su propia transacción, se separan con DETACH PARTITION CONCURRENTLY
+      (PostgreSQL 14+) fuera de cualquier transacción y solo entonces se
+      borran. Entre la copia y el DETACH (normalmente segundos) las compras
+      de esa partición están en los dos niveles; son compras ya cerradas de
+      hace más de un año.
+
+    Cada DDL espera a sus locks como mucho `particiones_lock_timeout_ms` y
+    se reintenta con espera creciente; si no lo consigue, queda para la
+    siguiente pasada. Un archivado interrumpido se retoma donde se quedó.
+    """
+
+    def __init__(self):
+        self.tarea: Optional[asyncio.Task] = None
+        self.meses_futuros = settings.particiones_meses_futuros
+        self.meses_calientes = settings.particiones_meses_calientes
+        self.intervalo = settings.particiones_intervalo
+        self.reintentos_ddl = settings.particiones_reintentos_ddl
+
+        # Métricas
+        self.creadas = 0
+        self.archivadas = 0
+        self.errores = 0
+        self.esperas_lock = 0
+        self.ultimo_archivado: Optional[dict] = None
+        self.ultimo_mantenimiento: Optional[datetime] = None
+
+    async def iniciar(self):
+        """Arranca el mantenimiento periódico (ciclo de vida de la app)"""
+        if self.tarea is None:
+            self.tarea = asyncio.create_task(self._ejecutar())
+
+    async def detener(self):
+        """Detiene el mantenimiento periódico"""
+        if self.tarea is not None:
+            self.tarea.cancel()
+            try:
+                await self.tarea
+            except asyncio.CancelledError:
+                pass
+            self.tarea = None
+
+    async def _ejecutar(self):
+        """Mantiene las particiones al arrancar y cada `intervalo` segundos"""
+        while True:
+            try:
+                await self.mantener()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.errores += 1
+                logger.error(f"Error en el mantenimiento de particiones: {str(e)}")
+
+            await asyncio.sleep(self.intervalo)
+
+    async def mantener(self) -> Optional[dict]:
+        """
+        Crea las particiones que falten y archiva las antiguas
+
+        Returns:
+            dict con particiones creadas y archivadas, o None si otro worker
+            ya está manteniéndolas
+        """
+        async with self._bloqueo() as bloqueado:
+            if not bloqueado:
+                return None
+
+            creadas = await self.crear_particiones()
+            archivadas = 0
+            for nombre in await self.particiones_a_archivar():
+                if await self.archivar(nombre):
+                    archivadas += 1
+
+        self.ultimo_mantenimiento = datetime.now()
+        return {"creadas": creadas, "archivadas": archivadas}
+
+    async def crear_particiones(self) -> Optional[int]:
+        """
+        Crea y adjunta las particiones del mes actual y los siguientes que falten
+
+        Returns:
+            Número de particiones creadas, o None si otro worker tiene el lock
+        """
+        mes = _mes_actual()
+        creadas = 0
+        async with self._bloqueo() as bloqueado:
+            if not bloqueado:
+                return None
+
+            for i in range(self.meses_futuros + 1):
+                inicio = _sumar_meses(mes, i)
+                nombre = nombre_particion(inicio)
+                if await self._estado(nombre) == ADJUNTA:
+                    continue
+
+                crear, adjuntar = ddl_crear_particion(inicio, _sumar_meses(inicio, 1))
+                for sentencia in crear:
+                    await database.execute(sentencia)
+                if not await self._ddl(adjuntar):
+                    logger.warning(f"Partición {nombre} sin adjuntar: `compras` sigue ocupada")
+                    continue
+                logger.info(f"Partición {nombre} creada")
+                creadas += 1
+
+        self.creadas += creadas
+        return creadas
+
+    async def particiones_a_archivar(self) -> List[str]:
+        """
+        Particiones anteriores a los meses calientes, de la más antigua a la más nueva
+
+        Incluye las que quedaron separadas o a medio separar por un archivado
+        interrumpido.
+        """
+        frontera = _sumar_meses(_mes_actual(), -(self.meses_calientes - 1))
+        filas = await database.fetch_all(sqlalchemy.text(
+            "SELECT relname FROM pg_class "
+            "WHERE relkind = 'r' AND relname ~ '^compras_p[0-9]{4}_[0-9]{2}$' "
+            "AND pg_table_is_visible(oid)"
+        ))
+
+        antiguas = []
+        for fila in filas:
+            coincidencia = _PATRON_PARTICION.match(fila["relname"])
+            if coincidencia is None:
+                continue
+            mes = date(int(coincidencia.group(1)), int(coincidencia.group(2)), 1)
+            if mes < frontera:
+                antiguas.append((mes, fila["relname"]))
+        return [nombre for _, nombre in sorted(antiguas)]
+
+    async def archivar(self, nombre: str) -> bool:
+        """
+        Mueve una partición a `compras_archivo`
+
+        Las filas se insertan ordenadas por usuario, así que el historial de
+        cada usuario queda en pocas páginas del archivo. Una partición que aún
+        tiene compras pendientes no se archiva: la expiración solo recorre
+        `compras`.
+
+        Returns:
+            True si la partición se archivó
+        """
+        columnas = [c.name for c in compras_archivo_table.c]
+        particion = sqlalchemy.table(nombre, *(sqlalchemy.column(c) for c in columnas))
+        inicio = time.perf_counter()
+
+        async with self._bloqueo() as bloqueado:
+            if not bloqueado:
+                return False
+            estado = await self._estado(nombre)
+            if estado is None:
+                return False
+
+            if estado == ADJUNTA:
+                pendientes = await database.fetch_val(
+                    sqlalchemy.select(sqlalchemy.exists().where(particion.c.estado == "pendiente"))
+                )
+                if pendientes:
+                    logger.warning(f"La partición {nombre} aún tiene compras pendientes, no se archiva")
+                    return False
+
+            # 1. Copia, en su propia transacción (sin locks sobre `compras`)
+            async with database.transaction():
+                await self._copiar(particion, columnas)
+
+            # 2. Separación sin bloquear lecturas ni escrituras (no admite
+            #    transacción); FINALIZE completa una que se interrumpió
+            if estado == ADJUNTA:
+                await database.execute(f"ALTER TABLE compras DETACH PARTITION {nombre} CONCURRENTLY")
+            elif estado == SEPARANDO:
+                await database.execute(f"ALTER TABLE compras DETACH PARTITION {nombre} FINALIZE")
+
+            # 3. Lo que cambió desde la copia, y borrado de la tabla ya suelta
+            async with database.transaction():
+                await self._copiar(particion, columnas)
+                await database.execute(f"DROP TABLE {nombre}")
+
+        duracion_ms = (time.perf_counter() - inicio) * 1000
+        self.archivadas += 1
+        self.ultimo_archivado = {"particion": nombre, "duracion_ms": round(duracion_ms, 3)}
+        logger.info(f"Partición {nombre} archivada en {duracion_ms:.1f} ms")
+        return True
+
+    @staticmethod
+    async def _copiar(particion, columnas: List[str]):
+        """Upsert de la partición en el archivo (solo reescribe las filas que cambiaron)"""
+        archivo = compras_archivo_table
+        insert = pg_insert(archivo).from_select(
+            columnas,
+            sqlalchemy.select(*particion.c).order_by(
+                particion.c.usuario_id,
+                particion.c.fecha_compra,
+                particion.c.id
+            )
+        )
+        await database.execute(
+            insert.on_conflict_do_update(
+                index_elements=[archivo.c.id],
+                set_={c: insert.excluded[c] for c in columnas if c != "id"},
+                where=archivo.c.actualizado_en.is_distinct_from(insert.excluded.actualizado_en)
+            )
+        )
+
+    @asynccontextmanager
+    async def _bloqueo(self):
+        """
+        Advisory lock de sesión del mantenimiento (un único worker a la vez)
+
+        Se mantiene la conexión durante todo el bloque, porque el DETACH
+        CONCURRENTLY no puede ir dentro de una transacción. El lock es
+        reentrante en la misma conexión.
+        """
+        async with database.connection():
+            bloqueado = await database.fetch_val(
+                sqlalchemy.select(sqlalchemy.func.pg_try_advisory_lock(LOCK_PARTICIONES))
+            )
+            try:
+                yield bloqueado
+            finally:
+                if bloqueado:
+                    await database.execute(
+                        sqlalchemy.select(sqlalchemy.func.pg_advisory_unlock(LOCK_PARTICIONES))
+                    )
+
+    async def _ddl(self, sentencia: str) -> bool:
+        """
+        Ejecuta un DDL esperando a sus locks como mucho `lock_timeout`
+
+        Returns:
+            True si se ejecutó, False si tras los reintentos seguía sin locks
+        """
+        for intento in range(self.reintentos_ddl):
+            try:
+                async with database.transaction():
+                    await database.execute(
+                        f"SET LOCAL lock_timeout = {int(settings.particiones_lock_timeout_ms)}"
+                    )
+                    await database.execute(sentencia)
+                return True
+            except asyncpg.exceptions.LockNotAvailableError:
+                self.esperas_lock += 1
+                await asyncio.sleep(min(0.05 * 2 ** intento, 5.0))
+        return False
+
+    @staticmethod
+    async def _estado(nombre: str) -> Optional[str]:
+        """ADJUNTA, SEPARANDO (DETACH CONCURRENTLY a medias), SEPARADA o None si no existe"""
+        fila = await database.fetch_one(
+            sqlalchemy.text(
+                "SELECT to_regclass(:nombre) IS NOT NULL AS existe, "
+                "(SELECT i.inhdetachpending FROM pg_inherits i "
+                " WHERE i.inhrelid = to_regclass(:nombre) "
+                " AND i.inhparent = 'compras'::regclass) AS pendiente"
+            ).bindparams(nombre=nombre)
+        )
+        if not fila["existe"]:
+            return None
+        if fila["pendiente"] is None:
+            return SEPARADA
+        return SEPARANDO if fila["pendiente"] else ADJUNTA
+
+    def metricas(self) -> dict:
+        """Particiones creadas y archivadas"""
+        return {
+            "creadas": self.creadas,
+            "archivadas": self.archivadas,
+            "errores": self.errores,
+            "esperas_lock": self.esperas_lock,
+            "ultimo_archivado": self.ultimo_archivado,
+            "ultimo_mantenimiento": (
+                self.ultimo_mantenimiento.isoformat() if self.ultimo_mantenimiento else None
+            )
+        }
+
+
+particiones_service = ParticionesService()
@@ -1,66 +1,166 @@
 """
 Cliente RabbitMQ para publicar mensajes de notificación
 """
-import json
+import asyncio
 import aio_pika
-from typing import Optional
+import orjson
+from contextlib import asynccontextmanager
+from pamqp.commands import Basic
+from typing import AsyncIterator, List, Optional
 from app.config import settings
 from app.utils.logger import logger
 
 
 class RabbitMQClient:
     """Cliente para publicar mensajes en RabbitMQ"""
-    
+
     def __init__(self):
-        self.connection: Optional[aio_pika.Connection] = None
-        self.channel: Optional[aio_pika.Channel] = None
+        self.connection: Optional[aio_pika.abc.AbstractRobustConnection] = None
+        # Pool de canales con publisher confirms: los libres esperan en la
+        # cola y el semáforo limita cuántos hay prestados a la vez
+        self._canales: "asyncio.LifoQueue[aio_pika.abc.AbstractChannel]" = asyncio.LifoQueue()
+        self._cupo_canales: Optional[asyncio.Semaphore] = None
         self.queue_name = settings.rabbitmq_queue
-    
+        self._lock = asyncio.Lock()
+
+        # Métricas
+        self.publicados = 0
+        self.lotes = 0
+        self.rechazados = 0
+        self.errores = 0
+        self.canales_descartados = 0
+
     async def conectar(self):
-        """Conecta a RabbitMQ"""
-        try:
-            self.connection = await aio_pika.connect_robust(settings.rabbitmq_url)
-            self.channel = await self.connection.channel()
-            
-            # Declarar cola (asegura que existe)
-            await self.channel.declare_queue(self.queue_name, durable=True)
-            
-            logger.info(f"Conectado a RabbitMQ - Cola: {self.queue_name}")
-        except Exception as e:
-            logger.error(f"Error al conectar a RabbitMQ: {str(e)}")
-            raise
-    
+        """Conecta a RabbitMQ (varias llamadas concurrentes conectan una sola vez)"""
+        async with self._lock:
+            if self._cupo_canales is not None:
+                return
+
+            try:
+                self.connection = await aio_pika.connect_robust(settings.rabbitmq_url)
+
+                # Declarar cola (asegura que existe)
+                channel = await self.connection.channel()
+                await channel.declare_queue(self.queue_name, durable=True)
+                await channel.close()
+
+                # Pool de canales para publicadores concurrentes
+                self._cupo_canales = asyncio.Semaphore(settings.rabbitmq_canales)
+
+                logger.info(f"Conectado a RabbitMQ - Cola: {self.queue_name}")
+            except Exception as e:
+                logger.error(f"Error al conectar a RabbitMQ: {str(e)}")
+                raise
+
+    async def _crear_canal(self) -> aio_pika.abc.AbstractChannel:
+        """Crea un canal en modo publisher confirms"""
+        return await self.connection.channel(publisher_confirms=True)
+
+    @asynccontextmanager
+    async def _canal(self) -> AsyncIterator[aio_pika.abc.AbstractChannel]:
+        """
+        Presta un canal del pool
+
+        Los canales que el broker cerró (p. ej. por un error de canal) se
+        descartan al sacarlos o devolverlos y se sustituyen por uno nuevo.
+        """
+        async with self._cupo_canales:
+            canal = None
+            while not self._canales.empty():
+                canal = self._canales.get_nowait()
+                if not canal.is_closed:
+                    break
+                self.canales_descartados += 1
+                canal = None
+
+            if canal is None:
+                canal = await self._crear_canal()
+
+            try:
+                yield canal
+            finally:
+                if canal.is_closed:
+                    self.canales_descartados += 1
+                else:
+                    self._canales.put_nowait(canal)
+
     async def publicar_mensaje(self, mensaje: dict):
         """
         Publica un mensaje en la cola
-        
+
         Args:
             mensaje: Diccionario con los datos a enviar
         """
-        if not self.channel:
+        await self.publicar_lote([mensaje])
+
+    async def publicar_lote(self, mensajes: List[dict]):
+        """
+        Publica varios mensajes en la cola y espera sus confirmaciones
+
+        Los mensajes se envían sin esperar uno a uno; las confirmaciones del
+        broker se esperan en conjunto al final.
+
+        Args:
+            mensajes: Lista de diccionarios con los datos a enviar
+
+        Raises:
+            Exception si algún mensaje no se pudo publicar o fue rechazado
+        """
+        if not mensajes:
+            return
+
+        if self._cupo_canales is None:
             await self.conectar()
-        
+
         try:
-            mensaje_json = json.dumps(mensaje)
-            
-            await self.channel.default_exchange.publish(
-                aio_pika.Message(
-                    body=mensaje_json.encode(),
-                    delivery_mode=aio_pika.DeliveryMode.PERSISTENT  # Mensaje persistente
-                ),
-                routing_key=self.queue_name
-            )
-            
-            logger.info(f"Mensaje publicado en RabbitMQ: {mensaje_json}")
+            async with self._canal() as channel:
+                confirmaciones = await asyncio.gather(*(
+                    channel.default_exchange.publish(
+                        aio_pika.Message(
+                            body=orjson.dumps(mensaje),
+                            content_type="application/json",
+                            delivery_mode=aio_pika.DeliveryMode.PERSISTENT  # Mensaje persistente
+                        ),
+                        routing_key=self.queue_name,
+                        timeout=settings.rabbitmq_confirm_timeout
+                    )
+                    for mensaje in mensajes
+                ))
+
+            rechazados = sum(1 for c in confirmaciones if isinstance(c, Basic.Nack))
+            if rechazados:
+                self.rechazados += rechazados
+                raise RuntimeError(f"RabbitMQ rechazó {rechazados} de {len(mensajes)} mensajes")
+
+            self.publicados += len(mensajes)
+            self.lotes += 1
+            logger.info(f"{len(mensajes)} mensaje(s) publicados en RabbitMQ")
         except Exception as e:
+            self.errores += 1
             logger.error(f"Error al publicar mensaje: {str(e)}")
             raise
-    
+
+    def metricas(self) -> dict:
+        """Contadores de publicación"""
+        return {
+            "publicados": self.publicados,
+            "lotes": self.lotes,
+            "rechazados": self.rechazados,
+            "errores": self.errores,
+            "canales_descartados": self.canales_descartados
+        }
+
     async def cerrar(self):
         """Cierra la conexión"""
+        self._cupo_canales = None
+        while not self._canales.empty():
+            canal = self._canales.get_nowait()
+            if not canal.is_closed:
+                await canal.close()
+
         if self.connection:
             await self.connection.close()
             logger.info("Conexión a RabbitMQ cerrada")
 
 
-rabbitmq_client = RabbitMQClient()
\ No newline at end of file
+rabbitmq_client = RabbitMQClient()
@@ -1 +1,200 @@
-# Cliente HTTP para servicio de Usuarios
\ No newline at end of file
+"""
+Cliente HTTP para el servicio de Usuarios (Node.js)
+"""
+import asyncio
+from typing import Dict, Iterable, List, Optional, Set
+import httpx
+from app.config import settings
+from app.utils.cache import TTLCache
+from app.utils.logger import logger
+
+
+class UsuariosClient:
+    """
+    Cliente para consultar perfiles en el servicio de Usuarios
+
+    Al estilo DataLoader: los ids pedidos en la misma vuelta del event loop
+    se acumulan y salen juntos en una sola petición por lotes
+    (`GET /api/v1/users/batch`, hasta `usuarios_lote_max` ids cada una). Un
+    id que ya está pendiente o en vuelo comparte esa petición. Los usuarios
+    encontrados se cachean `usuarios_cache_ttl` segundos y los que no existen
+    (o están inactivos) `usuarios_cache_ttl_negativo`; los errores no se
+    cachean.
+    """
+
+    def __init__(self):
+        self.base_url = settings.usuarios_service_url
+        self.client: Optional[httpx.AsyncClient] = None
+        self.cache = TTLCache(settings.usuarios_cache_max, settings.usuarios_cache_ttl)
+        self._pendientes: Dict[str, asyncio.Future] = {}
+        self._en_vuelo: Dict[str, asyncio.Future] = {}
+        self._programado = False
+        self._tareas: Set[asyncio.Task] = set()
+
+        # Métricas
+        self.peticiones = 0
+        self.ids_pedidos = 0
+        self.compartidas = 0
+        self.errores = 0
+
+    def _crear_cliente(self) -> httpx.AsyncClient:
+        """Crea el cliente HTTP compartido con keep-alive"""
+        limits = httpx.Limits(
+            max_connections=settings.usuarios_pool_max_conexiones,
+            max_keepalive_connections=settings.usuarios_pool_max_keepalive,
+            keepalive_expiry=settings.usuarios_keepalive_expiry
+        )
+        return httpx.AsyncClient(
+            base_url=self.base_url,
+            limits=limits,
+            timeout=httpx.Timeout(
+                settings.usuarios_timeout,
+                connect=settings.usuarios_connect_timeout,
+                pool=settings.usuarios_pool_timeout
+            )
+        )
+
+    async def iniciar(self):
+        """Abre el cliente HTTP compartido (ciclo de vida de la app)"""
+        if self.client is None:
+            self.client = self._crear_cliente()
+            logger.info(f"Cliente de Usuarios iniciado - {self.base_url}")
+
+    async def cerrar(self):
+        """
+        Cierra el cliente HTTP y sus conexiones
+
+        Antes cancela los lotes en curso y espera a que terminen: quienes los
+        esperaban reciben None (como si Usuarios no respondiera) y ningún lote
+        usa el cliente después de cerrarlo.
+        """
+        pendientes, self._pendientes = self._pendientes, {}
+        for futuro in pendientes.values():
+            if not futuro.done():
+                futuro.set_result(None)
+
+        tareas = list(self._tareas)
+        for tarea in tareas:
+            tarea.cancel()
+        await asyncio.gather(*tareas, return_exceptions=True)
+
+        if self.client is not None:
+            await self.client.aclose()
+            self.client = None
+            logger.info("Cliente de Usuarios cerrado")
+
+    def metricas(self) -> dict:
+        """Peticiones por lotes y uso de la caché de usuarios"""
+        return {
+            "cache": self.cache.metricas(),
+            "peticiones": self.peticiones,
+            "ids_por_peticion": round(self.ids_pedidos / self.peticiones, 2) if self.peticiones else 0.0,
+            "consultas_compartidas": self.compartidas,
+            "errores": self.errores
+        }
+
+    async def get_usuario(self, usuario_id: str) -> Optional[dict]:
+        """
+        Obtiene un usuario por ID (con caché y agrupación por lotes)
+
+        Args:
+            usuario_id: ID del usuario
+
+        Returns:
+            dict con el perfil (sin contraseña) o None si no existe, está
+            inactivo o Usuarios no responde
+        """
+        encontrado, usuario = self.cache.get(usuario_id)
+        if encontrado:
+            return usuario
+
+        # shield: cancelar a un llamador no cancela la consulta compartida
+        return await asyncio.shield(self._encolar(usuario_id))
+
+    async def get_usuarios(self, usuario_ids: Iterable[str]) -> Dict[str, Optional[dict]]:
+        """
+        Obtiene varios usuarios (los que falten en caché, en una petición)
+
+        Args:
+            usuario_ids: IDs de los usuarios (se ignoran duplicados)
+
+        Returns:
+            dict usuario_id -> usuario (o None si no existe)
+        """
+        ids = list(dict.fromkeys(usuario_ids))
+        usuarios = await asyncio.gather(*(self.get_usuario(usuario_id) for usuario_id in ids))
+        return dict(zip(ids, usuarios))
+
+    def _encolar(self, usuario_id: str) -> asyncio.Future:
+        """Futuro con el usuario; programa el envío del lote al final de esta vuelta"""
+        futuro = self._pendientes.get(usuario_id) or self._en_vuelo.get(usuario_id)
+        if futuro is not None:
+            self.compartidas += 1
+            return futuro
+
+        loop = asyncio.get_running_loop()
+        futuro = loop.create_future()
+        self._pendientes[usuario_id] = futuro
+        if not self._programado:
+            self._programado = True
+            loop.call_soon(self._despachar)
+        return futuro
+
+    def _despachar(self):
+        """Envía los ids acumulados en lotes de `usuarios_lote_max`"""
+        self._programado = False
+        pendientes, self._pendientes = self._pendientes, {}
+        self._en_vuelo.update(pendientes)
+
+        ids = list(pendientes)
+        for inicio in range(0, len(ids), settings.usuarios_lote_max):
+            tarea = asyncio.create_task(self._cargar_lote(ids[inicio:inicio + settings.usuarios_lote_max]))
+            self._tareas.add(tarea)
+            tarea.add_done_callback(self._tareas.discard)
+
+    async def _cargar_lote(self, ids: List[str]):
+        """Consulta un lote, actualiza la caché y resuelve los futuros"""
+        usuarios = None
+        try:
+            usuarios = await self._pedir_lote(ids)
+        except Exception as e:
+            self.errores += 1
+            logger.error(f"Error de conexión con servicio de Usuarios: {str(e)}")
+        finally:
+            for usuario_id in ids:
+                usuario = usuarios.get(usuario_id) if usuarios is not None else None
+                if usuarios is not None:
+                    ttl = None if usuario is not None else settings.usuarios_cache_ttl_negativo
+                    self.cache.set(usuario_id, usuario, ttl)
+
+                futuro = self._en_vuelo.pop(usuario_id)
+                if not futuro.done():
+                    futuro.set_result(usuario)
+
+    async def _pedir_lote(self, ids: List[str]) -> Optional[Dict[str, dict]]:
+        """
+        GET por lotes sobre el pool compartido
+
+        Returns:
+            dict usuario_id -> usuario con los encontrados, o None si el
+            servicio respondió con error
+        """
+        if self.client is None:
+            await self.iniciar()
+
+        self.peticiones += 1
+        self.ids_pedidos += len(ids)
+        response = await self.client.get("/api/v1/users/batch", params={"ids": ",".join(ids)})
+
+        if response.status_code != 200:
+            self.errores += 1
+            logger.error(f"Error al obtener usuarios por lote: {response.status_code}")
+            return None
+
+        return {
+            str(usuario.get("_id", usuario.get("id"))): usuario
+            for usuario in response.json().get("users", [])
+        }
+
+
+usuarios_client = UsuariosClient()
@@ -0,0 +1,92 @@
+"""
+Arranque en producción con varios workers
+
+    python -m app.servidor
+"""
+import os
+import random
+from socket import socket
+from typing import List, Optional
+import uvicorn
+from uvicorn.supervisors import Multiprocess
+from app.config import settings
+from app.utils.logger import detener_logging, logger
+
+
+def numero_workers() -> int:
+    """Workers configurados, o uno por CPU disponible para el proceso"""
+    if settings.servidor_workers > 0:
+        return settings.servidor_workers
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+class ServidorWorker(uvicorn.Server):
+    """
+    Servidor de un worker con su propio límite de peticiones
+
+    Cada worker desplaza `servidor_max_peticiones` al azar hasta
+    `servidor_max_peticiones_variacion` (en proporción): con el mismo límite
+    todos recibirían un reparto parecido de peticiones y se reiniciarían a la
+    vez, dejando el servicio sin workers que atiendan.
+    """
+
+    def run(self, sockets: Optional[List[socket]] = None) -> None:
+        limite = self.config.limit_max_requests
+        if limite:
+            margen = int(limite * settings.servidor_max_peticiones_variacion)
+            self.config.limit_max_requests = max(limite + random.randint(-margen, margen), 1)
+        super().run(sockets=sockets)
+
+
+def main():
+    """
+    Lanza uvicorn con N workers, uvloop y httptools
+
+    La configuración se valida aquí, antes de crear los workers, así que un
+    error en ella detiene el arranque una sola vez. El proceso principal
+    abre el socket y lo comparte; cada worker importa la aplicación y abre
+    sus propios pools (PostgreSQL, RabbitMQ, HTTP, LISTEN) en el lifespan,
+    de modo que nada se hereda entre procesos. Al apagarse, los workers
+    dejan de aceptar conexiones y esperan a las peticiones en curso hasta
+    `servidor_timeout_apagado`. Un worker que llega a
+    `servidor_max_peticiones` (± la variación de cada worker) se apaga igual
+    y el supervisor lo sustituye (con un único worker, el proceso termina y
+    lo reinicia el orquestador).
+    """
+    workers = numero_workers()
+    logger.info(
+        f"Iniciando {settings.app_name} con {workers} workers en el puerto {settings.port} "
+        f"(hasta {workers * settings.db_pool_max} conexiones a PostgreSQL)"
+    )
+
+    config = uvicorn.Config(
+        "app.main:app",
+        host="0.0.0.0",
+        port=settings.port,
+        workers=workers,
+        loop="uvloop",
+        http="httptools",
+        backlog=settings.servidor_backlog,
+        timeout_keep_alive=settings.servidor_keep_alive,
+        timeout_graceful_shutdown=settings.servidor_timeout_apagado,
+        limit_max_requests=settings.servidor_max_peticiones or None
+    )
+    servidor = ServidorWorker(config=config)
+
+    # Como uvicorn.run, pero cada worker arranca su propio ServidorWorker
+    # (se copia al proceso hijo) y sortea ahí su límite de peticiones
+    try:
+        if config.workers > 1:
+            Multiprocess(config, target=servidor.run, sockets=[config.bind_socket()]).run()
+        else:
+            servidor.run()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        detener_logging()
+
+
+if __name__ == "__main__":
+    main()
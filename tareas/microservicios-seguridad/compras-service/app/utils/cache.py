@@ -0,0 +1,132 @@
+"""
+Caché en memoria con TTL + LRU y deduplicación de peticiones concurrentes
+"""
+import asyncio
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Hashable, Optional, Tuple
+
+
+class TTLCache:
+    """
+    Caché LRU acotada con expiración por entrada
+
+    Es segura entre hilos: las dependencias síncronas de FastAPI (como
+    verify_jwt) se ejecutan en el threadpool y comparten la caché.
+    """
+
+    def __init__(self, max_entradas: int, ttl: float):
+        self.max_entradas = max_entradas
+        self.ttl = ttl
+        self._datos: "OrderedDict[Hashable, Tuple[float, Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+        # Métricas
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expiraciones = 0
+
+    def get(self, clave: Hashable) -> Tuple[bool, Any]:
+        """
+        Busca una clave en la caché
+
+        Returns:
+            (encontrado, valor)
+        """
+        with self._lock:
+            entrada = self._datos.get(clave)
+            if entrada is None:
+                self.misses += 1
+                return False, None
+
+            expira_en, valor = entrada
+            if expira_en <= time.monotonic():
+                del self._datos[clave]
+                self.expiraciones += 1
+                self.misses += 1
+                return False, None
+
+            self._datos.move_to_end(clave)
+            self.hits += 1
+            return True, valor
+
+    def set(self, clave: Hashable, valor: Any, ttl: Optional[float] = None):
+        """Guarda un valor con el TTL indicado (o el de la caché)"""
+        ttl = self.ttl if ttl is None else ttl
+        if ttl <= 0:
+            return
+
+        with self._lock:
+            self._datos[clave] = (time.monotonic() + ttl, valor)
+            self._datos.move_to_end(clave)
+
+            while len(self._datos) > self.max_entradas:
+                self._datos.popitem(last=False)
+                self.evictions += 1
+
+    def invalidar(self, clave: Hashable):
+        """Elimina una clave de la caché"""
+        with self._lock:
+            self._datos.pop(clave, None)
+
+    def limpiar(self):
+        """Vacía la caché"""
+        with self._lock:
+            self._datos.clear()
+
+    def __len__(self) -> int:
+        return len(self._datos)
+
+    def metricas(self) -> dict:
+        """Contadores de uso de la caché"""
+        total = self.hits + self.misses
+        return {
+            "entradas": len(self._datos),
+            "max_entradas": self.max_entradas,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / total, 4) if total else 0.0,
+            "evictions": self.evictions,
+            "expiraciones": self.expiraciones
+        }
+
+
+class SingleFlight:
+    """
+    Agrupa llamadas concurrentes con la misma clave en una sola ejecución
+
+    fn corre en una tarea propia y todos los llamadores (también el primero)
+    la esperan con shield: si un cliente se desconecta solo se cancela su
+    espera, no la ejecución compartida ni la del resto.
+    """
+
+    def __init__(self):
+        self._en_curso: Dict[Hashable, asyncio.Task] = {}
+        self.compartidas = 0
+
+    async def do(self, clave: Hashable, fn: Callable[[], Awaitable[Any]]) -> Any:
+        """Ejecuta fn una sola vez por clave; el resto espera el mismo resultado"""
+        tarea = self._en_curso.get(clave)
+        if tarea is not None:
+            self.compartidas += 1
+        else:
+            tarea = asyncio.create_task(fn())
+            self._en_curso[clave] = tarea
+            tarea.add_done_callback(lambda t: self._terminar(clave, t))
+        return await asyncio.shield(tarea)
+
+    async def cancelar(self):
+        """Cancela las ejecuciones en curso y espera a que terminen (al cerrar)"""
+        tareas = list(self._en_curso.values())
+        for tarea in tareas:
+            tarea.cancel()
+        await asyncio.gather(*tareas, return_exceptions=True)
+
+    def _terminar(self, clave: Hashable, tarea: asyncio.Task):
+        if self._en_curso.get(clave) is tarea:
+            del self._en_curso[clave]
+        # Evita el aviso de excepción no recuperada si todos dejaron de esperar
+        if not tarea.cancelled():
+            tarea.exception()
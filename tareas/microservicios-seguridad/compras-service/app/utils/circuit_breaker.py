@@ -0,0 +1,183 @@
+"""
+Circuit breaker para dependencias HTTP y registro de datos servidos obsoletos
+"""
+import time
+from collections import deque
+from contextvars import ContextVar
+from typing import Deque, Dict, Optional, Set, Tuple
+from app.utils.logger import logger
+
+CERRADO = "cerrado"
+ABIERTO = "abierto"
+SEMIABIERTO = "semiabierto"
+
+
+class CircuitoAbiertoError(Exception):
+    """La llamada se rechazó sin intentarla porque el circuito está abierto"""
+
+
+class CircuitBreaker:
+    """
+    Corta las llamadas a una dependencia que falla o responde lenta
+
+    Cerrado: se registran las últimas `ventana` llamadas; si con al menos
+    `minimo_llamadas` la proporción de fallos o de llamadas lentas supera su
+    umbral, el circuito se abre. Abierto: se rechaza todo durante `espera`
+    segundos. Semiabierto: se dejan pasar hasta `sondas` llamadas de prueba;
+    si todas van bien se cierra, y al primer fallo o lentitud vuelve a abrirse.
+    """
+
+    def __init__(
+        self,
+        nombre: str,
+        ventana: int,
+        minimo_llamadas: int,
+        tasa_fallos: float,
+        tasa_lentas: float,
+        lento_ms: float,
+        espera: float,
+        sondas: int
+    ):
+        self.nombre = nombre
+        self.minimo_llamadas = minimo_llamadas
+        self.tasa_fallos = tasa_fallos
+        self.tasa_lentas = tasa_lentas
+        self.lento_ms = lento_ms
+        self.espera = espera
+        self.sondas = sondas
+
+        self.estado = CERRADO
+        self.abierto_desde = 0.0
+        self._resultados: Deque[Tuple[bool, bool]] = deque(maxlen=ventana)
+        self._sondas_en_vuelo = 0
+        self._sondas_ok = 0
+
+        # Métricas
+        self.rechazadas = 0
+        self.transiciones: Dict[str, int] = {}
+        self.ultimo_cambio: Optional[float] = None
+
+    def _cambiar(self, estado: str, motivo: str = ""):
+        clave = f"{self.estado}->{estado}"
+        self.transiciones[clave] = self.transiciones.get(clave, 0) + 1
+        self.ultimo_cambio = time.time()
+        nivel = logger.warning if estado == ABIERTO else logger.info
+        nivel(f"Circuito {self.nombre}: {clave}{f' ({motivo})' if motivo else ''}")
+
+        self.estado = estado
+        self._resultados.clear()
+        self._sondas_en_vuelo = 0
+        self._sondas_ok = 0
+        if estado == ABIERTO:
+            self.abierto_desde = time.monotonic()
+
+    def permitir(self) -> bool:
+        """Indica si la llamada puede intentarse (y la cuenta como sonda)"""
+        if self.estado == ABIERTO:
+            if time.monotonic() - self.abierto_desde < self.espera:
+                self.rechazadas += 1
+                return False
+            self._cambiar(SEMIABIERTO)
+
+        if self.estado == SEMIABIERTO:
+            if self._sondas_en_vuelo >= self.sondas:
+                self.rechazadas += 1
+                return False
+            self._sondas_en_vuelo += 1
+
+        return True
+
+    def registrar(self, exito: bool, duracion_ms: float):
+        """Registra el resultado de una llamada permitida"""
+        lenta = duracion_ms >= self.lento_ms
+
+        if self.estado == SEMIABIERTO:
+            self._sondas_en_vuelo = max(self._sondas_en_vuelo - 1, 0)
+            if not exito or lenta:
+                self._cambiar(ABIERTO, "sonda fallida" if not exito else "sonda lenta")
+                return
+            self._sondas_ok += 1
+            if self._sondas_ok >= self.sondas:
+                self._cambiar(CERRADO)
+            return
+
+        if self.estado == ABIERTO:
+            # Llamada iniciada antes de abrirse el circuito
+            return
+
+        self._resultados.append((not exito, lenta))
+        total = len(self._resultados)
+        if total < self.minimo_llamadas:
+            return
+
+        fallos = sum(fallo for fallo, _ in self._resultados) / total
+        lentas = sum(lenta for _, lenta in self._resultados) / total
+        if fallos >= self.tasa_fallos:
+            self._cambiar(ABIERTO, f"{fallos:.0%} de fallos")
+        elif lentas >= self.tasa_lentas:
+            self._cambiar(ABIERTO, f"{lentas:.0%} de llamadas lentas")
+
+    def cancelar(self):
+        """Libera una llamada permitida que se canceló sin resultado"""
+        if self.estado == SEMIABIERTO:
+            self._sondas_en_vuelo = max(self._sondas_en_vuelo - 1, 0)
+
+    def metricas(self) -> dict:
+        """Estado actual y transiciones del circuito"""
+        total = len(self._resultados)
+        return {
+            "estado": self.estado,
+            "tasa_fallos": round(sum(f for f, _ in self._resultados) / total, 4) if total else 0.0,
+            "tasa_lentas": round(sum(lenta for _, lenta in self._resultados) / total, 4) if total else 0.0,
+            "rechazadas": self.rechazadas,
+            "transiciones": dict(self.transiciones),
+            "ultimo_cambio": self.ultimo_cambio
+        }
+
+
+# Dependencias cuyos datos se sirvieron obsoletos en la petición en curso. Es
+# un set compartido: las tareas hijas (asyncio.gather) copian el contexto pero
+# apuntan al mismo objeto
+_obsoletos: ContextVar[Optional[Set[str]]] = ContextVar("obsoletos", default=None)
+
+
+def registrar_obsoletos() -> Set[str]:
+    """Empieza a registrar los datos obsoletos de la petición actual"""
+    obsoletos: Set[str] = set()
+    _obsoletos.set(obsoletos)
+    return obsoletos
+
+
+def marcar_obsoleto(fuente: str):
+    """Anota que la respuesta actual incluye datos obsoletos de `fuente`"""
+    obsoletos = _obsoletos.get()
+    if obsoletos is not None:
+        obsoletos.add(fuente)
+
+
+class DatosObsoletosMiddleware:
+    """
+    Middleware ASGI que añade X-Datos-Obsoletos si la respuesta usa datos de respaldo
+
+    ASGI puro: no envuelve la respuesta en otra tarea ni la copia, así que
+    las respuestas en streaming (NDJSON, SSE) pasan tal cual.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        obsoletos = registrar_obsoletos()
+
+        async def enviar(mensaje):
+            if mensaje["type"] == "http.response.start" and obsoletos:
+                mensaje["headers"] = list(mensaje.get("headers", [])) + [
+                    (b"x-datos-obsoletos", ",".join(sorted(obsoletos)).encode("latin-1"))
+                ]
+            await send(mensaje)
+
+        await self.app(scope, receive, enviar)
@@ -0,0 +1,326 @@
+"""
+Enrutado de lecturas a réplicas de PostgreSQL con read-your-writes
+"""
+import asyncio
+import itertools
+import time
+from contextvars import ContextVar
+from http.cookies import CookieError, SimpleCookie
+from typing import Any, AsyncIterator, List, Optional
+import sqlalchemy
+from app.utils.cache import TTLCache
+from app.utils.logger import logger
+
+# Cookie y header con la posición del WAL de la última escritura del cliente
+COOKIE_LSN = "compras_lsn"
+CABECERA_LSN = "X-Compras-LSN"
+
+
+def lsn_a_entero(lsn: str) -> int:
+    """'16/B374D848' -> posición del WAL como entero comparable"""
+    alto, bajo = lsn.split("/")
+    return (int(alto, 16) << 32) | int(bajo, 16)
+
+
+def entero_a_lsn(posicion: int) -> str:
+    return f"{posicion >> 32:X}/{posicion & 0xFFFFFFFF:X}"
+
+
+class PinEscritura:
+    """Estado de read-your-writes de la petición actual"""
+
+    __slots__ = ("lsn_cliente", "escritura")
+
+    def __init__(self, lsn_cliente: Optional[int] = None):
+        self.lsn_cliente = lsn_cliente
+        self.escritura = False
+
+
+_pin: ContextVar[Optional[PinEscritura]] = ContextVar("pin_escritura", default=None)
+
+
+class Replica:
+    """Pool de una réplica y su estado de salud"""
+
+    def __init__(self, nombre: str, database):
+        self.nombre = nombre
+        self.database = database
+        self.sana = False
+        self.latencia_ms: Optional[float] = None
+        self.lag_segundos: Optional[float] = None
+        self.lsn: Optional[int] = None
+        self.lecturas = 0
+        self.fallos = 0
+
+
+class DatabaseRouter:
+    """
+    Envía las lecturas a réplicas sanas y las escrituras al primario
+
+    Read-your-writes en dos niveles:
+
+    - Tras una escritura, el usuario queda fijado al primario durante
+      `ventana_escritura` segundos en este proceso.
+    - La respuesta a una petición que escribió lleva la posición del WAL
+      del primario tras confirmarla (cookie `compras_lsn` y header
+      `X-Compras-LSN`). Con ella, cualquier worker solo lee en réplicas que
+      ya la hayan aplicado; si ninguna llega, lee en el primario.
+
+    Las búsquedas por id que no encuentran nada en una réplica se repiten en
+    el primario, por si el cliente no devuelve la cookie.
+    """
+
+    def __init__(
+        self,
+        primario,
+        replicas: List[Any],
+        ventana_escritura: float,
+        intervalo_salud: float,
+        lag_maximo: float
+    ):
+        self.primario = primario
+        self.replicas = [Replica(f"replica-{i}", db) for i, db in enumerate(replicas)]
+        self.intervalo_salud = intervalo_salud
+        self.lag_maximo = lag_maximo
+        self._escrituras = TTLCache(100_000, ventana_escritura)
+        self._turno = itertools.count()
+        self.tarea: Optional[asyncio.Task] = None
+        # La cookie dura hasta que cualquier réplica sana debería haberla aplicado
+        self.vida_cookie = int(max(ventana_escritura, lag_maximo + intervalo_salud)) + 1
+
+        # Métricas
+        self.lecturas_primario = 0
+        self.fijadas_primario = 0
+        self.fijadas_lsn = 0
+        self.reintentos_primario = 0
+
+    async def conectar(self):
+        """Conecta las réplicas (una réplica caída no impide arrancar)"""
+        for replica in self.replicas:
+            try:
+                await replica.database.connect()
+            except Exception as e:
+                logger.error(f"No se pudo conectar a {replica.nombre}: {str(e)}")
+        if self.replicas:
+            await self.comprobar_salud()
+            self.tarea = asyncio.create_task(self._vigilar())
+
+    async def desconectar(self):
+        if self.tarea is not None:
+            self.tarea.cancel()
+            try:
+                await self.tarea
+            except asyncio.CancelledError:
+                pass
+            self.tarea = None
+        for replica in self.replicas:
+            if replica.database.is_connected:
+                await replica.database.disconnect()
+
+    async def _vigilar(self):
+        while True:
+            await asyncio.sleep(self.intervalo_salud)
+            await self.comprobar_salud()
+
+    async def comprobar_salud(self):
+        """Mide latencia y retraso de replicación de cada réplica"""
+        consulta_lag = sqlalchemy.text(
+            "SELECT COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0) AS lag, "
+            "pg_last_wal_replay_lsn()::text AS lsn"
+        )
+        for replica in self.replicas:
+            inicio = time.perf_counter()
+            try:
+                if not replica.database.is_connected:
+                    await replica.database.connect()
+                fila = await asyncio.wait_for(
+                    replica.database.fetch_one(consulta_lag),
+                    timeout=self.intervalo_salud
+                )
+                replica.latencia_ms = round((time.perf_counter() - inicio) * 1000, 3)
+                replica.lag_segundos = float(fila["lag"])
+                replica.lsn = lsn_a_entero(fila["lsn"]) if fila["lsn"] else None
+                sana = replica.lag_segundos <= self.lag_maximo
+            except Exception as e:
+                logger.warning(f"{replica.nombre} no responde: {str(e)}")
+                sana = False
+
+            if sana != replica.sana:
+                logger.info(f"{replica.nombre} {'disponible' if sana else 'fuera de servicio'}")
+            replica.sana = sana
+
+    def marcar_escritura(self, usuario_id: str):
+        """Fija al usuario al primario durante la ventana de read-your-writes"""
+        self._escrituras.set(usuario_id, True)
+        pin = _pin.get()
+        if pin is not None:
+            pin.escritura = True
+
+    async def lsn_primario(self) -> Optional[str]:
+        """Posición actual del WAL del primario (None si no hay réplicas o falla)"""
+        if not self.replicas:
+            return None
+        try:
+            return await self.primario.fetch_val(
+                sqlalchemy.text("SELECT pg_current_wal_lsn()::text")
+            )
+        except Exception as e:
+            logger.warning(f"No se pudo leer la posición del WAL del primario: {str(e)}")
+            return None
+
+    def _elegir(self, usuario_id: Optional[str]) -> Optional[Replica]:
+        """Réplica para una lectura, o None si debe ir al primario"""
+        if usuario_id is not None and self._escrituras.get(usuario_id)[0]:
+            self.fijadas_primario += 1
+            return None
+
+        sanas = [r for r in self.replicas if r.sana]
+        if not sanas:
+            return None
+
+        pin = _pin.get()
+        if pin is not None and pin.lsn_cliente is not None:
+            sanas = [r for r in sanas if r.lsn is not None and r.lsn >= pin.lsn_cliente]
+            if not sanas:
+                self.fijadas_lsn += 1
+                return None
+
+        # Reparto por turnos entre las réplicas con menor latencia
+        sanas.sort(key=lambda r: r.latencia_ms or 0.0)
+        mejores = [r for r in sanas if (r.latencia_ms or 0.0) <= (sanas[0].latencia_ms or 0.0) * 2 + 1]
+        return mejores[next(self._turno) % len(mejores)]
+
+    async def _leer(
+        self,
+        metodo: str,
+        query,
+        usuario_id: Optional[str],
+        primario_si_vacio: bool = False
+    ) -> Any:
+        replica = self._elegir(usuario_id)
+        if replica is not None:
+            try:
+                resultado = await getattr(replica.database, metodo)(query)
+                replica.lecturas += 1
+                if resultado or not primario_si_vacio:
+                    return resultado
+                self.reintentos_primario += 1
+            except Exception as e:
+                replica.fallos += 1
+                replica.sana = False
+                logger.warning(f"Lectura fallida en {replica.nombre}, se usa el primario: {str(e)}")
+
+        self.lecturas_primario += 1
+        return await getattr(self.primario, metodo)(query)
+
+    async def fetch_one(
+        self,
+        query,
+        usuario_id: Optional[str] = None,
+        primario_si_vacio: bool = False
+    ) -> Any:
+        """
+        Lee una fila
+
+        Con `primario_si_vacio`, si la réplica no devuelve nada se repite en
+        el primario (búsquedas por id de filas que pueden ser muy recientes).
+        """
+        return await self._leer("fetch_one", query, usuario_id, primario_si_vacio)
+
+    async def fetch_all(self, query, usuario_id: Optional[str] = None) -> List[Any]:
+        return await self._leer("fetch_all", query, usuario_id)
+
+    async def iterate(self, query, usuario_id: Optional[str] = None) -> AsyncIterator[Any]:
+        """Itera en una réplica (sin reintento: las filas ya emitidas no se repiten)"""
+        replica = self._elegir(usuario_id)
+        database = replica.database if replica is not None else self.primario
+        if replica is None:
+            self.lecturas_primario += 1
+        else:
+            replica.lecturas += 1
+
+        async for fila in database.iterate(query):
+            yield fila
+
+    def metricas(self) -> dict:
+        return {
+            "lecturas_primario": self.lecturas_primario,
+            "fijadas_primario": self.fijadas_primario,
+            "fijadas_lsn": self.fijadas_lsn,
+            "reintentos_primario": self.reintentos_primario,
+            "replicas": [
+                {
+                    "nombre": r.nombre,
+                    "sana": r.sana,
+                    "latencia_ms": r.latencia_ms,
+                    "lag_segundos": r.lag_segundos,
+                    "lecturas": r.lecturas,
+                    "fallos": r.fallos,
+                    "pool": r.database.metricas_pool()
+                }
+                for r in self.replicas
+            ]
+        }
+
+
+class ReadYourWritesMiddleware:
+    """
+    Middleware ASGI que lleva la posición del WAL del cliente entre workers
+
+    Lee la cookie `compras_lsn` (o el header `X-Compras-LSN`) de la petición
+    para que el router descarte las réplicas que aún no la han aplicado. Si
+    la petición escribió, al empezar la respuesta (con la transacción ya
+    confirmada) pide al primario su posición actual y la devuelve en la
+    cookie y en el header.
+    """
+
+    def __init__(self, app, router: DatabaseRouter):
+        self.app = app
+        self.router = router
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        pin = PinEscritura(self._lsn_cliente(scope))
+        _pin.set(pin)
+
+        async def enviar(mensaje):
+            if mensaje["type"] == "http.response.start" and pin.escritura:
+                lsn = await self.router.lsn_primario()
+                if lsn is not None:
+                    cookie = (
+                        f"{COOKIE_LSN}={lsn}; Max-Age={self.router.vida_cookie}; "
+                        "Path=/; HttpOnly; SameSite=Lax"
+                    )
+                    mensaje["headers"] = list(mensaje.get("headers", [])) + [
+                        (b"set-cookie", cookie.encode("latin-1")),
+                        (CABECERA_LSN.lower().encode("latin-1"), lsn.encode("latin-1"))
+                    ]
+            await send(mensaje)
+
+        await self.app(scope, receive, enviar)
+
+    @staticmethod
+    def _lsn_cliente(scope) -> Optional[int]:
+        """Posición del WAL que envía el cliente (header o cookie), si es válida"""
+        valores = []
+        for nombre, valor in scope.get("headers", []):
+            if nombre == CABECERA_LSN.lower().encode("latin-1"):
+                valores.append(valor.decode("latin-1"))
+            elif nombre == b"cookie":
+                try:
+                    cookie = SimpleCookie(valor.decode("latin-1"))
+                except CookieError:
+                    continue
+                if COOKIE_LSN in cookie:
+                    valores.append(cookie[COOKIE_LSN].value)
+
+        posiciones = []
+        for valor in valores:
+            try:
+                posiciones.append(lsn_a_entero(valor.strip()))
+            except ValueError:
+                continue
+        return max(posiciones) if posiciones else None
@@ -0,0 +1,126 @@
+"""
+Respuestas cacheables: ETag, peticiones condicionales y compresión
+"""
+import gzip
+import hashlib
+from typing import Dict, Optional
+from fastapi import Request, Response
+from app.config import settings
+from app.utils.logger import logger
+
+try:
+    import zstandard
+    _zstd = zstandard.ZstdCompressor(level=6)
+except ImportError:
+    logger.warning("Paquete zstandard no instalado, solo se comprimirá con gzip")
+    _zstd = None
+
+# Codificaciones soportadas, por orden de preferencia del servidor
+CODIFICACIONES = ["zstd", "gzip"] if _zstd is not None else ["gzip"]
+
+_SUFIJOS = {"zstd": "-zst", "gzip": "-gz"}
+
+
+def calcular_etag(cuerpo: bytes) -> str:
+    """ETag fuerte a partir del contenido"""
+    return '"' + hashlib.sha256(cuerpo).hexdigest()[:32] + '"'
+
+
+def comprimir(cuerpo: bytes, codificacion: str) -> bytes:
+    if codificacion == "zstd":
+        return _zstd.compress(cuerpo)
+    return gzip.compress(cuerpo, compresslevel=6)
+
+
+def elegir_codificacion(accept_encoding: Optional[str]) -> Optional[str]:
+    """Primera codificación soportada que el cliente acepta (q > 0)"""
+    if not accept_encoding:
+        return None
+
+    aceptadas = set()
+    for parte in accept_encoding.lower().split(","):
+        nombre, _, parametros = parte.strip().partition(";")
+        q = parametros.strip()
+        if q.startswith("q="):
+            try:
+                if float(q[2:]) <= 0:
+                    continue
+            except ValueError:
+                continue
+        aceptadas.add(nombre.strip())
+
+    for codificacion in CODIFICACIONES:
+        if codificacion in aceptadas or "*" in aceptadas:
+            return codificacion
+    return None
+
+
+def etag_coincide(if_none_match: Optional[str], etag: str) -> bool:
+    """Comprueba If-None-Match ignorando el sufijo de la codificación"""
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+
+    base = etag.strip('"')
+    for candidato in if_none_match.split(","):
+        candidato = candidato.strip()
+        if candidato.startswith("W/"):
+            candidato = candidato[2:]
+        candidato = candidato.strip('"')
+        for sufijo in _SUFIJOS.values():
+            if candidato.endswith(sufijo):
+                candidato = candidato[:-len(sufijo)]
+                break
+        if candidato == base:
+            return True
+    return False
+
+
+class RepresentacionCacheable:
+    """
+    Cuerpo JSON ya serializado con su ETag y sus versiones comprimidas
+
+    Se construye una vez por versión del recurso; cada variante comprimida
+    se calcula la primera vez que un cliente la pide.
+    """
+
+    def __init__(self, cuerpo: bytes):
+        self.cuerpo = cuerpo
+        self.etag = calcular_etag(cuerpo)
+        self._comprimidos: Dict[str, bytes] = {}
+
+    def comprimido(self, codificacion: str) -> bytes:
+        datos = self._comprimidos.get(codificacion)
+        if datos is None:
+            datos = self._comprimidos[codificacion] = comprimir(self.cuerpo, codificacion)
+        return datos
+
+    def responder(self, request: Request, max_age: int = 0) -> Response:
+        """
+        Respuesta 200 (comprimida si procede) o 304 si el cliente ya la tiene
+        """
+        cabeceras = {
+            "Cache-Control": f"private, max-age={max_age}",
+            "Vary": "Accept-Encoding"
+        }
+
+        codificacion = None
+        if len(self.cuerpo) >= settings.respuesta_compresion_min_bytes:
+            codificacion = elegir_codificacion(request.headers.get("accept-encoding"))
+
+        etag = self.etag
+        if codificacion is not None:
+            etag = etag[:-1] + _SUFIJOS[codificacion] + '"'
+        cabeceras["ETag"] = etag
+
+        if etag_coincide(request.headers.get("if-none-match"), self.etag):
+            return Response(status_code=304, headers=cabeceras)
+
+        if codificacion is None:
+            contenido = self.cuerpo
+        else:
+            contenido = self.comprimido(codificacion)
+            cabeceras["Content-Encoding"] = codificacion
+
+        return Response(content=contenido, media_type="application/json", headers=cabeceras)
@@ -1,13 +1,19 @@
 """
 Validación de JWT compatible con servicio de Usuarios (Node.js)
 """
+import hashlib
+import time
 import jwt
-from fastapi import HTTPException, Security
+from fastapi import Depends, HTTPException, Security
 from fastapi.security import HTTPAuthorizationCredentials, HTTPBearer
 from app.config import settings
+from app.utils.cache import TTLCache
 
 security = HTTPBearer()
 
+# Claims de tokens ya validados, indexados por hash del token, hasta su "exp"
+tokens_cache = TTLCache(settings.jwt_cache_max, settings.jwt_cache_ttl_max)
+
 
 def verify_jwt(credentials: HTTPAuthorizationCredentials = Security(security)) -> dict:
     """
@@ -23,6 +29,11 @@ def verify_jwt(credentials: HTTPAuthorizationCredentials = Security(security)) -
         HTTPException 401 si el token es inválido
     """
     token = credentials.credentials
+    clave = hashlib.sha256(token.encode()).digest()
+    
+    encontrado, payload = tokens_cache.get(clave)
+    if encontrado:
+        return payload
     
     try:
         payload = jwt.decode(
@@ -38,6 +49,12 @@ def verify_jwt(credentials: HTTPAuthorizationCredentials = Security(security)) -
                 detail="Token inválido: faltan claims requeridos"
             )
         
+        # Solo se cachean tokens válidos y nunca más allá de su expiración
+        ttl = settings.jwt_cache_ttl_max
+        if "exp" in payload:
+            ttl = min(ttl, payload["exp"] - time.time())
+        tokens_cache.set(clave, payload, ttl)
+        
         return payload
         
     except jwt.ExpiredSignatureError:
@@ -57,4 +74,19 @@ def get_current_user(token_data: dict = Security(verify_jwt)) -> dict:
     return {
         "id": token_data["id"],
         "role": token_data["role"]
-    }
\ No newline at end of file
+    }
+
+
+def require_admin(current_user: dict = Depends(get_current_user)) -> dict:
+    """
+    Exige el rol admin (organizadores)
+
+    Raises:
+        HTTPException 403 si el usuario no es admin
+    """
+    if current_user["role"] != "admin":
+        raise HTTPException(
+            status_code=403,
+            detail="Acceso denegado: Requiere rol admin"
+        )
+    return current_user
\ No newline at end of file
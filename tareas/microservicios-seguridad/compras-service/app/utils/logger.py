@@ -1,29 +1,141 @@
 """
 Configuración de logging estructurado
+
+Los registros se encolan en una cola acotada (QueueHandler) y un hilo aparte
+(QueueListener) los formatea a JSON y los escribe en stdout, de modo que el
+event loop nunca espera por la E/S del log.
 """
+import atexit
+import copy
 import logging
+import queue
+import random
 import sys
-from pythonjsonlogger import jsonlogger
+import threading
+import time
+from logging.handlers import QueueHandler, QueueListener
+from typing import Dict, Optional
+from pythonjsonlogger.orjson import OrjsonFormatter
 from app.config import settings
 
 
+class BoundedQueueHandler(QueueHandler):
+    """QueueHandler que descarta registros si la cola está llena"""
+
+    def __init__(self, cola: queue.Queue):
+        super().__init__(cola)
+        self.descartados = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        """Resuelve el mensaje sin formatear a JSON (eso ocurre en el listener)"""
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = _formatter_base.formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.descartados += 1
+
+
+class MuestreoFilter(logging.Filter):
+    """
+    Muestreo y límite de frecuencia para registros de nivel inferior a WARNING
+
+    La clave de cada registro es el nombre del logger o, para el logger raíz,
+    el módulo que lo emite (p. ej. "rabbitmq_client"). Se aplica en el hilo
+    que emite el registro, así que las ventanas se protegen con un lock.
+    """
+
+    def __init__(self, muestreo: Dict[str, float], limite_por_segundo: int):
+        super().__init__()
+        self.muestreo = muestreo
+        self.limite_por_segundo = limite_por_segundo
+        self._ventanas: Dict[str, list] = {}
+        self._lock = threading.Lock()
+        self.muestreados = 0
+        self.limitados = 0
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno >= logging.WARNING:
+            return True
+
+        clave = record.name if record.name != "root" else record.module
+
+        proporcion = self.muestreo.get(clave)
+        if proporcion is not None and random.random() >= proporcion:
+            self.muestreados += 1
+            return False
+
+        if self.limite_por_segundo:
+            segundo = int(time.monotonic())
+            with self._lock:
+                ventana = self._ventanas.get(clave)
+                if ventana is None or ventana[0] != segundo:
+                    ventana = self._ventanas[clave] = [segundo, 0]
+                ventana[1] += 1
+                if ventana[1] > self.limite_por_segundo:
+                    self.limitados += 1
+                    return False
+
+        return True
+
+
+_formatter_base = logging.Formatter()
+_queue_handler: Optional[BoundedQueueHandler] = None
+_listener: Optional[QueueListener] = None
+_muestreo: Optional[MuestreoFilter] = None
+
+
 def setup_logger():
-    """Configura el logger con formato JSON"""
+    """Configura el logger con formato JSON escrito fuera del event loop"""
+    global _queue_handler, _listener, _muestreo
+
     logger = logging.getLogger()
     logger.setLevel(getattr(logging, settings.log_level.upper()))
-    
-    # Handler para consola
+
+    # Handler para consola (se ejecuta en el hilo del listener)
     handler = logging.StreamHandler(sys.stdout)
-    
+
     # Formato JSON
-    formatter = jsonlogger.JsonFormatter(
+    formatter = OrjsonFormatter(
         "%(asctime)s %(levelname)s %(name)s %(message)s"
     )
     handler.setFormatter(formatter)
-    
-    logger.addHandler(handler)
-    
+
+    _queue_handler = BoundedQueueHandler(queue.Queue(maxsize=settings.log_cola_max))
+    _muestreo = MuestreoFilter(settings.log_muestreo, settings.log_limite_por_segundo)
+    _queue_handler.addFilter(_muestreo)
+    logger.addHandler(_queue_handler)
+
+    _listener = QueueListener(_queue_handler.queue, handler, respect_handler_level=True)
+    _listener.start()
+    atexit.register(detener_logging)
+
     return logger
 
 
-logger = setup_logger()
\ No newline at end of file
+def detener_logging():
+    """Vacía la cola de logs y detiene el hilo escritor"""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+def metricas_logging() -> dict:
+    """Registros descartados por cola llena, muestreo o límite de frecuencia"""
+    return {
+        "en_cola": _queue_handler.queue.qsize() if _queue_handler else 0,
+        "descartados": _queue_handler.descartados if _queue_handler else 0,
+        "muestreados": _muestreo.muestreados if _muestreo else 0,
+        "limitados": _muestreo.limitados if _muestreo else 0
+    }
+
+
+logger = setup_logger()
@@ -0,0 +1,330 @@
+"""
+Instrumentación de consultas: huella normalizada, histogramas y log de lentas
+
+Incluye también la del pool de asyncpg: la espera para obtener una conexión
+se mide aparte del tiempo de la consulta.
+"""
+import asyncio
+import re
+import time
+from bisect import bisect_left
+from typing import Any, AsyncIterator, Dict, List, Optional, Union
+import asyncpg
+import databases
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.sql import ClauseElement
+from app.utils.logger import logger
+
+# Límites superiores (ms) de los buckets del histograma de latencia
+BUCKETS_MS = [1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000]
+
+# Máximo de huellas distintas registradas (el resto se agrupa en "otras")
+MAX_HUELLAS = 500
+
+_DIALECTO = postgresql.dialect()
+
+_LITERALES = [
+    (re.compile(r"'(?:[^']|'')*'"), "?"),
+    (re.compile(r"\b\d+(?:\.\d+)?\b"), "?"),
+    (re.compile(r"%\(\w+\)s(?:::\w+(?:\[\])?)?"), "?"),
+    (re.compile(r"\$\d+"), "?"),
+    (re.compile(r"\(\s*\?(?:\s*,\s*\?)+\s*\)"), "(?+)"),
+    (re.compile(r"\s+"), " "),
+]
+
+
+def normalizar_sql(sql: str) -> str:
+    """Quita literales y parámetros de una sentencia SQL"""
+    for patron, reemplazo in _LITERALES:
+        sql = patron.sub(reemplazo, sql)
+    return sql.strip()
+
+
+class EstadisticaConsulta:
+    """Contadores e histograma de latencia de una huella"""
+
+    __slots__ = ("huella", "llamadas", "errores", "total_ms", "max_ms", "buckets")
+
+    def __init__(self, huella: str):
+        self.huella = huella
+        self.llamadas = 0
+        self.errores = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+        self.buckets = [0] * (len(BUCKETS_MS) + 1)
+
+    def registrar(self, ms: float, error: bool):
+        self.llamadas += 1
+        self.errores += error
+        self.total_ms += ms
+        self.max_ms = max(self.max_ms, ms)
+        self.buckets[bisect_left(BUCKETS_MS, ms)] += 1
+
+    def percentil(self, p: float) -> float:
+        """Estimación del percentil (límite superior del bucket)"""
+        objetivo = p * self.llamadas
+        acumulado = 0
+        for i, cantidad in enumerate(self.buckets):
+            acumulado += cantidad
+            if acumulado >= objetivo:
+                return BUCKETS_MS[i] if i < len(BUCKETS_MS) else self.max_ms
+        return self.max_ms
+
+    def resumen(self) -> dict:
+        return {
+            "huella": self.huella,
+            "llamadas": self.llamadas,
+            "errores": self.errores,
+            "total_ms": round(self.total_ms, 3),
+            "media_ms": round(self.total_ms / self.llamadas, 3) if self.llamadas else 0.0,
+            "p50_ms": self.percentil(0.50),
+            "p99_ms": self.percentil(0.99),
+            "max_ms": round(self.max_ms, 3),
+            "histograma": dict(zip([f"<={b}ms" for b in BUCKETS_MS] + ["inf"], self.buckets))
+        }
+
+
+class PoolAgotadoError(Exception):
+    """No se obtuvo una conexión del pool dentro del timeout de adquisición"""
+
+
+class ConexionConEdad(asyncpg.Connection):
+    """Conexión que recuerda cuándo se abrió (para la vida máxima)"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.creada_en = time.monotonic()
+
+
+class PoolInstrumentado:
+    """
+    Envoltorio de `asyncpg.Pool` usado por el backend de `databases`
+
+    Solo intercepta `acquire` y `release`; el resto se delega en el pool.
+    """
+
+    def __init__(self, pool: asyncpg.Pool, timeout_adquisicion: float, vida_maxima: float):
+        self._pool = pool
+        self.timeout_adquisicion = timeout_adquisicion or None
+        self.vida_maxima = vida_maxima
+
+        # Métricas
+        self.espera = EstadisticaConsulta("adquisicion")
+        self.esperando = 0
+        self.max_esperando = 0
+        self.timeouts = 0
+        self.recicladas = 0
+
+    def __getattr__(self, nombre: str) -> Any:
+        return getattr(self._pool, nombre)
+
+    async def acquire(self):
+        """
+        Obtiene una conexión del pool
+
+        Raises:
+            PoolAgotadoError si no hay conexión libre dentro del timeout
+        """
+        inicio = time.perf_counter()
+        self.esperando += 1
+        self.max_esperando = max(self.max_esperando, self.esperando)
+        try:
+            conexion = await self._pool.acquire(timeout=self.timeout_adquisicion)
+        except asyncio.TimeoutError:
+            self.timeouts += 1
+            self.espera.registrar((time.perf_counter() - inicio) * 1000, True)
+            raise PoolAgotadoError(
+                f"Sin conexiones libres tras {self.timeout_adquisicion}s "
+                f"(pool de {self._pool.get_max_size()})"
+            )
+        finally:
+            self.esperando -= 1
+
+        self.espera.registrar((time.perf_counter() - inicio) * 1000, False)
+        return conexion
+
+    async def release(self, conexion, *, timeout: Optional[float] = None):
+        """Devuelve la conexión al pool, o la cierra si superó su vida máxima"""
+        # `_con` es la conexión real tras el proxy del pool; al cerrarla el
+        # pool libera su hueco y abrirá otra en la siguiente adquisición
+        real = conexion._con
+        if (
+            self.vida_maxima
+            and real is not None
+            and time.monotonic() - getattr(real, "creada_en", time.monotonic()) > self.vida_maxima
+        ):
+            self.recicladas += 1
+            await real.close(timeout=timeout)
+            return
+        await self._pool.release(conexion, timeout=timeout)
+
+    def metricas(self) -> dict:
+        tamano = self._pool.get_size()
+        inactivas = self._pool.get_idle_size()
+        espera = self.espera.resumen()
+        return {
+            "min": self._pool.get_min_size(),
+            "max": self._pool.get_max_size(),
+            "tamano": tamano,
+            "en_uso": tamano - inactivas,
+            "inactivas": inactivas,
+            "esperando": self.esperando,
+            "max_esperando": self.max_esperando,
+            "adquisiciones": espera["llamadas"],
+            "timeouts": self.timeouts,
+            "recicladas": self.recicladas,
+            "espera_media_ms": espera["media_ms"],
+            "espera_p99_ms": espera["p99_ms"],
+            "espera_max_ms": espera["max_ms"],
+            "espera_histograma": espera["histograma"]
+        }
+
+
+class InstrumentedDatabase:
+    """
+    Envoltorio de `databases.Database` que mide cada consulta
+
+    Delega todo en la base de datos original; `execute`, `execute_many`,
+    `fetch_*` e `iterate` se cronometran y se agrupan por huella. Al conectar
+    con PostgreSQL, el pool de asyncpg se envuelve en un `PoolInstrumentado`.
+    """
+
+    def __init__(
+        self,
+        database: databases.Database,
+        umbral_lento_ms: float,
+        timeout_adquisicion: float = 0,
+        vida_maxima: float = 0
+    ):
+        self._database = database
+        self.umbral_lento_ms = umbral_lento_ms
+        self.timeout_adquisicion = timeout_adquisicion
+        self.vida_maxima = vida_maxima
+        self.pool: Optional[PoolInstrumentado] = None
+        self.estadisticas: Dict[str, EstadisticaConsulta] = {}
+        self._huellas: Dict[Any, str] = {}
+
+    def __getattr__(self, nombre: str) -> Any:
+        return getattr(self._database, nombre)
+
+    async def connect(self) -> None:
+        await self._database.connect()
+        backend = self._database._backend
+        if isinstance(getattr(backend, "_pool", None), asyncpg.Pool):
+            self.pool = backend._pool = PoolInstrumentado(
+                backend._pool,
+                self.timeout_adquisicion,
+                self.vida_maxima
+            )
+
+    def metricas_pool(self) -> Optional[dict]:
+        """Estado del pool y espera de adquisición (None si no es asyncpg)"""
+        return self.pool.metricas() if self.pool is not None else None
+
+    def _huella(self, query: Union[ClauseElement, str]) -> str:
+        """Huella de la consulta; se compila una sola vez por forma de consulta"""
+        if isinstance(query, str):
+            return normalizar_sql(query)
+
+        cache_key = query._generate_cache_key()
+        if cache_key is None:
+            return normalizar_sql(str(query.compile(dialect=_DIALECTO)))
+
+        clave = cache_key.key
+        huella = self._huellas.get(clave)
+        if huella is None:
+            huella = normalizar_sql(str(query.compile(dialect=_DIALECTO)))
+            if len(self._huellas) < MAX_HUELLAS * 4:
+                self._huellas[clave] = huella
+        return huella
+
+    def _registrar(self, query, values: Optional[dict], inicio: float, error: bool):
+        ms = (time.perf_counter() - inicio) * 1000
+        huella = self._huella(query)
+
+        estadistica = self.estadisticas.get(huella)
+        if estadistica is None:
+            if len(self.estadisticas) >= MAX_HUELLAS:
+                huella = "otras"
+                estadistica = self.estadisticas.get(huella)
+            if estadistica is None:
+                estadistica = self.estadisticas[huella] = EstadisticaConsulta(huella)
+        estadistica.registrar(ms, error)
+
+        if ms >= self.umbral_lento_ms:
+            logger.warning(
+                f"Consulta lenta ({ms:.1f} ms): {huella}",
+                extra={"duracion_ms": round(ms, 3), "binds": self._forma_binds(query, values)}
+            )
+
+    @staticmethod
+    def _forma_binds(query, values: Optional[dict]) -> dict:
+        """Nombres y tipos de los parámetros (sin sus valores)"""
+        if values is None and isinstance(query, ClauseElement):
+            values = query.compile(dialect=_DIALECTO).params
+        return {nombre: type(valor).__name__ for nombre, valor in (values or {}).items()}
+
+    async def _medir(self, metodo: str, query, values: Optional[dict] = None):
+        inicio = time.perf_counter()
+        error = False
+        try:
+            return await getattr(self._database, metodo)(query, values)
+        except Exception:
+            error = True
+            raise
+        finally:
+            self._registrar(query, values, inicio, error)
+
+    async def execute(self, query, values: Optional[dict] = None) -> Any:
+        return await self._medir("execute", query, values)
+
+    async def execute_many(self, query, values: List[dict]) -> None:
+        inicio = time.perf_counter()
+        error = False
+        try:
+            return await self._database.execute_many(query, values)
+        except Exception:
+            error = True
+            raise
+        finally:
+            self._registrar(query, values[0] if values else None, inicio, error)
+
+    async def fetch_all(self, query, values: Optional[dict] = None) -> List[Any]:
+        return await self._medir("fetch_all", query, values)
+
+    async def fetch_one(self, query, values: Optional[dict] = None) -> Optional[Any]:
+        return await self._medir("fetch_one", query, values)
+
+    async def fetch_val(self, query, values: Optional[dict] = None, column: Any = 0) -> Any:
+        inicio = time.perf_counter()
+        error = False
+        try:
+            return await self._database.fetch_val(query, values, column=column)
+        except Exception:
+            error = True
+            raise
+        finally:
+            self._registrar(query, values, inicio, error)
+
+    async def iterate(self, query, values: Optional[dict] = None) -> AsyncIterator[Any]:
+        """Itera el cursor; la latencia incluye el recorrido completo"""
+        inicio = time.perf_counter()
+        error = False
+        try:
+            async for fila in self._database.iterate(query, values):
+                yield fila
+        except Exception:
+            error = True
+            raise
+        finally:
+            self._registrar(query, values, inicio, error)
+
+    def top(self, n: int = 20, orden: str = "total_ms") -> List[dict]:
+        """Las N huellas con mayor valor en `orden` (total_ms, llamadas, max_ms, ...)"""
+        resumenes = [e.resumen() for e in self.estadisticas.values()]
+        resumenes.sort(key=lambda r: r.get(orden, 0), reverse=True)
+        return resumenes[:n]
+
+    def reiniciar(self):
+        """Borra las estadísticas acumuladas"""
+        self.estadisticas.clear()
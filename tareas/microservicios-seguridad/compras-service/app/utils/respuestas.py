@@ -0,0 +1,26 @@
+"""
+Respuesta JSON rápida para modelos construidos desde la base de datos
+"""
+from typing import Any
+import pydantic_core
+from fastapi.responses import JSONResponse
+from pydantic import BaseModel
+
+
+class ModeloJSONResponse(JSONResponse):
+    """
+    Serializa con pydantic-core sin revalidar contra `response_model`
+
+    Al devolver la respuesta directamente, FastAPI no vuelve a validar el
+    modelo ni pasa por `json.dumps`. El serializador es el mismo que usa
+    FastAPI en modo JSON, así que la salida (Decimal como texto, datetime en
+    ISO 8601) es idéntica byte a byte (ver tests/test_respuestas.py); solo
+    difieren los floats no finitos, que `json.dumps` rechaza y aquí salen
+    como NaN/Infinity. Acepta modelos o datos ya compatibles con JSON (p. ej.
+    respuestas de idempotencia almacenadas).
+    """
+
+    def render(self, content: Any) -> bytes:
+        if isinstance(content, BaseModel):
+            return content.__pydantic_serializer__.to_json(content)
+        return pydantic_core.to_json(content)
@@ -0,0 +1,3 @@
+"""
+Benchmarks del servicio de compras
+"""
@@ -0,0 +1,71 @@
+"""
+Benchmark del inventario de asientos sobre un único evento muy demandado
+
+Compara el throughput de reservas con 1 shard (un contador por evento) y
+con `inventario_shards` shards a medida que crece la concurrencia.
+
+Requiere una base de datos PostgreSQL de pruebas en DATABASE_URL:
+
+    python -m benchmarks.bench_inventario --reservas 2000
+"""
+import argparse
+import asyncio
+import time
+from app.database import connect_db, disconnect_db, database, inventario_table
+from app.config import settings
+from app.services.inventario_service import InventarioService
+
+EVENTO_BENCH = 999999
+
+
+async def preparar(inventario: InventarioService, capacidad: int):
+    """Reinicia el inventario del evento de prueba"""
+    await database.execute(
+        inventario_table.delete().where(inventario_table.c.evento_id == EVENTO_BENCH)
+    )
+    await inventario.inicializar_evento(EVENTO_BENCH, capacidad)
+
+
+async def ejecutar(shards: int, concurrencia: int, reservas: int) -> float:
+    """Lanza `reservas` reservas de 1 asiento con `concurrencia` compradores"""
+    inventario = InventarioService()
+    inventario.shards = shards
+    await preparar(inventario, reservas)
+
+    pendientes = iter(range(reservas))
+
+    async def comprador():
+        for _ in pendientes:
+            async with database.transaction():
+                await inventario.reservar(EVENTO_BENCH, 1)
+
+    inicio = time.perf_counter()
+    await asyncio.gather(*(comprador() for _ in range(concurrencia)))
+    duracion = time.perf_counter() - inicio
+
+    assert await inventario.disponibles(EVENTO_BENCH) == 0
+    return reservas / duracion
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--reservas", type=int, default=2000)
+    parser.add_argument("--concurrencia", type=int, nargs="+", default=[1, 4, 16, 64])
+    args = parser.parse_args()
+
+    await connect_db()
+    try:
+        print(f"{'shards':>8} {'concurrencia':>13} {'reservas/s':>12}")
+        for shards in (1, settings.inventario_shards):
+            for concurrencia in args.concurrencia:
+                ops = await ejecutar(shards, concurrencia, args.reservas)
+                print(f"{shards:>8} {concurrencia:>13} {ops:>12.1f}")
+        await database.execute(
+            inventario_table.delete().where(inventario_table.c.evento_id == EVENTO_BENCH)
+        )
+    finally:
+        await disconnect_db()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,326 @@
+"""
+Micro-benchmarks de los caminos críticos del servicio de compras
+
+Ejecuta el `ComprasService` real contra dobles locales: Eventos responde
+desde un `httpx.MockTransport`, RabbitMQ se sustituye por un publicador en
+memoria y la base de datos es una PostgreSQL local de pruebas (DATABASE_URL).
+Los datos usan un usuario y un rango de eventos reservados para la suite:
+el relay del outbox solo publica los mensajes de ese usuario (sembrados por
+la propia suite) y al terminar solo se borra lo que está en ese rango.
+
+    python -m benchmarks.suite --iteraciones 500 --guardar benchmarks/baseline.json
+    python -m benchmarks.suite --comparar benchmarks/baseline.json
+
+Por cada caso se informa ops/s, latencia p50/p99 y memoria asignada por
+llamada (tracemalloc, en una pasada aparte para no distorsionar los tiempos).
+"""
+import argparse
+import asyncio
+import json
+import platform
+import statistics
+import subprocess
+import sys
+import time
+import tracemalloc
+from typing import Awaitable, Callable, Dict, List
+import httpx
+import jwt
+import sqlalchemy
+from fastapi.security import HTTPAuthorizationCredentials
+from app.config import settings
+from app.database import (
+    compras_archivo_table,
+    compras_table,
+    connect_db,
+    database,
+    disconnect_db,
+    idempotencia_table,
+    inventario_table,
+    outbox_table,
+    ventas_eventos_table
+)
+from app.models.compra import CompraCreate, CompraPago
+from app.services.compras_service import compras_service
+from app.services.eventos_client import eventos_client
+from app.services.outbox_relay import outbox_relay
+from app.services.rabbitmq_client import rabbitmq_client
+from app.utils.jwt_utils import tokens_cache, verify_jwt
+
+# Usuario y eventos reservados para la suite (fuera de los ids reales)
+USUARIO_BENCH = "__bench__usuario"
+EVENTO_BENCH_BASE = 900_000_000
+EVENTOS_BENCH = 20
+
+# Regresión (en %) de ops/s a partir de la cual se marca un caso
+UMBRAL_REGRESION = 10.0
+
+
+def _eventos_handler(request: httpx.Request) -> httpx.Response:
+    """Servicio de Eventos simulado"""
+    if request.url.path == "/eventos":
+        return httpx.Response(200, json={"eventos": [
+            {"id": i, "nombre": f"Evento {i}", "precio": "25.00", "capacidad": 10**9}
+            for i in range(EVENTO_BENCH_BASE + 1, EVENTO_BENCH_BASE + EVENTOS_BENCH + 1)
+        ]})
+
+    evento_id = int(request.url.path.rsplit("/", 1)[-1])
+    if not EVENTO_BENCH_BASE < evento_id <= EVENTO_BENCH_BASE + EVENTOS_BENCH:
+        return httpx.Response(404, json={"error": "no encontrado"})
+    return httpx.Response(200, json={
+        "id": evento_id,
+        "nombre": f"Evento {evento_id}",
+        "precio": "25.00",
+        "capacidad": 10**9
+    })
+
+
+class PublicadorEnMemoria:
+    """Sustituye a RabbitMQ: guarda los mensajes publicados"""
+
+    def __init__(self):
+        self.mensajes: List[dict] = []
+
+    async def publicar_lote(self, mensajes: List[dict]):
+        self.mensajes.extend(mensajes)
+
+    async def publicar_mensaje(self, mensaje: dict):
+        self.mensajes.append(mensaje)
+
+
+async def medir(
+    nombre: str,
+    fn: Callable[[int], Awaitable[object]],
+    iteraciones: int,
+    calentamiento: int
+) -> dict:
+    """Cronometra fn(i) y mide la memoria asignada por llamada"""
+    for i in range(calentamiento):
+        await fn(i)
+
+    latencias = []
+    inicio_total = time.perf_counter()
+    for i in range(calentamiento, calentamiento + iteraciones):
+        inicio = time.perf_counter()
+        await fn(i)
+        latencias.append((time.perf_counter() - inicio) * 1000)
+    duracion = time.perf_counter() - inicio_total
+
+    # Pasada aparte con tracemalloc (asignaciones transitorias por llamada)
+    muestras_memoria = min(iteraciones, 50)
+    desplazamiento = calentamiento + iteraciones
+    tracemalloc.start()
+    asignados = []
+    for i in range(desplazamiento, desplazamiento + muestras_memoria):
+        tracemalloc.reset_peak()
+        base, _ = tracemalloc.get_traced_memory()
+        await fn(i)
+        _, pico = tracemalloc.get_traced_memory()
+        asignados.append(pico - base)
+    tracemalloc.stop()
+
+    latencias.sort()
+    return {
+        "nombre": nombre,
+        "iteraciones": iteraciones,
+        "ops_por_segundo": round(iteraciones / duracion, 1),
+        "p50_ms": round(statistics.median(latencias), 4),
+        "p99_ms": round(latencias[min(len(latencias) - 1, int(len(latencias) * 0.99))], 4),
+        "kb_por_llamada": round(statistics.mean(asignados) / 1024, 2)
+    }
+
+
+async def ejecutar_suite(iteraciones: int, calentamiento: int) -> List[dict]:
+    resultados = []
+    total = iteraciones + calentamiento + min(iteraciones, 50)
+
+    # verify_jwt: con la caché de tokens y validando la firma en cada llamada
+    token = jwt.encode(
+        {"id": USUARIO_BENCH, "role": "user", "exp": int(time.time()) + 3600},
+        settings.jwt_secret,
+        algorithm=settings.jwt_algorithm
+    )
+    credenciales = HTTPAuthorizationCredentials(scheme="Bearer", credentials=token)
+
+    async def jwt_cache(_):
+        verify_jwt(credenciales)
+
+    async def jwt_sin_cache(_):
+        tokens_cache.limpiar()
+        verify_jwt(credenciales)
+
+    resultados.append(await medir("verify_jwt (cache)", jwt_cache, iteraciones, calentamiento))
+    resultados.append(await medir("verify_jwt (sin cache)", jwt_sin_cache, iteraciones, calentamiento))
+
+    # crear_compra
+    compras_creadas: List[int] = []
+
+    async def crear(i):
+        compra = await compras_service.crear_compra(
+            CompraCreate(evento_id=EVENTO_BENCH_BASE + 1 + i % EVENTOS_BENCH, cantidad=1),
+            USUARIO_BENCH
+        )
+        compras_creadas.append(compra.id)
+
+    resultados.append(await medir("crear_compra", crear, iteraciones, calentamiento))
+    assert len(compras_creadas) == total
+
+    # confirmar_pago sobre las compras pendientes recién creadas
+    pago = CompraPago(metodo_pago="tarjeta")
+
+    async def pagar(i):
+        await compras_service.confirmar_pago(compras_creadas[i], pago, USUARIO_BENCH)
+
+    resultados.append(await medir("confirmar_pago", pagar, iteraciones, calentamiento))
+
+    # listar_compras_usuario (primera página) y relay del outbox
+    async def listar(_):
+        await compras_service.listar_compras_usuario(USUARIO_BENCH, limit=50)
+
+    resultados.append(await medir("listar_compras_usuario", listar, iteraciones, calentamiento))
+
+    # Relay del outbox: solo los mensajes de la suite, con lotes completos
+    iteraciones_relay = min(iteraciones, 50)
+    await sembrar_outbox((iteraciones_relay + 1 + iteraciones_relay) * outbox_relay.lote)
+
+    async def relay(_):
+        await outbox_relay.procesar_lote(_outbox_bench())
+
+    resultados.append(await medir("outbox_relay.procesar_lote", relay, iteraciones_relay, 1))
+
+    return resultados
+
+
+def _eventos_bench(columna):
+    return columna.between(EVENTO_BENCH_BASE + 1, EVENTO_BENCH_BASE + EVENTOS_BENCH)
+
+
+def _outbox_bench():
+    """Mensajes del outbox generados por la suite"""
+    return outbox_table.c.payload["usuarioId"].as_string() == USUARIO_BENCH
+
+
+async def sembrar_outbox(mensajes: int):
+    """Inserta mensajes de la suite en el outbox (los de pagos ya cuentan)"""
+    pendientes = await database.fetch_val(
+        sqlalchemy.select(sqlalchemy.func.count()).select_from(outbox_table).where(_outbox_bench())
+    )
+    faltan = mensajes - pendientes
+    if faltan <= 0:
+        return
+    await database.execute_many(
+        outbox_table.insert(),
+        [
+            {
+                "tipo": "pago_confirmado",
+                "payload": {
+                    "compraId": 0,
+                    "usuarioId": USUARIO_BENCH,
+                    "eventoId": EVENTO_BENCH_BASE + 1 + i % EVENTOS_BENCH,
+                    "cantidad": 1,
+                    "total": 25.0,
+                    "metodoPago": "tarjeta"
+                }
+            }
+            for i in range(faltan)
+        ]
+    )
+
+
+async def limpiar():
+    """Elimina los datos generados por la suite (solo su usuario y sus eventos)"""
+    async with database.transaction():
+        for tabla in (compras_table, compras_archivo_table):
+            await database.execute(
+                tabla.delete().where(
+                    tabla.c.usuario_id == USUARIO_BENCH,
+                    _eventos_bench(tabla.c.evento_id)
+                )
+            )
+        await database.execute(
+            outbox_table.delete().where(_outbox_bench())
+        )
+        await database.execute(
+            idempotencia_table.delete().where(idempotencia_table.c.usuario_id == USUARIO_BENCH)
+        )
+        for tabla in (inventario_table, ventas_eventos_table):
+            await database.execute(tabla.delete().where(_eventos_bench(tabla.c.evento_id)))
+
+
+def _metadatos() -> dict:
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        "commit": commit,
+        "python": platform.python_version(),
+        "fecha": time.strftime("%Y-%m-%dT%H:%M:%S")
+    }
+
+
+def imprimir(resultados: List[dict], baseline: Dict[str, dict]):
+    print(f"{'caso':<30} {'ops/s':>10} {'p50 ms':>9} {'p99 ms':>9} {'KB/llamada':>11} {'vs base':>9}")
+    for r in resultados:
+        comparacion = ""
+        base = baseline.get(r["nombre"])
+        if base:
+            cambio = (r["ops_por_segundo"] - base["ops_por_segundo"]) / base["ops_por_segundo"] * 100
+            comparacion = f"{cambio:+.1f}%" + (" !" if cambio <= -UMBRAL_REGRESION else "")
+        print(
+            f"{r['nombre']:<30} {r['ops_por_segundo']:>10} {r['p50_ms']:>9} "
+            f"{r['p99_ms']:>9} {r['kb_por_llamada']:>11} {comparacion:>9}"
+        )
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--iteraciones", type=int, default=300)
+    parser.add_argument("--calentamiento", type=int, default=20)
+    parser.add_argument("--guardar", help="Guarda los resultados como baseline JSON")
+    parser.add_argument("--comparar", help="Baseline JSON con el que comparar")
+    args = parser.parse_args()
+
+    eventos_client.client = httpx.AsyncClient(
+        base_url=settings.eventos_service_url,
+        transport=httpx.MockTransport(_eventos_handler)
+    )
+    publicador = PublicadorEnMemoria()
+    rabbitmq_client.publicar_lote = publicador.publicar_lote
+    rabbitmq_client.publicar_mensaje = publicador.publicar_mensaje
+
+    await connect_db()
+    try:
+        resultados = await ejecutar_suite(args.iteraciones, args.calentamiento)
+    finally:
+        await limpiar()
+        await disconnect_db()
+        await eventos_client.cerrar()
+
+    baseline = {}
+    if args.comparar:
+        with open(args.comparar) as f:
+            baseline = {r["nombre"]: r for r in json.load(f)["resultados"]}
+
+    imprimir(resultados, baseline)
+
+    if args.guardar:
+        with open(args.guardar, "w") as f:
+            json.dump({"metadatos": _metadatos(), "resultados": resultados}, f, indent=2)
+        print(f"Baseline guardado en {args.guardar}")
+
+    regresiones = [
+        r["nombre"] for r in resultados
+        if r["nombre"] in baseline and
+        r["ops_por_segundo"] < baseline[r["nombre"]]["ops_por_segundo"] * (1 - UMBRAL_REGRESION / 100)
+    ]
+    if regresiones:
+        print(f"Regresiones: {', '.join(regresiones)}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,103 @@
+"""
+Pruebas de la caché TTL y de SingleFlight
+"""
+import asyncio
+import random
+import threading
+import time
+import pytest
+from app.utils import cache as modulo_cache
+from app.utils.cache import SingleFlight, TTLCache
+
+
+class _RelojQueCede:
+    """Reloj que cede el GIL en cada lectura para forzar carreras entre hilos"""
+
+    def monotonic(self) -> float:
+        time.sleep(0)
+        return time.monotonic()
+
+
+def test_ttlcache_concurrente_con_evicciones(monkeypatch):
+    """Varios hilos leyendo, escribiendo y expulsando no rompen la caché"""
+    monkeypatch.setattr(modulo_cache, "time", _RelojQueCede())
+    cache = TTLCache(8, 60.0)
+    errores = []
+    inicio = threading.Barrier(8)
+
+    def trabajar(semilla: int):
+        azar = random.Random(semilla)
+        inicio.wait()
+        try:
+            for _ in range(5_000):
+                clave = azar.randrange(32)
+                if azar.random() < 0.5:
+                    cache.set(clave, clave, azar.choice([None, 0.0001]))
+                else:
+                    encontrado, valor = cache.get(clave)
+                    assert not encontrado or valor == clave
+        except Exception as e:
+            errores.append(e)
+
+    hilos = [threading.Thread(target=trabajar, args=(i,)) for i in range(8)]
+    for hilo in hilos:
+        hilo.start()
+    for hilo in hilos:
+        hilo.join()
+
+    assert errores == []
+    assert len(cache) <= 8
+    assert cache.metricas()["evictions"] > 0
+
+
+def test_singleflight_cancelar_al_primero_no_afecta_al_resto():
+    """Si el primer llamador se cancela, los demás reciben el resultado"""
+    async def escenario():
+        single_flight = SingleFlight()
+        ejecuciones = 0
+        liberar = asyncio.Event()
+
+        async def cargar():
+            nonlocal ejecuciones
+            ejecuciones += 1
+            await liberar.wait()
+            return "resultado"
+
+        primero = asyncio.create_task(single_flight.do("clave", cargar))
+        await asyncio.sleep(0)
+        seguidores = [
+            asyncio.create_task(single_flight.do("clave", cargar)) for _ in range(5)
+        ]
+        await asyncio.sleep(0)
+
+        primero.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await primero
+
+        liberar.set()
+        resultados = await asyncio.gather(*seguidores)
+        return ejecuciones, resultados, single_flight
+
+    ejecuciones, resultados, single_flight = asyncio.run(escenario())
+    assert ejecuciones == 1
+    assert resultados == ["resultado"] * 5
+    assert single_flight.compartidas == 5
+    assert single_flight._en_curso == {}
+
+
+def test_singleflight_propaga_excepciones():
+    """La excepción de fn llega a todos los llamadores"""
+    async def escenario():
+        single_flight = SingleFlight()
+
+        async def fallar():
+            await asyncio.sleep(0)
+            raise ValueError("fallo")
+
+        return await asyncio.gather(
+            *(single_flight.do("clave", fallar) for _ in range(3)),
+            return_exceptions=True
+        )
+
+    resultados = asyncio.run(escenario())
+    assert all(isinstance(r, ValueError) for r in resultados)
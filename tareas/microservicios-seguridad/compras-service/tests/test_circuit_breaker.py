@@ -0,0 +1,41 @@
+"""
+Pruebas de la cabecera de datos obsoletos
+"""
+import asyncio
+from app.utils.circuit_breaker import DatosObsoletosMiddleware, marcar_obsoleto
+
+
+async def _peticion(app):
+    """Ejecuta una petición HTTP ASGI y devuelve los mensajes enviados"""
+    enviados = []
+
+    async def recibir():
+        return {"type": "http.request", "body": b""}
+
+    async def enviar(mensaje):
+        enviados.append(mensaje)
+
+    await app({"type": "http", "headers": []}, recibir, enviar)
+    return enviados
+
+
+def test_cabecera_de_datos_obsoletos_marcados_en_tareas_hijas():
+    async def app(scope, receive, send):
+        await asyncio.gather(asyncio.create_task(_marcar("eventos")), _marcar("usuarios"))
+        await send({"type": "http.response.start", "status": 200, "headers": []})
+        await send({"type": "http.response.body", "body": b"{}"})
+
+    async def _marcar(fuente):
+        marcar_obsoleto(fuente)
+
+    enviados = asyncio.run(_peticion(DatosObsoletosMiddleware(app)))
+    assert dict(enviados[0]["headers"])[b"x-datos-obsoletos"] == b"eventos,usuarios"
+    assert enviados[1]["body"] == b"{}"
+
+
+def test_sin_datos_obsoletos_no_hay_cabecera():
+    async def app(scope, receive, send):
+        await send({"type": "http.response.start", "status": 200, "headers": []})
+
+    enviados = asyncio.run(_peticion(DatosObsoletosMiddleware(app)))
+    assert enviados[0]["headers"] == []
@@ -0,0 +1,94 @@
+"""
+Pruebas del enrutado de lecturas con read-your-writes
+"""
+import asyncio
+from app.utils.db_router import (
+    DatabaseRouter,
+    ReadYourWritesMiddleware,
+    entero_a_lsn,
+    lsn_a_entero
+)
+
+
+class _BaseDeDatos:
+    """Base de datos en memoria que devuelve siempre la misma fila"""
+
+    def __init__(self, fila, lsn: str = "0/0"):
+        self.fila = fila
+        self.lsn = lsn
+        self.lecturas = 0
+
+    async def fetch_one(self, query):
+        self.lecturas += 1
+        return self.fila
+
+    async def fetch_val(self, query):
+        return self.lsn
+
+
+def _router(primario, replica, lsn_replica: str) -> DatabaseRouter:
+    router = DatabaseRouter(primario, [replica], 5.0, 5.0, 10.0)
+    router.replicas[0].sana = True
+    router.replicas[0].lsn = lsn_a_entero(lsn_replica)
+    return router
+
+
+async def _peticion(app, cabeceras):
+    """Ejecuta una petición HTTP ASGI y devuelve las cabeceras de la respuesta"""
+    enviados = []
+
+    async def recibir():
+        return {"type": "http.request", "body": b""}
+
+    async def enviar(mensaje):
+        enviados.append(mensaje)
+
+    await app({"type": "http", "headers": cabeceras}, recibir, enviar)
+    return dict(enviados[0]["headers"])
+
+
+def test_lsn_ida_y_vuelta():
+    assert lsn_a_entero("16/B374D848") == (0x16 << 32) | 0xB374D848
+    assert entero_a_lsn(lsn_a_entero("16/B374D848")) == "16/B374D848"
+
+
+def test_lsn_del_cliente_descarta_replicas_atrasadas():
+    """Otro worker con la cookie lee en el primario si la réplica no llegó"""
+    primario = _BaseDeDatos({"id": 1})
+    replica = _BaseDeDatos({"id": 1})
+    router = _router(primario, replica, "0/100")
+
+    async def app(scope, receive, send):
+        await router.fetch_one("consulta")
+        await send({"type": "http.response.start", "status": 200, "headers": []})
+
+    middleware = ReadYourWritesMiddleware(app, router)
+    asyncio.run(_peticion(middleware, [(b"cookie", b"compras_lsn=0/200")]))
+    assert (primario.lecturas, replica.lecturas) == (1, 0)
+
+    router.replicas[0].lsn = lsn_a_entero("0/200")
+    asyncio.run(_peticion(middleware, [(b"x-compras-lsn", b"0/200")]))
+    assert (primario.lecturas, replica.lecturas) == (1, 1)
+
+
+def test_escritura_devuelve_lsn_del_primario():
+    primario = _BaseDeDatos(None, lsn="0/2A0")
+    router = _router(primario, _BaseDeDatos(None), "0/0")
+
+    async def app(scope, receive, send):
+        router.marcar_escritura("usuario")
+        await send({"type": "http.response.start", "status": 201, "headers": []})
+
+    cabeceras = asyncio.run(_peticion(ReadYourWritesMiddleware(app, router), []))
+    assert cabeceras[b"x-compras-lsn"] == b"0/2A0"
+    assert cabeceras[b"set-cookie"].startswith(b"compras_lsn=0/2A0;")
+
+
+def test_busqueda_vacia_en_replica_se_repite_en_primario():
+    primario = _BaseDeDatos({"id": 7})
+    replica = _BaseDeDatos(None)
+    router = _router(primario, replica, "0/0")
+
+    assert asyncio.run(router.fetch_one("consulta")) is None
+    assert asyncio.run(router.fetch_one("consulta", primario_si_vacio=True)) == {"id": 7}
+    assert router.reintentos_primario == 1
@@ -0,0 +1,68 @@
+"""
+Pruebas del cliente de Eventos
+"""
+import asyncio
+import httpx
+import pytest
+from app.services.eventos_client import CLAVE_CATALOGO, EventosClient
+from app.utils.circuit_breaker import SEMIABIERTO
+
+
+def test_cancelar_una_llamada_no_cuenta_como_fallo():
+    """Un cliente que abandona la petición no abre el circuito ni ocupa la sonda"""
+    async def escenario():
+        recibida = asyncio.Event()
+
+        async def lenta(request):
+            recibida.set()
+            await asyncio.sleep(60)
+            return httpx.Response(200, json={})
+
+        cliente = EventosClient()
+        cliente.client = httpx.AsyncClient(
+            base_url="http://eventos.test",
+            transport=httpx.MockTransport(lenta)
+        )
+        cliente.breaker.estado = SEMIABIERTO
+        try:
+            llamada = asyncio.create_task(cliente._get("/eventos/1", 5.0))
+            await recibida.wait()
+            llamada.cancel()
+            with pytest.raises(asyncio.CancelledError):
+                await llamada
+        finally:
+            await cliente.cerrar()
+        return cliente
+
+    cliente = asyncio.run(escenario())
+    assert cliente.breaker.estado == SEMIABIERTO
+    assert cliente.breaker._sondas_en_vuelo == 0
+    assert cliente.en_vuelo == 0
+
+
+def test_cerrar_cancela_el_refresco_del_catalogo():
+    """cerrar() no deja la descarga del catálogo en segundo plano"""
+    async def escenario():
+        recibida = asyncio.Event()
+
+        async def lenta(request):
+            recibida.set()
+            await asyncio.sleep(60)
+            return httpx.Response(200, json={"eventos": []})
+
+        cliente = EventosClient()
+        cliente.client = httpx.AsyncClient(
+            base_url="http://eventos.test",
+            transport=httpx.MockTransport(lenta)
+        )
+        cliente._refresco = asyncio.create_task(
+            cliente.single_flight.do(CLAVE_CATALOGO, cliente._cargar_catalogo)
+        )
+        await recibida.wait()
+        await cliente.cerrar()
+        return cliente
+
+    cliente = asyncio.run(escenario())
+    assert cliente._refresco is None
+    assert cliente.single_flight._en_curso == {}
+    assert cliente.client is None
@@ -0,0 +1,61 @@
+"""
+Pruebas de la serialización de ModeloJSONResponse frente a JSONResponse
+"""
+from datetime import datetime, timedelta, timezone
+from decimal import Decimal
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
+from app.models.compra import CompraDetallada
+from app.schemas.compra_schema import CompraListResponse
+from app.utils.respuestas import ModeloJSONResponse
+
+
+def _compra() -> CompraDetallada:
+    return CompraDetallada.model_construct(
+        id=7,
+        usuario_id="usuario-ñ",
+        evento_id=3,
+        cantidad=2,
+        precio_unitario=Decimal("25.50"),
+        total=Decimal("51.00"),
+        estado="pagado",
+        metodo_pago=None,
+        fecha_compra=datetime(2025, 3, 1, 12, 30, 0, 123456, tzinfo=timezone.utc),
+        fecha_pago=datetime(2025, 3, 1, 8, 0, tzinfo=timezone(timedelta(hours=-4))),
+        evento={"nombre": "Concierto", "precio": 25.5, "capacidad": 100, "aforo": 1e16}
+    )
+
+
+def _antes(modelo) -> bytes:
+    """Salida del camino anterior: response_model + jsonable_encoder + json.dumps"""
+    return JSONResponse(jsonable_encoder(modelo.model_dump(mode="json"))).body
+
+
+def test_misma_salida_que_jsonresponse():
+    """Decimal, datetime con zona, floats y texto no ASCII salen byte a byte igual"""
+    compra = _compra()
+    pagina = CompraListResponse.model_construct(
+        cantidad=1, total=1, compras=[compra], siguiente_cursor=None
+    )
+
+    assert ModeloJSONResponse(compra).body == _antes(compra)
+    assert ModeloJSONResponse(pagina).body == _antes(pagina)
+
+
+def test_formato_fijado():
+    """Decimal como texto sin normalizar, floats como json.dumps, UTF-8 sin escapar"""
+    cuerpo = ModeloJSONResponse(_compra()).body
+
+    assert b'"precio_unitario":"25.50","total":"51.00"' in cuerpo
+    assert b'"fecha_compra":"2025-03-01T12:30:00.123456Z"' in cuerpo
+    assert b'"fecha_pago":"2025-03-01T08:00:00-04:00"' in cuerpo
+    assert b'"precio":25.5' in cuerpo
+    assert b'"aforo":1e+16' in cuerpo
+    assert '"usuario_id":"usuario-ñ"'.encode() in cuerpo
+
+
+def test_datos_ya_serializados():
+    """Las respuestas de idempotencia almacenadas (dict) salen como JSONResponse"""
+    almacenada = jsonable_encoder(_compra())
+
+    assert ModeloJSONResponse(almacenada).body == JSONResponse(almacenada).body
@@ -1,3 +1,4 @@
+const mongoose = require('mongoose');
 const User = require('../models/User');
 const jwt = require('jsonwebtoken');
 const logger = require('../config/logger');
@@ -89,6 +90,33 @@ const getUserById = async (req, res) => {
     }
 };
 
+// Máximo de ids por consulta por lotes
+const MAX_IDS_LOTE = 100;
+
+// Obtener varios usuarios por ID (microservicio, una consulta por lote)
+// Los ids inexistentes o inactivos simplemente no aparecen en la respuesta
+const getUsersByIds = async (req, res) => {
+    try {
+        const ids = String(req.query.ids || '')
+            .split(',')
+            .map((id) => id.trim())
+            .filter(Boolean);
+
+        if (ids.length === 0 || ids.length > MAX_IDS_LOTE) {
+            return res.status(400).json({ message: `Se requieren entre 1 y ${MAX_IDS_LOTE} ids` });
+        }
+
+        logger.info('Obteniendo usuarios por lote (microservicio)', { total: ids.length });
+
+        const validos = ids.filter((id) => mongoose.Types.ObjectId.isValid(id));
+        const users = await User.find({ _id: { $in: validos }, isActive: true }).select('-password');
+
+        res.status(200).json({ users });
+    } catch (error) {
+        logger.error('Error al obtener usuarios por lote:', error.message);
+        res.status(500).json({ message: 'Error interno' });
+    }
+};
 
 // List all users (admin only)
 const getAllUsers = async (req, res) => {
@@ -158,6 +186,7 @@ module.exports = {
     login,
     getMe,
     getUserById,
+    getUsersByIds,
     getAllUsers,
     updateUser,
     deleteUser
@@ -1,6 +1,6 @@
 const express = require('express');
 const { verifyToken, isAdmin } = require('../middleware/auth');
-const { getMe, getUserById, getAllUsers, updateUser, deleteUser } = require('../controllers/userController');
+const { getMe, getUserById, getUsersByIds, getAllUsers, updateUser, deleteUser } = require('../controllers/userController');
 
 const router = express.Router();
 
@@ -11,6 +11,8 @@ router.get('/', verifyToken, isAdmin, getAllUsers);
 router.put('/:id', verifyToken, updateUser);
 router.delete('/:id', verifyToken, deleteUser);
 
+// Antes de '/:id' para que 'batch' no se tome como id
+router.get('/batch', getUsersByIds);
 router.get('/:id', getUserById);
 
 module.exports = router;
\ No newline at end of file